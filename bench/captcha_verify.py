@@ -0,0 +1,100 @@
+"""验证码点击 (callback_query_vcode) 每秒能完成的验证数，分别在写入数据库和不写入数据库时测量。
+
+在进程内按处理器的顺序执行一次点击的全部本地工作：读取用户状态、校验签名 (verify_callback)、
+重复点击过滤 (CallbackDeduper) 和记录验证结果 (UserStateStore.mark_human)，不调用 Bot API。
+"database" 一行使用机器人的 _save_is_human (每次验证写入并提交一次 users 表)，"memory" 一行不写入。
+每个用户先答对一次，再重复点击 --taps 次。另外单独测量过滤器已满 (100000 条) 时每秒能记录的点击数，此时每次点击都要淘汰最早的记录。
+
+    python bench/captcha_verify.py --users 20000 --taps 2
+"""
+import argparse
+import time
+
+from common import package_module, print_table, setup_environment
+
+
+def taps(captcha, key: bytes, users: int, issued_at: int) -> list:
+    """[(用户, 正确选项的回调数据)]，每个用户一个验证码。"""
+    from telegram import User
+
+    return [
+        (User(100000 + i, f"User{i}", False), captcha.challenge_callback_data(key, 100000 + i, "ABCDE", ["ABCDE"], issued_at)[0])
+        for i in range(users)
+    ]
+
+
+def run_once(name: str, save_human, users: int, repeats: int) -> list:
+    captcha = package_module("captcha")
+    userstate = package_module("userstate")
+    main = package_module("__main__")
+    key = captcha.captcha_key("123456:TEST")
+    states = userstate.UserStateStore(main._load_is_human, save_human)
+    deduper = captcha.CallbackDeduper(main.CAPTCHA_TTL)
+    clicks = taps(captcha, key, users, captcha.timestamp_ms())
+    for user, _ in clicks:
+        states.get(user.id) # 用户发出首条消息时已载入状态 (check_human)，不计入验证耗时
+
+    def tap(user, data) -> bool:
+        """与 callback_query_vcode 相同的本地处理，返回是否记录了验证结果。"""
+        state = states.get(user.id)
+        result = captcha.verify_callback(key, data, user.id, main.CAPTCHA_TTL, state.captcha_not_before)
+        if not deduper.first((user.id, user.id)) or state.is_human:
+            return False
+        if result == captcha.OK:
+            states.mark_human(user)
+            return True
+        return False
+
+    started = time.perf_counter()
+    verified = sum(tap(user, data) for user, data in clicks)
+    first = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for user, data in clicks:
+            tap(user, data)
+    repeated = time.perf_counter() - started
+    duplicates = users * repeats
+    return [
+        name,
+        verified,
+        verified / first,
+        first / verified * 1e6,
+        duplicates / repeated if duplicates else 0.0,
+        len(deduper),
+    ]
+
+
+def deduper_rate(max_size: int, clicks: int) -> float:
+    """过滤器已满且记录都未过期时每秒能记录的新点击数。"""
+    deduper = package_module("captcha").CallbackDeduper(3600, max_size)
+    now = 1_700_000_000.0
+    for i in range(max_size):
+        deduper.first(i, now)
+    started = time.perf_counter()
+    for i in range(max_size, max_size + clicks):
+        deduper.first(i, now)
+    return clicks / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=20000, help="每种方式完成验证的用户数")
+    parser.add_argument("--taps", type=int, default=2, help="每个用户验证后重复点击的次数")
+    parser.add_argument("--clicks", type=int, default=300000, help="测量过滤器淘汰速度的点击数")
+    args = parser.parse_args()
+
+    setup_environment()
+    main_module = package_module("__main__")
+    rows = [
+        run_once("memory", lambda user: None, args.users, args.taps),
+        run_once("database", main_module._save_is_human, args.users, args.taps),
+    ]
+    print(f"users={args.users} taps={args.taps}")
+    print_table(["persistence", "verified", "verifications/s", "us/verification", "duplicate taps/s", "deduper size"], rows)
+    print()
+    print_table(["deduper size", "clicks/s"], [[size, deduper_rate(size, args.clicks)] for size in (1000, 100000)])
+
+
+if __name__ == "__main__":
+    main()
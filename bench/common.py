@@ -0,0 +1,80 @@
+"""基准测试脚本的公共部分。
+
+每个脚本单独运行并把结果打印为表格，例如 python bench/shard_throughput.py --workers 1 2 4。
+脚本使用 tests/ 中的测试配置 (假的令牌和临时工作目录) 和本地的假 Bot API，不需要真实的机器人。
+"""
+import asyncio
+import contextlib
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+from soak import setup_environment # noqa: E402
+
+
+def _serve_fake_api(latency: float, urls, stop):
+    from fakebotapi import FakeBotAPI
+
+    async def serve():
+        api = FakeBotAPI(latency=latency, keep_calls=100)
+        urls.put(await api.start())
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+        await api.stop()
+
+    asyncio.run(serve())
+
+
+@contextlib.contextmanager
+def fake_api_process(latency: float = 0.0):
+    """在独立进程中运行假 Bot API (不与被测的客户端争用同一个事件循环和 CPU)，返回其地址。"""
+    ctx = multiprocessing.get_context("spawn")
+    urls = ctx.Queue()
+    stop = ctx.Event()
+    server = ctx.Process(target=_serve_fake_api, args=(latency, urls, stop), daemon=True)
+    server.start()
+    try:
+        yield urls.get(timeout=30)
+    finally:
+        stop.set()
+        server.join(10)
+
+
+def package_module(name: str = None):
+    """导入包或包中的模块 (包名含 "-"，需先调用 setup_environment 设置配置)。"""
+    return importlib.import_module(f"interactive-bot.{name}" if name else "interactive-bot")
+
+
+def rss_mb() -> float:
+    return package_module("monitor").current_rss() / 2**20
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+
+
+def print_table(headers: list, rows: list):
+    cells = [[str(h) for h in headers]] + [[f"{c:.2f}" if isinstance(c, float) else str(c) for c in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(headers))]
+    for row in cells:
+        print("  ".join(c.rjust(w) for c, w in zip(row, widths)))
+
+
+__all__ = ["setup_environment", "fake_api_process", "package_module", "rss_mb", "percentile", "Timer", "print_table", "ROOT"]
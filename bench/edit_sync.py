@@ -0,0 +1,155 @@
+"""编辑同步两种方式的开销对比：HTML 路径 (text_html 序列化后以 parse_mode=HTML 发送) 和实体路径 (直接传递 entities)。
+
+对几种典型的消息 (短文本、带大量格式的长文本、带格式的说明文字)：
+序列化一栏只测 text_html / caption_html 本身的耗时；调用一栏通过与机器人相同的 telegram.Bot
+向本地假 Bot API (在独立进程中运行) 发送 --edits 次编辑，记录每秒编辑数和客户端每次调用的 CPU 时间；
+请求大小为文本字段加格式字段的字节数。假 Bot API 不解析 HTML，Telegram 服务端解析 HTML 的开销不在其中。
+另外单独测量 EditCoalescer 记录同步摘要的速度 (缓存已满、需要淘汰时)。
+
+    python bench/edit_sync.py --edits 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import fake_api_process, package_module, print_table, setup_environment
+
+KINDS = ["bold", "italic", "code", "text_link", "underline", "strikethrough", "spoiler"]
+
+
+def _entities(text: str, count: int) -> list:
+    """在文本中均匀放置 count 个格式实体，每隔一个嵌套一个斜体。"""
+    step = max(2, len(text) // max(1, count))
+    entities = []
+    for i, offset in enumerate(range(0, len(text) - step, step)):
+        if len(entities) >= count:
+            break
+        kind = KINDS[i % len(KINDS)]
+        entity = {"type": kind, "offset": offset, "length": step - 1}
+        if kind == "text_link":
+            entity["url"] = f"https://example.com/{i}"
+        entities.append(entity)
+        if i % 2 and kind != "italic":
+            entities.append({"type": "italic", "offset": offset, "length": max(1, (step - 1) // 2)})
+    return entities
+
+
+def sample_messages(bot) -> dict:
+    from telegram import Message
+
+    base = {"message_id": 1, "date": int(time.time()), "chat": {"id": 1000, "type": "private"}}
+    long_text = ("格式 <b>&amp; 文本 " * 400)[:4000]
+    caption = ("说明 & <文字> " * 100)[:1000]
+    photo = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}]
+    raw = {
+        "short text": {**base, "text": "hello, edited", "entities": _entities("hello, edited", 1)},
+        "rich text 4000": {**base, "text": long_text, "entities": _entities(long_text, 300)},
+        "rich caption 1000": {**base, "photo": photo, "caption": caption, "caption_entities": _entities(caption, 80)},
+    }
+    return {name: Message.de_json(data, bot) for name, data in raw.items()}
+
+
+def serialize_seconds(message, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        message.text_html if message.text is not None else message.caption_html
+    return (time.perf_counter() - started) / rounds
+
+
+def payload_bytes(message, html: bool) -> int:
+    if message.text is not None:
+        text, entities = message.text, message.entities
+        text_html = message.text_html if html else None
+    else:
+        text, entities = message.caption, message.caption_entities
+        text_html = message.caption_html if html else None
+    if html:
+        return len(text_html.encode()) + len('"HTML"')
+    return len(text.encode()) + len(json.dumps([e.to_dict() for e in entities], ensure_ascii=False).encode())
+
+
+async def edit(bot, message, html: bool):
+    """与 _sync_edit_later 相同的调用，html=True 时使用改动前的 HTML 方式。"""
+    if message.text is not None:
+        if html:
+            await bot.edit_message_text(chat_id=-100, message_id=1, text=message.text_html, parse_mode="HTML")
+        else:
+            await bot.edit_message_text(chat_id=-100, message_id=1, text=message.text, entities=message.entities)
+    elif html:
+        await bot.edit_message_caption(chat_id=-100, message_id=1, caption=message.caption_html, parse_mode="HTML")
+    else:
+        await bot.edit_message_caption(
+            chat_id=-100, message_id=1, caption=message.caption, caption_entities=message.caption_entities
+        )
+
+
+async def run_calls(bot, message, html: bool, edits: int, concurrency: int) -> tuple:
+    remaining = iter(range(edits))
+
+    async def worker():
+        for _ in remaining:
+            await edit(bot, message, html)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return edits / elapsed, (time.process_time() - cpu_started) / edits
+
+
+def coalescer_rate(capacity: int, marks: int) -> float:
+    """缓存已满时每秒能记录的同步摘要数，每三次记录中有一次更新较早的目标消息。"""
+    coalescer = package_module("editsync").EditCoalescer(capacity)
+    for i in range(capacity):
+        coalescer.mark_synced((1, i), ("media", "text"))
+    started = time.perf_counter()
+    for i in range(capacity, capacity + marks):
+        coalescer.mark_synced((1, i), ("media", "text"))
+        if i % 3 == 0:
+            coalescer.mark_synced((1, i - 5), ("media", "edited"))
+    return marks / (time.perf_counter() - started)
+
+
+async def run(url: str, args) -> list:
+    from telegram import Bot
+
+    config = package_module()
+    request = package_module("network").TunedHTTPXRequest(connection_pool_size=args.concurrency)
+    bot = Bot(config.bot_token, base_url=f"{url}/bot", request=request)
+    rows = []
+    async with bot:
+        for name, message in sample_messages(bot).items():
+            serialize = serialize_seconds(message, args.rounds)
+            for html in (True, False):
+                rate, cpu = await run_calls(bot, message, html, args.edits, args.concurrency)
+                rows.append([
+                    name,
+                    "html" if html else "entities",
+                    serialize * 1e6 if html else 0.0,
+                    rate,
+                    cpu * 1e6,
+                    payload_bytes(message, html),
+                ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--edits", type=int, default=2000, help="每种消息和方式的编辑次数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=2000, help="测量序列化耗时的重复次数")
+    parser.add_argument("--marks", type=int, default=300000, help="测量 EditCoalescer 的记录次数")
+    args = parser.parse_args()
+
+    setup_environment()
+    with fake_api_process() as url:
+        rows = asyncio.run(run(url, args))
+    print(f"edits={args.edits} concurrency={args.concurrency}")
+    print_table(["message", "path", "serialize us", "edits/s", "CPU us/edit", "request bytes"], rows)
+    print()
+    print_table(["coalescer size", "marks/s"], [[size, coalescer_rate(size, args.marks)] for size in (1000, 100000)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Bot API 客户端的调用吞吐量和尾延迟随连接池大小 (HTTP_POOL_SIZE) 的变化。
+
+--concurrency 个并发任务 (模拟并发处理更新和广播) 通过与机器人相同的 TunedHTTPXRequest
+调用本地假 Bot API (在独立进程中运行) 的 sendMessage，每种连接池大小运行 --calls 次调用。
+超时列为等待空闲连接超时 (PoolTimeout) 或请求超时的次数。假 Bot API 只支持 HTTP/1.1，HTTP2 开关不在这里测量。
+
+连接池不是越大越好：httpcore 每次为请求分配连接都要检查池中所有连接，排队的请求越多、连接越多，
+客户端自身的 CPU 开销越大，连接数超过实际并发时吞吐量反而下降。
+
+    python bench/http_pool.py --pool-sizes 4 16 64 256 --concurrency 64 --calls 2000 --api-latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from common import fake_api_process, package_module, percentile, print_table, setup_environment
+
+
+async def run_once(url: str, pool_size: int, concurrency: int, calls: int, pool_timeout: float) -> list:
+    from telegram import Bot
+    from telegram.error import TimedOut
+
+    network = package_module("network")
+    config = package_module()
+    request = network.TunedHTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=config.http_connect_timeout,
+        read_timeout=config.http_read_timeout,
+        write_timeout=config.http_write_timeout,
+        pool_timeout=pool_timeout,
+        keepalive_expiry=config.http_keepalive_expiry,
+    )
+    bot = Bot(config.bot_token, base_url=f"{url}/bot", request=request)
+    latencies = []
+    timeouts = 0
+    remaining = iter(range(calls))
+
+    async def caller():
+        nonlocal timeouts
+        for i in remaining:
+            started = time.perf_counter()
+            try:
+                await bot.send_message(1000 + i % 100, "bench")
+            except TimedOut: # 等待连接池超时 (PoolTimeout) 或请求超时
+                timeouts += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    async with bot:
+        started = time.perf_counter()
+        await asyncio.gather(*(caller() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    ms = lambda seconds: seconds * 1000
+    return [
+        pool_size,
+        len(latencies) / elapsed,
+        ms(percentile(latencies, 50)),
+        ms(percentile(latencies, 99)),
+        ms(max(latencies, default=0)),
+        timeouts,
+    ]
+
+
+async def run(url: str, args) -> list:
+    return [await run_once(url, size, args.concurrency, args.calls, args.pool_timeout) for size in args.pool_sizes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[4, 16, 64, 256])
+    parser.add_argument("--concurrency", type=int, default=64, help="并发调用的任务数")
+    parser.add_argument("--calls", type=int, default=2000, help="每种连接池大小的调用次数")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="假 Bot API 每个请求的处理时间 (秒)")
+    parser.add_argument("--pool-timeout", type=float, default=5, help="等待空闲连接的最长时间 (秒)，同 HTTP_POOL_TIMEOUT")
+    args = parser.parse_args()
+
+    setup_environment()
+    with fake_api_process(args.api_latency) as url:
+        rows = asyncio.run(run(url, args))
+    print(f"concurrency={args.concurrency} calls={args.calls} api_latency={args.api_latency}s")
+    print_table(["pool size", "calls/s", "p50 ms", "p99 ms", "max ms", "timeouts"], rows)
+
+
+if __name__ == "__main__":
+    main()
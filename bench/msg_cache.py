@@ -0,0 +1,79 @@
+"""消息映射缓存 (MessageMapCache) 的命中率、查询速度和每 100 万条目的内存占用 (MESSAGE_CACHE_SIZE)。
+
+在进程内模拟消息流：每条新消息写入一条映射，同时按 --lookups 的比例查询较早的消息
+(回复、编辑、撤回等)。被查询消息的"年龄"(之后又来了多少条消息) 服从帕累托分布：大多数操作针对最近的消息，少数针对很久以前的消息。
+内存一栏为缓存填满 100 万条目时的 RSS 增量和按此换算的每条目字节数。
+
+    python bench/msg_cache.py --capacities 50000 200000 1000000 --messages 2000000
+"""
+import argparse
+import gc
+import random
+import time
+
+from common import package_module, print_table, rss_mb, setup_environment
+
+
+def traffic(messages: int, lookups: float, users: int, skew: float, seed: int = 0) -> list:
+    """[(消息序号, 用户 ID, 被查询的消息序号或 None)]，消息序号即用户侧和群组侧的消息 ID。"""
+    rng = random.Random(seed)
+    events = []
+    for i in range(1, messages + 1):
+        target = None
+        if rng.random() < lookups:
+            age = int(rng.paretovariate(skew)) - 1 # 年龄 0 最常见，长尾
+            target = i - age if age < i else None
+        events.append((i, i % users, target))
+    return events
+
+
+def run_once(capacity: int, events: list, users: int) -> list:
+    cache = package_module("msgcache").MessageMapCache(capacity)
+    started = time.perf_counter()
+    lookups = 0
+    for message_id, user_id, target in events:
+        cache.put(user_id, message_id, message_id)
+        if target is not None:
+            lookups += 1
+            if target % 2: # 一半是用户侧操作 (编辑)，一半是群组侧操作 (管理员回复)
+                cache.group_msg_id(target % users, target)
+            else:
+                cache.user_msg(target)
+    elapsed = time.perf_counter() - started
+    total = cache.hits + cache.misses
+    return [capacity, 100 * cache.hits / total if total else 0.0, len(events) / elapsed, lookups]
+
+
+def memory_per_million(entries: int = 1000000) -> list:
+    cache = package_module("msgcache").MessageMapCache(entries)
+    gc.collect()
+    before = rss_mb()
+    for i in range(1, entries + 1):
+        cache.put(100000 + i % 50000, i, 10000000 + i)
+    gc.collect()
+    used = rss_mb() - before
+    return [len(cache), used, used * 2**20 / len(cache)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--capacities", type=int, nargs="+", default=[50000, 200000, 1000000])
+    parser.add_argument("--messages", type=int, default=2000000, help="模拟的消息数")
+    parser.add_argument("--lookups", type=float, default=0.3, help="每条消息伴随一次查询的概率")
+    parser.add_argument("--skew", type=float, default=0.5, help="帕累托分布的形状参数，越小越多操作针对旧消息")
+    parser.add_argument("--users", type=int, default=50000)
+    args = parser.parse_args()
+
+    setup_environment()
+    # 先测内存，避免后面的事件列表和其他缓存影响 RSS 增量
+    entries, used, per_entry = memory_per_million()
+    events = traffic(args.messages, args.lookups, args.users, args.skew)
+    rows = [run_once(capacity, events, args.users) for capacity in args.capacities]
+    print(f"messages={args.messages} lookups={args.lookups} skew={args.skew} users={args.users}")
+    print_table(["capacity", "hit %", "messages/s", "lookups"], rows)
+    print()
+    print_table(["entries", "RSS +MB", "bytes/entry"], [[entries, used, per_entry]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""全文搜索 (/search，SEARCH_ENABLED) 在百万条消息语料上的写入速度、索引大小和查询延迟。
+
+在临时数据库中通过 SearchIndex.add() 按机器人的方式 (每批 200 条) 写入 --messages 条合成消息：
+英文单词和中文词按齐普夫分布组合，另有少量消息包含罕见词。然后对几类查询各运行 --repeats 次：
+高频词、罕见词、两个词、三字中文词 (trigram 匹配)、两字中文词 (trigram 无法匹配，退化为 LIKE 扫描，
+罕见时需要扫描全表) 和无结果的词。高频词只对最近 rank_window 条匹配计算相关度，见 SearchIndex。
+
+    python bench/search.py --messages 1000000 --repeats 20
+"""
+import argparse
+import os
+import random
+
+from common import Timer, package_module, percentile, print_table, setup_environment
+
+ENGLISH = ["order", "refund", "account", "payment", "shipping", "password", "delivery", "invoice", "support", "update"]
+CHINESE = ["订单", "退款", "账号", "付款", "快递", "密码", "发货", "发票", "客服", "更新"]
+FILLER = ["the", "my", "is", "not", "please", "help", "when", "why", "today", "again", "没收到", "怎么", "可以", "已经"]
+RARE = "zeppelin"
+RARE_CHINESE = "飞艇"
+
+
+def corpus(count: int, seed: int = 0):
+    """生成 (群组消息 ID, 用户 ID, 文本)。"""
+    rng = random.Random(seed)
+    words = ENGLISH + CHINESE + FILLER
+    weights = [1 / (rank + 1) for rank in range(len(words))] # 齐普夫分布
+    for i in range(1, count + 1):
+        text = " ".join(rng.choices(words, weights, k=rng.randint(4, 20)))
+        if i % 10000 == 0:
+            text += f" {RARE} {RARE_CHINESE}"
+        yield i, 100000 + i % 20000, text
+
+
+def build(index, count: int) -> float:
+    """写入语料，返回每秒写入的消息数。"""
+    with Timer() as timer:
+        for group_msg_id, user_id, text in corpus(count):
+            index.add(group_msg_id, user_id, "u2a", text)
+        index.flush()
+    return count / timer.seconds
+
+
+def run_queries(index, repeats: int) -> list:
+    queries = {
+        "common word": "order",
+        "rare word": RARE,
+        "two words": "refund payment",
+        "3-char chinese": "没收到",
+        "2-char common (LIKE)": "退款",
+        "2-char rare (LIKE)": RARE_CHINESE,
+        "no match": "xylophone",
+    }
+    rows = []
+    for name, keywords in queries.items():
+        latencies = []
+        for _ in range(repeats):
+            with Timer() as timer:
+                hits = index.search(keywords)
+            latencies.append(timer.seconds * 1000)
+        rows.append([name, keywords, len(hits), percentile(latencies, 50), percentile(latencies, 99)])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeats", type=int, default=20, help="每类查询的次数")
+    args = parser.parse_args()
+
+    setup_environment()
+    index = package_module("search").SearchIndex(True)
+    index.setup()
+    rate = build(index, args.messages)
+    db_mb = sum(
+        os.path.getsize(os.path.join("assets", name)) for name in os.listdir("assets") if name.startswith("db.sqlite3")
+    ) / 2**20
+    print(f"messages={args.messages} trigram={index.trigram} indexed {rate:.0f} messages/s, database {db_mb:.0f} MB")
+    print_table(["query", "keywords", "hits", "p50 ms", "p99 ms"], run_queries(index, args.repeats))
+
+
+if __name__ == "__main__":
+    main()
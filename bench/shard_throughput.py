@@ -0,0 +1,135 @@
+"""分片模式的吞吐量随 worker 数的变化 (SHARD_WORKERS)。
+
+机器人在子进程中按正常方式启动，通过 BOT_API_BASE_URL 连接本进程中的假 Bot API。
+每轮使用新的工作目录：先让 --users 个新用户各发一条消息 (创建话题)，再发 --messages 条普通消息，
+记录从放入更新到所有消息都转发到管理群组的时间。最后向机器人发送 SIGTERM 并检查其正常退出。
+
+    python bench/shard_throughput.py --workers 1 2 4 --users 200 --messages 2000 --api-latency 0.02
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import signal
+import tempfile
+import time
+
+from common import print_table, setup_environment
+
+from fakebotapi import FakeBotAPI
+
+
+class CountingBotAPI(FakeBotAPI):
+    """额外统计转发到管理群组的消息数和 getUpdates 次数。"""
+
+    def __init__(self, **kwargs):
+        super().__init__(keep_calls=100, **kwargs)
+        self.delivered = 0
+        self.polls = 0
+
+    async def _api_getUpdates(self, params):
+        self.polls += 1
+        return await super()._api_getUpdates(params)
+
+    async def _api_copyMessage(self, params):
+        if int(params["chat_id"]) < 0:
+            self.delivered += 1
+        return await super()._api_copyMessage(params)
+
+    async def _api_copyMessages(self, params):
+        if int(params["chat_id"]) < 0:
+            self.delivered += len(params.get("message_ids", []))
+        return await super()._api_copyMessages(params)
+
+
+def _run_bot(work_dir: str, base_url: str, workers: int):
+    """子进程：与 python -m interactive-bot 相同的启动方式。"""
+    setup_environment(work_dir)
+    os.environ["BOT_API_BASE_URL"] = base_url
+    os.environ["SHARD_WORKERS"] = str(workers)
+    from telegram import Update
+
+    from common import package_module
+
+    main = package_module("__main__")
+    if workers > 1:
+        main.run_sharded("interactive-bot.__main__:build_application", workers, Update.ALL_TYPES)
+    else:
+        main.build_application().run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+def _message(user_id: int, message_id: int) -> dict:
+    return {"message": {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": f"hello {message_id}",
+    }}
+
+
+async def _deliver(api: CountingBotAPI, updates: list, timeout: float) -> float:
+    """放入更新并等待全部转发，返回耗时 (秒)，超时返回 None。"""
+    target = api.delivered + len(updates)
+    started = time.perf_counter()
+    for update in updates:
+        api.push_update(update)
+    while api.delivered < target:
+        if time.perf_counter() - started > timeout:
+            return None
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - started
+
+
+async def run_once(workers: int, users: int, messages: int, api_latency: float, timeout: float) -> list:
+    api = CountingBotAPI(latency=api_latency)
+    url = await api.start()
+    ctx = multiprocessing.get_context("spawn")
+    bot = ctx.Process(target=_run_bot, args=(tempfile.mkdtemp(prefix="bench-shard-"), f"{url}/bot", workers))
+    bot.start()
+    try:
+        while api.polls == 0: # 等待机器人开始拉取更新
+            if not bot.is_alive():
+                raise RuntimeError(f"bot exited during start-up with code {bot.exitcode}")
+            await asyncio.sleep(0.05)
+        user_ids = [200000 + i for i in range(users)]
+        first = [_message(user_id, 1) for user_id in user_ids]
+        rng = random.Random(workers)
+        next_id = dict.fromkeys(user_ids, 2)
+        rest = []
+        for _ in range(messages):
+            user_id = rng.choice(user_ids)
+            rest.append(_message(user_id, next_id[user_id]))
+            next_id[user_id] += 1
+        new_users = await _deliver(api, first, timeout)
+        steady = await _deliver(api, rest, timeout)
+    finally:
+        stop_started = time.perf_counter()
+        os.kill(bot.pid, signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, bot.join, 60)
+        stop_seconds = time.perf_counter() - stop_started
+        if bot.is_alive():
+            bot.kill()
+        await api.stop()
+    rate = lambda count, seconds: f"{count / seconds:.1f}" if seconds else "timeout"
+    return [workers, rate(users, new_users), rate(messages, steady), f"{stop_seconds:.1f}s", bot.exitcode]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker 数，1 为单进程模式")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--api-latency", type=float, default=0.02, help="假 Bot API 每个请求的处理时间 (秒)")
+    parser.add_argument("--timeout", type=float, default=300, help="每个阶段的最长等待时间 (秒)")
+    args = parser.parse_args()
+
+    setup_environment()
+    rows = [asyncio.run(run_once(n, args.users, args.messages, args.api_latency, args.timeout)) for n in args.workers]
+    print(f"users={args.users} messages={args.messages} api_latency={args.api_latency}s")
+    print_table(["workers", "new users/s", "messages/s", "stop", "exit code"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""多租户模式 (TENANTS_FILE) 下每个租户的内存占用。
+
+机器人在子进程中按多租户方式启动 (所有租户共用一个事件循环和 HTTP 连接池)，连接本进程中的假 Bot API。
+对每种租户数记录：启动时间、空闲时的 RSS，以及每个租户各有 --users 个用户发过消息 (创建话题、写入状态和缓存) 后的 RSS。
+每租户内存按与最小租户数一行的 RSS 差值除以租户数之差计算；"N processes" 为每个机器人单独一个进程时的估计
+(第一行只有一个租户时的空闲 RSS 乘以租户数)。最后向机器人发送 SIGTERM 并检查其正常退出。
+
+    python bench/tenants.py --tenants 1 10 50 --users 20
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from common import print_table, setup_environment
+
+from fakebotapi import FakeBotAPI, request_token
+
+
+def tenant_entries(count: int) -> list:
+    return [
+        {
+            "name": f"tenant{i}",
+            "bot_token": f"{100000 + i}:TENANT{i}",
+            "admin_group_id": -1000000 - i,
+            "admin_user_ids": [1],
+        }
+        for i in range(count)
+    ]
+
+
+class TenantBotAPI(FakeBotAPI):
+    """按令牌统计 getUpdates 次数和转发到管理群组的消息数。"""
+
+    def __init__(self):
+        super().__init__(keep_calls=100)
+        self.polled = set()
+        self.delivered = 0
+
+    async def _api_getUpdates(self, params):
+        self.polled.add(request_token.get())
+        return await super()._api_getUpdates(params)
+
+    async def _api_copyMessage(self, params):
+        if int(params["chat_id"]) < 0:
+            self.delivered += 1
+        return await super()._api_copyMessage(params)
+
+
+def _run_bot(work_dir: str, base_url: str, tenants_file: str):
+    """子进程：与 python -m interactive-bot 在多租户模式下相同的启动方式。"""
+    setup_environment(work_dir)
+    os.environ["BOT_API_BASE_URL"] = base_url
+    os.environ["TENANTS_FILE"] = tenants_file
+    from telegram import Update
+
+    from common import package_module
+
+    main = package_module("__main__")
+    main.run_tenants(
+        main.build_application, main.load_tenants(tenants_file), Update.ALL_TYPES, main.build_request(), main.drain_application
+    )
+
+
+def rss_of(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _message(user_id: int, message_id: int) -> dict:
+    return {"message": {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        "text": f"hello {message_id}",
+    }}
+
+
+async def _wait_for(condition, bot, timeout: float, what: str):
+    started = time.perf_counter()
+    while not condition():
+        if not bot.is_alive():
+            raise RuntimeError(f"bot exited while waiting for {what} with code {bot.exitcode}")
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError(f"timed out waiting for {what}")
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def run_once(count: int, users: int, messages: int, timeout: float) -> list:
+    work_dir = tempfile.mkdtemp(prefix="bench-tenants-")
+    entries = tenant_entries(count)
+    tenants_file = os.path.join(work_dir, "tenants.json")
+    with open(tenants_file, "w") as f:
+        json.dump(entries, f)
+    api = TenantBotAPI()
+    url = await api.start()
+    ctx = multiprocessing.get_context("spawn")
+    bot = ctx.Process(target=_run_bot, args=(work_dir, f"{url}/bot", tenants_file))
+    bot.start()
+    try:
+        tokens = {entry["bot_token"] for entry in entries}
+        startup = await _wait_for(lambda: tokens <= api.polled, bot, timeout, "all tenants to poll")
+        await asyncio.sleep(2)
+        idle = rss_of(bot.pid)
+        target = count * users * messages
+        for entry in entries:
+            for user in range(users):
+                for message_id in range(1, messages + 1):
+                    api.push_update(_message(300000 + user, message_id), entry["bot_token"])
+        await _wait_for(lambda: api.delivered >= target, bot, timeout, "messages to be forwarded")
+        await asyncio.sleep(2)
+        loaded = rss_of(bot.pid)
+    finally:
+        stop_started = time.perf_counter()
+        os.kill(bot.pid, signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, bot.join, 60)
+        stop_seconds = time.perf_counter() - stop_started
+        if bot.is_alive():
+            bot.kill()
+        await api.stop()
+    return [count, startup, idle, loaded, stop_seconds, bot.exitcode]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tenants", type=int, nargs="+", default=[1, 10, 50], help="租户数")
+    parser.add_argument("--users", type=int, default=20, help="每个租户发消息的用户数")
+    parser.add_argument("--messages", type=int, default=5, help="每个用户的消息数")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    setup_environment()
+    results = [asyncio.run(run_once(n, args.users, args.messages, args.timeout)) for n in args.tenants]
+    base_count, _, base_idle, base_loaded, _, _ = results[0]
+    rows = []
+    for count, startup, idle, loaded, stop_seconds, exitcode in results:
+        extra = count - base_count
+        per_idle = (idle - base_idle) / extra if extra else "-"
+        per_loaded = (loaded - base_loaded) / extra if extra else "-"
+        separate = base_idle * count / base_count
+        rows.append([count, f"{startup:.1f}s", idle, loaded, separate, per_idle, per_loaded, f"{stop_seconds:.1f}s", exitcode])
+    print(f"users={args.users} messages={args.messages} per tenant")
+    print_table(
+        ["tenants", "startup", "idle RSS MB", "loaded RSS MB", "N processes MB", "MB/tenant idle", "MB/tenant loaded", "stop", "exit code"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""用户状态表 (UserStateStore) 在 100 万用户下的内存占用和速度 (USER_STATE_MAX)。
+
+在进程内依次让 --users 个不同的用户各访问一次 (每个用户的首条消息)，再按 --hot 个活跃用户重复访问，
+记录 RSS 增量、内存中保留的用户数、每秒 get() 次数，以及所有用户闲置超过 idle_ttl 后 sweep() 的耗时。
+验证结果读取用内存中的集合代替数据库，只测量状态表本身。上限很大的一行相当于不淘汰。
+
+    python bench/user_states.py --users 1000000 --limits 100000 1000000000
+"""
+import argparse
+import gc
+import time
+
+from common import package_module, print_table, rss_mb, setup_environment
+
+
+def run_once(limit: int, users: int, hot: int, rounds: int) -> list:
+    humans = set(range(0, users, 3)) # 三分之一的用户已通过验证
+    store = package_module("userstate").UserStateStore(humans.__contains__, lambda user: None, max_users=limit)
+    gc.collect()
+    rss_before = rss_mb()
+    now = 1_700_000_000.0
+    started = time.perf_counter()
+    for user_id in range(users):
+        store.get(user_id, now)
+    first_seen = users / (time.perf_counter() - started)
+    gc.collect()
+    rss = rss_mb() - rss_before
+
+    started = time.perf_counter()
+    for i in range(rounds):
+        store.get(users - 1 - i % hot, now)
+    hot_gets = rounds / (time.perf_counter() - started)
+
+    kept = len(store)
+    started = time.perf_counter()
+    evicted = store.sweep(now + store.idle_ttl + 1)
+    sweep_ms = (time.perf_counter() - started) * 1000
+    return [limit, kept, rss, rss * 2**20 / kept if kept else 0.0, first_seen, hot_gets, evicted, sweep_ms]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--limits", type=int, nargs="+", default=[100000, 1000000000], help="USER_STATE_MAX")
+    parser.add_argument("--hot", type=int, default=10000, help="活跃用户数")
+    parser.add_argument("--rounds", type=int, default=1000000, help="活跃用户的访问次数")
+    args = parser.parse_args()
+
+    setup_environment()
+    rows = [run_once(limit, args.users, args.hot, args.rounds) for limit in args.limits]
+    print(f"users={args.users} hot={args.hot} rounds={args.rounds}")
+    print_table(["max users", "kept", "RSS +MB", "bytes/user", "new gets/s", "hot gets/s", "swept", "sweep ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
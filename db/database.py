@@ -1,10 +1,75 @@
-from sqlalchemy import create_engine
+import contextvars
+
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./assets/db.sqlite3"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_size=100, max_overflow=200)
-SessionMaker = sessionmaker(bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+def _configure_sqlite(dbapi_connection, connection_record):
+    """WAL 模式下读写互不阻塞；分片模式下多个进程写同一个文件，写锁被占用时等待而不是立即报 database is locked。"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=10000")
+    cursor.close()
+
+
+def _create_engine(url: str, **kwargs):
+    sqlite_engine = create_engine(url, **kwargs)
+    event.listen(sqlite_engine, "connect", _configure_sqlite)
+    return sqlite_engine
+
+
+engine = _create_engine(SQLALCHEMY_DATABASE_URL, pool_size=100, max_overflow=200)
+
+Base = declarative_base()
+
+# 多租户模式下当前租户的数据库名，为空表示使用默认数据库
+current_database = contextvars.ContextVar("current_database", default=None)
+_tenant_engines = {}
+
+
+def ensure_columns(metadata, bind=None):
+    """为已存在的表补充模型中新增的列及其索引 (create_all 不会修改已存在的表)。"""
+    bind = bind or engine
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            added = [c for c in table.columns if c.name not in existing]
+            for column in added:
+                col_type = column.type.compile(bind.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}'))
+            for index in table.indexes:
+                if any(c.name in index.columns for c in added):
+                    index.create(conn, checkfirst=True)
+
+
+def get_engine():
+    """返回当前租户的数据库引擎，每个租户使用独立的 SQLite 文件，首次使用时建表。"""
+    name = current_database.get()
+    if name is None:
+        return engine
+    tenant_engine = _tenant_engines.get(name)
+    if tenant_engine is None:
+        tenant_engine = _create_engine(f"sqlite:///./assets/{name}.sqlite3", pool_size=5, max_overflow=20)
+        Base.metadata.create_all(bind=tenant_engine)
+        ensure_columns(Base.metadata, tenant_engine)
+        _tenant_engines[name] = tenant_engine
+    return tenant_engine
+
+
+class _TenantSessionMaker:
+    """与 sessionmaker 用法相同，按当前租户绑定到对应的数据库。"""
+
+    def __init__(self):
+        self._factory = sessionmaker()
+
+    def __call__(self, **kwargs):
+        return self._factory(bind=get_engine(), **kwargs)
+
+
+SessionMaker = _TenantSessionMaker()
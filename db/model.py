@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from sqlalchemy import Boolean, Column, Integer, String, DateTime
 from sqlalchemy.sql import func
 from .database import Base
@@ -27,6 +29,8 @@ class MessageMap(Base):
     user_chat_message_id = Column(Integer)
     group_chat_message_id = Column(Integer)
     user_id = Column(Integer)
+    direction = Column(String(8)) # u2a: 用户发给管理员，a2u: 管理员发给用户
+    created_at = Column(DateTime, default=datetime.now)
 
 
 class User(Base):
@@ -39,3 +43,79 @@ class User(Base):
     is_premium = Column(Boolean)
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     message_thread_id = Column(Integer, default=0)
+    last_active_at = Column(DateTime, index=True) # 对话最后活跃时间 (任一方发消息)
+    last_admin_reply_at = Column(DateTime) # 管理员最后回复时间，为空表示从未回复
+    photo_file_id = Column(String(256)) # 联系人卡片头像缓存，空字符串表示没有头像
+    photo_checked_at = Column(DateTime)
+    is_human = Column(Boolean, default=False) # 已通过人机验证
+
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox_message"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    message_id = Column(Integer)
+    reply_to_message_id = Column(Integer)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class QuarantineMessage(Base):
+    __tablename__ = "quarantine_message"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    message_id = Column(Integer)
+    content_hash = Column(String(64), index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class TopicPool(Base):
+    __tablename__ = "topic_pool"
+    id = Column(Integer, primary_key=True, index=True)
+    message_thread_id = Column(Integer, unique=True)
+    user_id = Column(Integer) # 已分配给该用户但尚未完成改名，为空表示空闲
+    acquired_at = Column(DateTime) # 分配时间
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class TopicStats(Base):
+    __tablename__ = "topic_stats"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, unique=True, index=True)
+    message_thread_id = Column(Integer)
+    user_messages = Column(Integer, default=0)
+    admin_messages = Column(Integer, default=0)
+    unanswered = Column(Integer, default=0) # 管理员上次回复后用户发来的消息数
+    awaiting_since = Column(DateTime, index=True) # 等待管理员回复的起始时间，为空表示已回复
+    first_response_seconds = Column(Integer) # 首次回复耗时
+    response_count = Column(Integer, default=0)
+    response_seconds = Column(Integer, default=0) # 回复耗时总和，除以 response_count 即平均值
+
+
+class AdminStats(Base):
+    __tablename__ = "admin_stats"
+    id = Column(Integer, primary_key=True, index=True)
+    admin_id = Column(Integer, unique=True, index=True)
+    name = Column(String(128))
+    replies = Column(Integer, default=0)
+    response_count = Column(Integer, default=0)
+    response_seconds = Column(Integer, default=0)
+    last_reply_at = Column(DateTime)
+
+
+class StatCounter(Base):
+    __tablename__ = "stat_counter"
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, default=0)
+
+
+class ScheduledJob(Base):
+    __tablename__ = "scheduled_job"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(128), index=True) # 同名任务可以被替换或取消
+    kind = Column(String(32))
+    chat_id = Column(Integer)
+    target_id = Column(Integer)
+    ref_id = Column(Integer) # 消息 ID、媒体组 ID 等
+    arg = Column(Integer) # 任务参数或进度 (如广播已发送到的用户)
+    due_at = Column(DateTime, index=True)
@@ -18,19 +18,74 @@ logger = logging.getLogger(current_package)
 
 # 读取配置文件
 load_dotenv()
-bot_token = os.getenv("BOT_TOKEN") or exit("BOT_TOKEN 未填写")
-app_name = os.getenv("APP_NAME") or exit("APP_NAME 未填写")
 welcome_message = os.getenv("WELCOME_MESSAGE") or "欢迎使用本机器人"
-try:
-    admin_group_id = int(os.getenv("ADMIN_GROUP_ID")) or exit("ADMIN_GROUP 未填写")
-    admin_user_ids = [
-        int(x.strip()) for x in os.getenv("ADMIN_USER_IDS").split(",")
-    ] or exit("ADMIN_USER_IDS 未填写")
-except ValueError:
-    exit("ADMIN_GROUP_ID or ADMIN_USER_IDS 应该是数字\n其中ADMIN_USER_IDS是以“,”分隔")
+# 多租户模式：一个进程运行多个机器人，各机器人的令牌、群组和管理员在 TENANTS_FILE 中配置
+tenants_file = os.getenv("TENANTS_FILE")
+if tenants_file:
+    bot_token = None
+    app_name = os.getenv("APP_NAME") or "tenants"
+    admin_group_id = 0
+    admin_user_ids = []
+else:
+    bot_token = os.getenv("BOT_TOKEN") or exit("BOT_TOKEN 未填写")
+    app_name = os.getenv("APP_NAME") or exit("APP_NAME 未填写")
+    try:
+        admin_group_id = int(os.getenv("ADMIN_GROUP_ID")) or exit("ADMIN_GROUP 未填写")
+        admin_user_ids = [
+            int(x.strip()) for x in os.getenv("ADMIN_USER_IDS").split(",")
+        ] or exit("ADMIN_USER_IDS 未填写")
+    except ValueError:
+        exit("ADMIN_GROUP_ID or ADMIN_USER_IDS 应该是数字\n其中ADMIN_USER_IDS是以“,”分隔")
 
 
 is_delete_topic_as_ban_forever = os.getenv("DELETE_TOPIC_AS_FOREVER_BAN") == "TRUE"
 is_delete_user_messages = os.getenv("DELETE_USER_MESSAGE_ON_CLEAR_CMD") == "TRUE"
 disable_captcha = os.getenv("DISABLE_CAPTCHA") == "TRUE"
 message_interval = int(os.getenv("MESSAGE_INTERVAL", 5))
+message_burst = int(os.getenv("MESSAGE_BURST", 3))
+global_message_rate = float(os.getenv("GLOBAL_MESSAGE_RATE", 0))
+shard_workers = int(os.getenv("SHARD_WORKERS", 0))
+outbox_workers = int(os.getenv("OUTBOX_WORKERS", 4))
+outbox_max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+
+# Bot API HTTP 连接配置
+http_pool_size = int(os.getenv("HTTP_POOL_SIZE", 256))
+get_updates_pool_size = int(os.getenv("GET_UPDATES_POOL_SIZE", 1))
+http_connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+http_read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", 5))
+http_write_timeout = float(os.getenv("HTTP_WRITE_TIMEOUT", 5))
+http_pool_timeout = float(os.getenv("HTTP_POOL_TIMEOUT", 5))
+http_keepalive_expiry = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+http2_enabled = os.getenv("HTTP2") == "TRUE"
+# Bot API 服务器地址 (自建的 Bot API 服务器或测试用的本地服务器)，末尾为 /bot，令牌直接拼接在后面
+bot_api_base_url = os.getenv("BOT_API_BASE_URL") or "https://api.telegram.org/bot"
+
+# 批量操作 (清理、批量管理) 的 API 调用速率(次/秒)与并发数
+bulk_api_rate = float(os.getenv("BULK_API_RATE", 20))
+bulk_concurrency = int(os.getenv("BULK_CONCURRENCY", 4))
+
+# 新用户涌入 (刷屏攻击) 检测：每分钟新用户数阈值 (0 为关闭)、重复内容阈值、解除攻击状态的平静期(秒)、攻击结束后每分钟放行的隔离用户数
+raid_new_users_per_minute = int(os.getenv("RAID_NEW_USERS_PER_MINUTE", 0))
+raid_duplicate_threshold = int(os.getenv("RAID_DUPLICATE_THRESHOLD", 3))
+raid_calm_seconds = int(os.getenv("RAID_CALM_SECONDS", 300))
+raid_release_per_minute = int(os.getenv("RAID_RELEASE_PER_MINUTE", 10))
+contact_photo_ttl_hours = int(os.getenv("CONTACT_PHOTO_TTL_HOURS", 24))
+topic_pool_max = int(os.getenv("TOPIC_POOL_MAX", 0))
+message_cache_size = int(os.getenv("MESSAGE_CACHE_SIZE", 200000))
+edit_sync_delay = float(os.getenv("EDIT_SYNC_DELAY", 2))
+auto_close_idle_days = int(os.getenv("AUTO_CLOSE_IDLE_DAYS", 0))
+user_state_max = int(os.getenv("USER_STATE_MAX", 100000))
+
+# 消息全文索引 (/search 命令)，以及索引内容的保留天数 (0 为永久保留)
+search_enabled = os.getenv("SEARCH_INDEX") == "TRUE"
+search_retention_days = int(os.getenv("SEARCH_RETENTION_DAYS", 0))
+
+# 事件循环阻塞超过多少秒时记录阻塞位置的调用栈，0 为关闭
+loop_lag_threshold = float(os.getenv("LOOP_LAG_THRESHOLD", 0.5))
+
+# 收到 SIGTERM 后排空进行中工作的最长时间 (秒)，应小于部署工具强制结束进程前的等待时间
+drain_timeout = float(os.getenv("DRAIN_TIMEOUT", 8))
+
+# 资源采样 (RSS、对象数量、任务数等) 的间隔 (分钟，0 为关闭)，以及相对第一次采样的 RSS 增长报警阈值 (MB)
+monitor_interval = float(os.getenv("MONITOR_INTERVAL", 0))
+monitor_rss_growth_mb = float(os.getenv("MONITOR_RSS_GROWTH_MB", 256))
@@ -1,5 +1,8 @@
+import html
 import os
 import random
+import signal
+import threading
 import time
 import asyncio
 from datetime import datetime, timedelta
@@ -7,6 +10,7 @@ from string import ascii_letters as letters
 
 import httpx
 import telegram
+from sqlalchemy import func
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 # 导入常量，用于过滤器
 from telegram.constants import ChatType, UpdateType
@@ -23,33 +27,112 @@ from telegram.ext import (
 )
 from telegram.helpers import mention_html
 
-from db.database import SessionMaker, engine
-from db.model import Base, FormnStatus, MediaGroupMesssage, MessageMap, User
+from db.database import SessionMaker, engine, ensure_columns
+from db.model import Base, FormnStatus, MediaGroupMesssage, MessageMap, OutboxMessage, TopicStats, AdminStats, User
 
 from . import (
-    admin_group_id,
-    admin_user_ids,
-    app_name,
-    bot_token,
     is_delete_topic_as_ban_forever,
     is_delete_user_messages,
     logger,
-    welcome_message,
     disable_captcha,
     message_interval,
+    message_burst,
+    global_message_rate,
+    shard_workers,
+    outbox_workers,
+    outbox_max_attempts,
+    raid_new_users_per_minute,
+    raid_duplicate_threshold,
+    raid_calm_seconds,
+    raid_release_per_minute,
+    contact_photo_ttl_hours,
+    topic_pool_max,
+    message_cache_size,
+    edit_sync_delay,
+    auto_close_idle_days,
+    user_state_max,
+    search_enabled,
+    search_retention_days,
+    tenants_file,
+    loop_lag_threshold,
+    drain_timeout,
+    bot_api_base_url,
+)
+from .antiflood import FloodGuard
+from .editsync import EditCoalescer, edit_digest, input_media_of
+from .bulk import apply_to_topics, call_limited, chunked, clear_user_messages
+from .network import build_request
+from .msgcache import MessageMapCache
+from .outbox import Outbox
+from .raid import Quarantine, RaidDetector, content_hash
+from .topicpool import POOL_TOPIC_NAME, TopicPool
+from .search import SearchIndex, snippet_html
+from .shard import run_sharded
+from .stats import end_waiting, format_duration, global_stats, record_admin_reply, record_user_message
+from .jobstore import JobDeferred, job_store
+from .drain import Drain
+from .tenant import TenantContext, TenantLocal, load_tenants, run_tenants, tenant
+from .userstate import UserStateStore
+from .captcha import (
+    EXPIRED,
+    INVALID,
+    NOT_YOURS,
+    OK,
+    CallbackDeduper,
+    captcha_key,
+    challenge_callback_data,
+    timestamp_ms,
+    verify_callback,
 )
 from .utils import delete_message_later
+from .watchdog import LoopWatchdog, profiler, summarize
+from .monitor import TimedApplication, monitor
 
-# 创建表
+# 创建表，并为旧数据库补充新增的列
 Base.metadata.create_all(bind=engine)
-db = SessionMaker()
+ensure_columns(Base.metadata)
+db = TenantLocal(SessionMaker) # 每个租户使用绑定到自己数据库的会话
+
+# 最近消息映射的内存索引
+msg_cache = TenantLocal(lambda: MessageMapCache(message_cache_size))
+
+# 可选的消息全文索引
+search_index = TenantLocal(lambda: SearchIndex(search_enabled, search_retention_days))
+
+# 编辑同步的合并窗口
+edit_coalescer = TenantLocal(EditCoalescer)
+
+# 预先创建的话题池
+topic_pool = TenantLocal(lambda: TopicPool(topic_pool_max))
 
+# 刷屏攻击检测与隔离区
+raid_detector = TenantLocal(lambda: RaidDetector(
+    raid_new_users_per_minute,
+    duplicate_threshold=raid_duplicate_threshold,
+    calm_seconds=raid_calm_seconds,
+))
+quarantine = TenantLocal(lambda: Quarantine(duplicate_threshold=raid_duplicate_threshold))
 
-# 延时发送媒体组消息的回调 (保持不变)
-async def _send_media_group_later(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    media_group_id = job.data
-    _, from_chat_id, target_id, dir = job.name.split("_")
+# 事件循环阻塞检测 (整个进程一个，多租户共用)
+watchdog = LoopWatchdog(loop_lag_threshold)
+
+# 停机排空状态 (收到 SIGTERM 后在 DRAIN_TIMEOUT 秒内完成或保存进行中的工作)
+drain = TenantLocal(lambda: Drain(drain_timeout))
+
+# 防刷屏限流：MESSAGE_INTERVAL 秒补充一次发送额度，最多累积 MESSAGE_BURST 条
+flood_guard = TenantLocal(lambda: FloodGuard(
+    rate=1 / message_interval if message_interval > 0 else 0,
+    burst=message_burst,
+    global_rate=global_message_rate,
+))
+
+
+# 延时发送媒体组消息的回调 (任务记录：chat_id 为来源，target_id 为目标，ref_id 为媒体组 ID)
+async def _send_media_group_later(context: ContextTypes.DEFAULT_TYPE, job):
+    media_group_id = job.ref_id
+    from_chat_id = job.chat_id
+    target_id = job.target_id
+    dir = job.kind.rsplit("_", 1)[1]
 
     media_group_msgs = (
         db.query(MediaGroupMesssage)
@@ -76,25 +159,19 @@ async def _send_media_group_later(context: ContextTypes.DEFAULT_TYPE):
                 message_thread_id=message_thread_id,
             )
             for sent, msg in zip(sents, media_group_msgs):
-                msg_map = MessageMap(
-                    user_chat_message_id=msg.message_id,
-                    group_chat_message_id=sent.message_id,
-                    user_id=u.user_id,
-                )
-                db.add(msg_map)
+                record_message_map(db, u.user_id, msg.message_id, sent.message_id, dir)
+                search_index.resolve(u.user_id, msg.message_id, sent.message_id)
             db.commit() # 提交数据库更改
         else: # a2u
             sents = await chat.send_copies(
                 from_chat_id, [m.message_id for m in media_group_msgs]
             )
             for sent, msg in zip(sents, media_group_msgs):
-                msg_map = MessageMap(
-                    user_chat_message_id=sent.message_id,
-                    group_chat_message_id=msg.message_id,
-                    user_id=target_id, # target_id 在 a2u 时就是 user_id
-                )
-                db.add(msg_map)
+                # target_id 在 a2u 时就是 user_id
+                record_message_map(db, int(target_id), sent.message_id, msg.message_id, dir)
             db.commit() # 提交数据库更改
+            if job.arg: # 发送媒体组的管理员
+                record_delivered_admin_reply(int(target_id), job.arg)
     except BadRequest as e:
         logger.error(f"Error sending media group {media_group_id} in job {job.name}: {e}")
         # 可以考虑在这里通知管理员或用户发送失败
@@ -102,6 +179,22 @@ async def _send_media_group_later(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Unexpected error in _send_media_group_later for job {job.name}: {e}", exc_info=True)
 
 
+def media_group_job_name(chat_id, target_id, dir) -> str:
+    return f"sendmediagroup_{chat_id}_{target_id}_{dir}"
+
+
+# 管理员的消息送达用户后才记为回复 (更新回复时间和统计)，发送失败的消息不算
+def record_delivered_admin_reply(user_id: int, admin_id: int, admin_name: str = None):
+    u = db.query(User).filter(User.user_id == user_id).first()
+    if not u:
+        return
+    now = datetime.now()
+    u.last_active_at = now
+    u.last_admin_reply_at = now
+    record_admin_reply(db, user_id, u.message_thread_id, admin_id, admin_name, now)
+    db.commit()
+
+
 # 延时发送媒体组消息 (保持不变)
 async def send_media_group_later(
     delay: float,
@@ -110,16 +203,13 @@ async def send_media_group_later(
     media_group_id: int,
     dir,
     context: ContextTypes.DEFAULT_TYPE,
+    admin_id: int = None,
 ):
-    name = f"sendmediagroup_{chat_id}_{target_id}_{dir}"
-    # 移除同名的旧任务，防止重复执行
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    for job in current_jobs:
-        job.schedule_removal()
-        logger.debug(f"Removed previous job with name {name}")
-    # 添加新任务
-    context.job_queue.run_once(
-        _send_media_group_later, delay, chat_id=chat_id, name=name, data=media_group_id
+    name = media_group_job_name(chat_id, target_id, dir)
+    # 替换同名的旧任务，防止重复执行
+    job_store.schedule(
+        context.job_queue, f"media_group_{dir}", delay, name,
+        chat_id=chat_id, target_id=target_id, ref_id=int(media_group_id), arg=admin_id, replace=True,
     )
     logger.debug(f"Scheduled media group {media_group_id} sending job: {name} in {delay}s")
     return name
@@ -139,59 +229,373 @@ def update_user_db(user: telegram.User):
     db.commit()
 
 
+# 记录一条消息映射 (写入数据库会话并放入内存索引)，由调用方提交
+def record_message_map(session, user_id: int, user_msg_id: int, group_msg_id: int, direction: str):
+    session.add(MessageMap(
+        user_chat_message_id=user_msg_id,
+        group_chat_message_id=group_msg_id,
+        user_id=user_id,
+        direction=direction,
+    ))
+    msg_cache.put(user_id, user_msg_id, group_msg_id)
+
+
+# 查找用户侧消息对应的群组消息 ID，先查内存索引，未命中再查数据库
+def lookup_group_msg_id(user_id: int, user_msg_id: int, session=None):
+    group_msg_id = msg_cache.group_msg_id(user_id, user_msg_id)
+    if group_msg_id is None:
+        msg_map = (session or db).query(MessageMap).filter(
+            MessageMap.user_id == user_id,
+            MessageMap.user_chat_message_id == user_msg_id,
+        ).first()
+        if msg_map and msg_map.group_chat_message_id:
+            group_msg_id = msg_map.group_chat_message_id
+            msg_cache.put(user_id, user_msg_id, group_msg_id)
+    return group_msg_id
+
+
+# 查找群组消息对应的 (用户 ID, 用户侧消息 ID)，先查内存索引，未命中再查数据库
+def lookup_user_msg(group_msg_id: int):
+    mapped = msg_cache.user_msg(group_msg_id)
+    if mapped is None:
+        msg_map = db.query(MessageMap).filter(MessageMap.group_chat_message_id == group_msg_id).first()
+        if msg_map and msg_map.user_chat_message_id:
+            mapped = (msg_map.user_id, msg_map.user_chat_message_id)
+            msg_cache.put(msg_map.user_id, msg_map.user_chat_message_id, group_msg_id)
+    return mapped
+
+
+# 批量更新话题状态，已有记录统一更新，缺失的补充创建，一次提交
+def set_topic_status(thread_ids: list, status: str):
+    for chunk in chunked(list(thread_ids)):
+        existing = {
+            tid for (tid,) in db.query(FormnStatus.message_thread_id).filter(FormnStatus.message_thread_id.in_(chunk))
+        }
+        if existing:
+            db.query(FormnStatus).filter(FormnStatus.message_thread_id.in_(existing)).update(
+                {FormnStatus.status: status}, synchronize_session=False
+            )
+        db.add_all(FormnStatus(message_thread_id=tid, status=status) for tid in chunk if tid not in existing)
+    db.commit()
+
+
+# 重新打开因长时间无活动被自动关闭的话题
+async def reopen_auto_closed_topic(context: ContextTypes.DEFAULT_TYPE, message_thread_id: int):
+    try:
+        await context.bot.reopen_forum_topic(tenant.admin_group_id, message_thread_id)
+        logger.info(f"Reopened auto-closed topic {message_thread_id}")
+    except BadRequest as e:
+        # 话题已被手动重新打开 (TOPIC_NOT_MODIFIED) 或已被删除，后者由转发流程处理
+        logger.debug(f"Failed to reopen auto-closed topic {message_thread_id}: {e}")
+    set_topic_status([message_thread_id], "opened")
+
+
+AUTO_CLOSE_BATCH_SIZE = 100
+
+
+# 定时关闭长时间无活动的话题，按批次限速调用 API，每批状态一次提交
+async def _auto_close_idle_topics(context: ContextTypes.DEFAULT_TYPE):
+    cutoff = datetime.now() - timedelta(days=auto_close_idle_days)
+    skipped = set() # 本轮关闭失败的话题，不再重复尝试
+    closed = 0
+    while True:
+        query = (
+            db.query(User.message_thread_id)
+            .join(FormnStatus, FormnStatus.message_thread_id == User.message_thread_id)
+            .filter(User.last_active_at < cutoff, FormnStatus.status == "opened")
+        )
+        if skipped:
+            query = query.filter(User.message_thread_id.notin_(skipped))
+        thread_ids = [tid for (tid,) in query.limit(AUTO_CLOSE_BATCH_SIZE)]
+        if not thread_ids:
+            break
+        done = await apply_to_topics(
+            context.bot.close_forum_topic, tenant.admin_group_id, thread_ids, ok_errors=("topic_not_modified",)
+        )
+        set_topic_status(done, "auto_closed")
+        skipped.update(set(thread_ids) - set(done))
+        closed += len(done)
+    if closed or skipped:
+        logger.info(f"Auto-closed {closed} idle topics ({len(skipped)} failed).")
+
+
+# 话题名称格式 (你修改后的版本)，限制长度 (Telegram API 限制 128 字符)
+def topic_name_for(full_name: str, user_id: int) -> str:
+    return f"{full_name}|{user_id}"[:128]
+
+
+# 为用户创建新话题并记录话题状态，返回 (话题 ID, 是否新建)。联系人卡片由调用方在用户的消息进入发件箱后安排 (schedule_contact_card)。
+# 隔离区放行任务 (0 号分片) 和用户所在的分片可能同时为同一用户创建话题：创建前重新读取绑定，
+# 绑定时用条件更新 (绑定仍是读取时的值才写入)，未抢到时撤销本次创建的话题，改用对方的话题
+async def create_topic(context: ContextTypes.DEFAULT_TYPE, u: User, full_name: str) -> tuple:
+    known_thread_id = u.message_thread_id
+    db.refresh(u)
+    if u.message_thread_id and u.message_thread_id != known_thread_id:
+        return u.message_thread_id, False
+    expected_thread_id = u.message_thread_id or 0
+
+    topic_name = topic_name_for(full_name, u.user_id)
+    message_thread_id = topic_pool.acquire(u.user_id) if topic_pool.enabled else None
+    from_pool = bool(message_thread_id)
+    if not from_pool:
+        forum_topic = await context.bot.create_forum_topic(
+            tenant.admin_group_id,
+            name=topic_name,
+        )
+        message_thread_id = forum_topic.message_thread_id
+    bound = db.query(User).filter(
+        User.user_id == u.user_id,
+        func.coalesce(User.message_thread_id, 0) == expected_thread_id,
+    ).update({User.message_thread_id: message_thread_id}, synchronize_session=False)
+    if not bound:
+        db.commit()
+        await _undo_topic(context, message_thread_id, from_pool)
+        db.refresh(u)
+        logger.info(f"Topic for user {u.user_id} was created by another process, using {u.message_thread_id}.")
+        return u.message_thread_id, False
+
+    topic_pool.record_arrival()
+    # 记录新话题状态
+    new_f_status = FormnStatus(message_thread_id=message_thread_id, status="opened")
+    db.add(new_f_status)
+    db.commit()
+    db.refresh(u)
+    if from_pool:
+        # 使用话题池中预先创建的话题，改名在后台完成
+        drain.track(context.application.create_task(_rename_pooled_topic(context, message_thread_id, topic_name)), "topic rename")
+    logger.info(f"Created new topic {message_thread_id} for user {u.user_id} ({full_name})")
+    return message_thread_id, True
+
+
+# 撤销未能绑定到用户的话题：话题池中的话题放回池中，新建的话题删除
+async def _undo_topic(context: ContextTypes.DEFAULT_TYPE, message_thread_id: int, from_pool: bool):
+    if from_pool:
+        topic_pool.put_back(message_thread_id)
+        return
+    try:
+        await context.bot.delete_forum_topic(tenant.admin_group_id, message_thread_id)
+    except Exception as e:
+        logger.warning(f"Failed to delete unbound topic {message_thread_id}: {e}")
+
+
+# 把话题池分配出去的话题改为用户的名字
+async def _rename_pooled_topic(context: ContextTypes.DEFAULT_TYPE, message_thread_id: int, topic_name: str):
+    try:
+        await call_limited(context.bot.edit_forum_topic, tenant.admin_group_id, message_thread_id, name=topic_name)
+        topic_pool.complete(message_thread_id)
+    except BadRequest as e:
+        if "topic_not_modified" in str(e).lower():
+            topic_pool.complete(message_thread_id)
+        else:
+            # 留在池中由维护任务重试
+            logger.warning(f"Failed to rename pooled topic {message_thread_id}: {e}")
+    except Exception as e:
+        logger.warning(f"Failed to rename pooled topic {message_thread_id}: {e}")
+
+
+# 回收分配后未绑定到用户的话题：从未使用过且仍然存在的放回池中，用过的 (绑定后被解除) 删除，不再分配
+async def _recycle_pooled_topic(context: ContextTypes.DEFAULT_TYPE, message_thread_id: int):
+    used = db.query(FormnStatus.id).filter(FormnStatus.message_thread_id == message_thread_id).first() or \
+        db.query(TopicStats.id).filter(TopicStats.message_thread_id == message_thread_id).first()
+    if not used:
+        try:
+            # 改回池中话题的名字，同时确认话题仍然存在
+            await call_limited(context.bot.edit_forum_topic, tenant.admin_group_id, message_thread_id, name=POOL_TOPIC_NAME)
+        except BadRequest as e:
+            if "topic_not_modified" not in str(e).lower():
+                topic_pool.discard(message_thread_id)
+                logger.info(f"Dropped pooled topic {message_thread_id} which no longer exists: {e}")
+                return
+        topic_pool.put_back(message_thread_id)
+        logger.info(f"Returned unbound topic {message_thread_id} to the pool.")
+        return
+    try:
+        await call_limited(context.bot.delete_forum_topic, tenant.admin_group_id, message_thread_id)
+    except BadRequest as e:
+        error_text = str(e).lower()
+        if "message thread not found" not in error_text and "topic_id_invalid" not in error_text:
+            raise
+    topic_pool.discard(message_thread_id)
+    logger.info(f"Deleted used topic {message_thread_id} no longer bound to a user.")
+
+
+# 定期维护话题池 (只在 0 号分片运行)：补齐未完成的改名、回收未绑定成功的话题、按到达速率补充空闲话题
+async def _maintain_topic_pool(context: ContextTypes.DEFAULT_TYPE):
+    for message_thread_id, user_id in topic_pool.pending():
+        u = db.query(User).filter(User.user_id == user_id).first()
+        if u and u.message_thread_id == message_thread_id:
+            full_name = " ".join(filter(None, [u.first_name, u.last_name])) or str(user_id)
+            await _rename_pooled_topic(context, message_thread_id, topic_name_for(full_name, user_id))
+            continue
+        # 未绑定到用户 (绑定前进程崩溃，或绑定后被 /clear 解除)
+        try:
+            await _recycle_pooled_topic(context, message_thread_id)
+        except Exception as e:
+            # 网络错误等：保留分配记录，下次维护时重试
+            logger.warning(f"Failed to recycle pooled topic {message_thread_id}: {e}")
+
+    missing = topic_pool.target_size() - topic_pool.free_count()
+    for _ in range(max(0, missing)):
+        try:
+            forum_topic = await call_limited(context.bot.create_forum_topic, tenant.admin_group_id, name=POOL_TOPIC_NAME)
+        except Exception as e:
+            logger.warning(f"Failed to pre-create pooled topic: {e}")
+            break
+        topic_pool.add(forum_topic.message_thread_id)
+    if missing > 0:
+        logger.debug(f"Topic pool refilled with {missing} topics.")
+
+
+# 攻击平息后按速率放行隔离区中的用户：创建话题并转发其被隔离的消息
+async def _release_quarantine(context: ContextTypes.DEFAULT_TYPE):
+    purged = quarantine.purge()
+    if purged:
+        logger.info(f"Dropped {purged} expired quarantined messages.")
+    # 只在 0 号分片运行：隔离的用户可能来自任一分片，直接查询数据库，不依赖本进程的 quarantine.users
+    if raid_detector.under_attack():
+        return
+    for user_id in quarantine.candidates(raid_release_per_minute):
+        u = db.query(User).filter(User.user_id == user_id).first()
+        if not u:
+            quarantine.pop(user_id)
+            continue
+        new_topic = False
+        full_name = " ".join(filter(None, [u.first_name, u.last_name])) or str(user_id)
+        try:
+            if not u.message_thread_id:
+                _, new_topic = await create_topic(context, u, full_name)
+        except Exception as e:
+            logger.error(f"Failed to create topic for quarantined user {user_id}: {e}", exc_info=True)
+            continue
+        message_ids = quarantine.pop(user_id)
+        for message_id in message_ids:
+            outbox.enqueue(user_id, message_id)
+        if new_topic:
+            schedule_contact_card(context, user_id, u.message_thread_id, full_name)
+        logger.info(f"Released {len(message_ids)} quarantined messages of user {user_id}.")
+
+
+# 等待发送联系人卡片的用户 -> (话题 ID, 显示名)，同一用户多次重开话题时只发送到最新的话题
+pending_cards = TenantLocal(dict)
+card_tasks = TenantLocal(dict)
+
+
+# 安排在后台发送联系人卡片 (同一用户的请求会合并)。应在用户的首条消息进入发件箱或媒体组任务之后调用
+def schedule_contact_card(context: ContextTypes.DEFAULT_TYPE, user_id: int, message_thread_id: int, full_name: str):
+    pending_cards[user_id] = (message_thread_id, full_name)
+    task = card_tasks.get(user_id)
+    if task is None or task.done():
+        card_tasks[user_id] = drain.track(
+            context.application.create_task(_contact_card_worker(context, user_id)), "contact card"
+        )
+
+
+async def _contact_card_worker(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    try:
+        # 先让用户的消息转发出去 (单条消息经发件箱，媒体组经延时任务)，再发送卡片
+        await outbox.wait_idle(user_id)
+        await _wait_media_group_sent(user_id)
+        while user_id in pending_cards:
+            message_thread_id, full_name = pending_cards.pop(user_id)
+            await send_contact_card(tenant.admin_group_id, message_thread_id, user_id, full_name, context)
+    finally:
+        card_tasks.pop(user_id, None)
+
+
+# 等待用户待发送的媒体组转发完成 (或超时)
+async def _wait_media_group_sent(user_id: int, timeout: float = 10):
+    name = media_group_job_name(user_id, tenant.admin_group_id, "u2a")
+    deadline = time.monotonic() + timeout
+    while job_store.exists(name) and time.monotonic() < deadline:
+        await asyncio.sleep(0.2)
+
+
+# 获取用户头像 file_id，优先使用数据库中未过期的缓存；没有头像时返回 None
+async def get_profile_photo(context: ContextTypes.DEFAULT_TYPE, user_id: int, refresh: bool = False):
+    u = db.query(User).filter(User.user_id == user_id).first()
+    now = datetime.now()
+    if u and not refresh and u.photo_checked_at and now - u.photo_checked_at < timedelta(hours=contact_photo_ttl_hours):
+        return u.photo_file_id or None
+    user_photo = await context.bot.get_user_profile_photos(user_id, limit=1)
+    file_id = ""
+    if user_photo.total_count > 0:
+        sizes = user_photo.photos[0]
+        file_id = sizes[min(1, len(sizes) - 1)].file_id # 使用中等尺寸，卡片无需原图
+    if u:
+        u.photo_file_id = file_id
+        u.photo_checked_at = now
+        db.commit()
+    return file_id or None
+
+
 # 发送联系人卡片 (修正版)
 async def send_contact_card(
-    chat_id, message_thread_id, user: User, update: Update, context: ContextTypes
+    chat_id, message_thread_id, user_id: int, full_name: str, context: ContextTypes.DEFAULT_TYPE
 ):
+    u = db.query(User).filter(User.user_id == user_id).first()
+    username = u.username if u else None
+    card = (
+        f"🆕 新的用户 {mention_html(user_id, full_name)} ({user_id}) 发起了新的对话。\n\n"
+        f"👤 {mention_html(user_id, full_name or str(user_id))}\n\n📱 {user_id}\n\n"
+        f"🔗 直接联系：{f'@{username}' if username else f'tg://user?id={user_id}'}"
+    )
     try:
-        # === 修改 1: 使用 user.user_id 获取头像 ===
-        user_photo = await context.bot.get_user_profile_photos(user.user_id, limit=1)
-
-        if user_photo.total_count > 0:
-            pic = user_photo.photos[0][-1].file_id
-            await context.bot.send_photo(
-                chat_id,
-                photo=pic,
-                # === 修改 2 & 3: 使用 user.user_id 生成文本 ===
-                caption=f"👤 {mention_html(user.user_id, user.first_name or str(user.user_id))}\n\n📱 {user.user_id}\n\n🔗 直接联系：{f'@{user.username}' if user.username else f'tg://user?id={user.user_id}'}",
-                message_thread_id=message_thread_id,
-                parse_mode="HTML",
-            )
-        else:
-            # 如果没有头像，可以只发送文本信息或者使用 send_message
-            await context.bot.send_message(
-                chat_id,
-                # === 修改 4 & 5: 使用 user.user_id 生成文本 ===
-                text=f"👤 {mention_html(user.user_id, user.first_name or str(user.user_id))}\n\n📱 {user.user_id}\n\n🔗 直接联系：{f'@{user.username}' if user.username else f'tg://user?id={user.user_id}'}",
-                message_thread_id=message_thread_id,
-                parse_mode="HTML",
-            )
+        pic = await get_profile_photo(context, user_id)
+        if pic:
+            try:
+                await context.bot.send_photo(
+                    chat_id,
+                    photo=pic,
+                    caption=card,
+                    message_thread_id=message_thread_id,
+                    parse_mode="HTML",
+                )
+                return
+            except BadRequest as e:
+                # 缓存的 file_id 可能已失效，刷新后重试一次
+                logger.debug(f"Cached profile photo of user {user_id} failed, refreshing: {e}")
+                pic = await get_profile_photo(context, user_id, refresh=True)
+                if pic:
+                    await context.bot.send_photo(
+                        chat_id,
+                        photo=pic,
+                        caption=card,
+                        message_thread_id=message_thread_id,
+                        parse_mode="HTML",
+                    )
+                    return
+        # 如果没有头像，只发送文本信息
+        await context.bot.send_message(
+            chat_id,
+            text=card,
+            message_thread_id=message_thread_id,
+            parse_mode="HTML",
+        )
     except Exception as e:
-         # === 修改 6: 日志中使用 user.user_id ===
-         logger.error(f"Failed to send contact card for user {user.user_id} to chat {chat_id}: {e}")
+         logger.error(f"Failed to send contact card for user {user_id} to chat {chat_id}: {e}")
 
 # start 命令处理 (你修改后的版本)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     update_user_db(user)
-    if user.id in admin_user_ids:
+    if user.id in tenant.admin_user_ids:
         logger.info(f"{user.first_name}({user.id}) is admin")
         try:
-            bg = await context.bot.get_chat(admin_group_id)
+            bg = await context.bot.get_chat(tenant.admin_group_id)
             if bg.type == "supergroup" and bg.is_forum: # 确保是开启了话题的超级群组
                 logger.info(f"Admin group is {bg.title}")
                 await update.message.reply_html(
-                    f"你好管理员 {mention_html(user.id, user.full_name)} ({user.id})\n\n欢迎使用 {app_name} 机器人。\n\n目前你的配置正确，机器人已在群组 <b>{bg.title}</b> 中。请确保机器人拥有在话题中发送消息的权限。"
+                    f"你好管理员 {mention_html(user.id, user.full_name)} ({user.id})\n\n欢迎使用 {tenant.app_name} 机器人。\n\n目前你的配置正确，机器人已在群组 <b>{bg.title}</b> 中。请确保机器人拥有在话题中发送消息的权限。"
                 )
             else:
-                 logger.warning(f"Admin group {admin_group_id} is not a supergroup with topics enabled.")
+                 logger.warning(f"Admin group {tenant.admin_group_id} is not a supergroup with topics enabled.")
                  await update.message.reply_html(
-                    f"⚠️⚠️后台管理群组设置错误⚠️⚠️\n管理员 {mention_html(user.id, user.full_name)}，群组 ID (`{admin_group_id}`) 对应的必须是一个已启用“话题(Topics)”功能的超级群组。请检查群组设置和配置中的 `admin_group_id`。"
+                    f"⚠️⚠️后台管理群组设置错误⚠️⚠️\n管理员 {mention_html(user.id, user.full_name)}，群组 ID (`{tenant.admin_group_id}`) 对应的必须是一个已启用“话题(Topics)”功能的超级群组。请检查群组设置和配置中的 `admin_group_id`。"
                 )
         except BadRequest as e:
             logger.error(f"Admin group error (BadRequest): {e}")
             await update.message.reply_html(
-                 f"⚠️⚠️无法访问后台管理群组⚠️⚠️\n管理员 {mention_html(user.id, user.full_name)}，无法获取群组信息。请确保机器人已被邀请加入群组 (`{admin_group_id}`) 并且具有必要权限（至少需要发送消息权限）。\n错误细节：{e}"
+                 f"⚠️⚠️无法访问后台管理群组⚠️⚠️\n管理员 {mention_html(user.id, user.full_name)}，无法获取群组信息。请确保机器人已被邀请加入群组 (`{tenant.admin_group_id}`) 并且具有必要权限（至少需要发送消息权限）。\n错误细节：{e}"
             )
         except Exception as e:
             logger.error(f"Admin group check error: {e}", exc_info=True)
@@ -202,22 +606,96 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # 非管理员用户的欢迎消息
         await update.message.reply_html(
-            f"{mention_html(user.id, user.full_name)}：\n\n{welcome_message}"
+            f"{mention_html(user.id, user.full_name)}：\n\n{tenant.welcome_message}"
         )
 
 
+CAPTCHA_TTL = 60 # 验证码有效期 (秒)
+CAPTCHA_ERROR_MUTE = 120 # 验证码错误后的禁言时间 (秒)
+
+
+# 读取/保存用户的验证结果，供 user_states 使用
+def _load_is_human(user_id: int) -> bool:
+    return bool(db.query(User.is_human).filter(User.user_id == user_id).scalar())
+
+
+def _save_is_human(user: telegram.User):
+    # 用户记录不存在时直接以已验证状态插入，每次验证只提交一次
+    updated = db.query(User).filter(User.user_id == user.id).update({User.is_human: True}, synchronize_session=False)
+    if not updated:
+        db.add(User(
+            user_id=user.id,
+            first_name=user.first_name or "未知",
+            last_name=user.last_name,
+            username=user.username,
+            is_human=True,
+        ))
+    db.commit()
+
+
+# 每个用户的验证结果、禁言、回执等运行时状态，冷用户定期淘汰
+user_states = TenantLocal(lambda: UserStateStore(_load_is_human, _save_is_human, max_users=user_state_max))
+
+# 验证码消息的重复点击过滤
+captcha_taps = TenantLocal(lambda: CallbackDeduper(CAPTCHA_TTL))
+
+
+async def _sweep_user_states(context: ContextTypes.DEFAULT_TYPE):
+    evicted = user_states.sweep()
+    dropped = drop_empty_data(context.application)
+    logger.debug(
+        f"User state sweep evicted {evicted} users, {len(user_states)} remaining; "
+        f"dropped {dropped} empty user_data/chat_data entries."
+    )
+
+
+# PTB 处理每个更新时都会为用户和聊天创建空的 user_data/chat_data 并写入持久化文件，
+# 本机器人已不使用它们，定期清除，避免内存和持久化文件随用户数一直增长
+def drop_empty_data(application) -> int:
+    empty_users = [user_id for user_id, data in application.user_data.items() if not data]
+    for user_id in empty_users:
+        application.drop_user_data(user_id)
+    empty_chats = [chat_id for chat_id, data in application.chat_data.items() if not data]
+    for chat_id in empty_chats:
+        application.drop_chat_data(chat_id)
+    return len(empty_users) + len(empty_chats)
+
+
+# 资源采样中的额外指标 (多租户模式下汇总所有租户)
+def _resource_gauges() -> dict:
+    return {
+        "db identity map": sum(len(session.identity_map) for session in db.instances()),
+        "message cache": sum(len(cache) for cache in msg_cache.instances()),
+        "user states": sum(len(states) for states in user_states.instances()),
+    }
+
+
+# 把旧版本保存在 user_data 中的验证结果迁移到数据库，并清除这些 user_data
+def migrate_user_data(application):
+    migrated = 0
+    for user_id, data in list(application.user_data.items()):
+        if data.get("is_human"):
+            db.query(User).filter(User.user_id == user_id).update({User.is_human: True}, synchronize_session=False)
+            migrated += 1
+        application.drop_user_data(user_id)
+    if migrated:
+        db.commit()
+        logger.info(f"Migrated captcha state of {migrated} users from user_data to the database.")
+
+
 # 人机验证 (保持不变，但注意路径)
 async def check_human(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
+    state = user_states.get(user.id)
     # 注意: ./assets/imgs 路径相对于脚本执行的当前工作目录
     img_dir = "./assets/imgs"
     if not os.path.isdir(img_dir) or not os.listdir(img_dir):
         logger.warning(f"Captcha image directory '{img_dir}' not found or empty. Skipping check_human.")
-        context.user_data["is_human"] = True # 无法验证，暂时跳过
+        state.is_human = True # 无法验证，暂时跳过 (不写入数据库)
         return True
 
-    if not context.user_data.get("is_human", False): # 检查是否已经验证通过
-        if context.user_data.get("is_human_error_time", 0) > time.time() - 120:
+    if not state.is_human: # 检查是否已经验证通过
+        if state.is_muted():
             # 2分钟内禁言
             sent_msg = await update.message.reply_html("你因验证码错误已被临时禁言，请 2 分钟后再试。\nYou have been temporarily muted due to captcha error, please try again in 2 minutes.")
             await delete_message_later(10, sent_msg.chat.id, sent_msg.message_id, context) # 10秒后删除提示
@@ -238,9 +716,13 @@ async def check_human(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # 尝试从 bot_data 获取缓存的文件 ID
             photo_file_id = context.bot_data.get(f"image|{code}")
 
-            # 准备按钮
+            # 准备按钮 (回调数据中带有由正确答案计算的签名和发出时间，服务端不保存验证码)。
+            # 只有最新发出的验证码有效，避免用户同时领取多个验证码逐个猜测
+            issued_at = timestamp_ms()
+            callback_data = challenge_callback_data(captcha_key(tenant.bot_token), user.id, code, codes, issued_at)
+            state.issue_captcha(issued_at)
             buttons = [
-                InlineKeyboardButton(x, callback_data=f"vcode_{x}_{user.id}") for x in codes
+                InlineKeyboardButton(x, callback_data=data) for x, data in zip(codes, callback_data)
             ]
             # 每行最多4个按钮
             button_matrix = [buttons[i : i + 4] for i in range(0, len(buttons), 4)]
@@ -268,11 +750,8 @@ async def check_human(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context.bot_data[f"image|{code}"] = biggest_photo.file_id
                 logger.debug(f"Cached captcha image file_id for code {code}")
 
-            # 存储正确的验证码以便后续检查
-            context.user_data["vcode"] = code
-            context.user_data["vcode_message_id"] = sent.message_id # 存储验证码消息ID
             # 60秒后删除验证码图片消息
-            await delete_message_later(60, sent.chat.id, sent.message_id, context)
+            await delete_message_later(CAPTCHA_TTL, sent.chat.id, sent.message_id, context)
             # 5秒后删除用户的原始触发消息 (可选)
             await delete_message_later(5, update.message.chat.id, update.message.message_id, context)
 
@@ -280,60 +759,63 @@ async def check_human(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except FileNotFoundError:
              logger.error(f"Captcha image file not found: {file_path}")
              await update.message.reply_html("抱歉，验证码图片丢失，请稍后再试或联系对方。\nSorry, the captcha image is missing, please try again later or contact him.")
-             context.user_data["is_human"] = True # 暂时跳过
+             state.is_human = True # 暂时跳过
              return True
         except IndexError:
             logger.error(f"Captcha image directory '{img_dir}' seems empty.")
             await update.message.reply_html("抱歉，无法加载验证码，请稍后再试或联系对方。\nSorry, unable to load captcha, please try again later or contact him.")
-            context.user_data["is_human"] = True # 暂时跳过
+            state.is_human = True # 暂时跳过
             return True
         except Exception as e:
              logger.error(f"Error during check_human: {e}", exc_info=True)
              await update.message.reply_html("抱歉，验证过程中发生错误，请稍后再试。\nSorry, an error occurred during verification, please try again later.")
-             context.user_data["is_human"] = True # 暂时跳过
+             state.is_human = True # 暂时跳过
              return True
 
     return True # 已验证
 
 
-# 处理验证码回调 (改进)
+# 处理验证码回调：回调数据自带签名和发出时间，只需对照内存中的禁言状态和最新验证码的发出时间
 async def callback_query_vcode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = query.from_user
-    try:
-        _, code_clicked, target_user_id_str = query.data.split("_")
-    except ValueError:
+    state = user_states.get(user.id)
+    result = verify_callback(
+        captcha_key(tenant.bot_token), query.data, user.id, CAPTCHA_TTL, state.captcha_not_before
+    )
+
+    if result == INVALID:
         logger.warning(f"Invalid vcode callback data format: {query.data}")
         await query.answer("无效操作。\nInvalid operation.", show_alert=True)
         return
-
-    if target_user_id_str != str(user.id):
+    if result == NOT_YOURS:
         # 不是发给这个用户的验证码
         await query.answer("这不是给你的验证码哦。\nThis captcha is not for you.", show_alert=True)
         return
 
-    # 从 user_data 获取正确的验证码和消息 ID
-    correct_code = context.user_data.get("vcode")
-    vcode_message_id = context.user_data.get("vcode_message_id")
+    # 重复点击同一条验证码消息 (上一次点击正在处理或已处理)：直接忽略，不再 answer 或删除消息
+    tap_key = (query.message.chat.id, query.message.message_id) if query.message else query.data
+    if not captcha_taps.first(tap_key):
+        return
 
-    # 检查验证码是否存在或已过期 (被删除)
-    if not correct_code or not vcode_message_id:
+    if result == EXPIRED or state.is_human:
         await query.answer("验证已过期或已完成。\nVerification has expired or been completed.", show_alert=True)
-        # 尝试删除可能残留的旧验证码消息
-        if query.message and query.message.message_id == vcode_message_id:
-             try:
-                 await query.message.delete()
-             except BadRequest:
-                 pass # 消息可能已被删除
+        # 尝试删除残留的旧验证码消息
+        try:
+            await query.message.delete()
+        except BadRequest:
+            pass # 消息可能已被删除
         return
-
-    # 防止重复点击或处理旧消息
-    if query.message and query.message.message_id != vcode_message_id:
-        await query.answer("此验证码已失效。\nThis captcha is no longer valid.", show_alert=True)
+    if state.is_muted():
+        # 答错后的禁言期间不接受任何回答 (包括其他仍未过期的验证码)
+        await query.answer("你因验证码错误已被临时禁言，请 2 分钟后再试。\nYou have been temporarily muted due to captcha error, please try again in 2 minutes.", show_alert=True)
+        try:
+            await query.message.delete()
+        except BadRequest:
+            pass # 消息可能已被删除
         return
 
-
-    if code_clicked == correct_code:
+    if result == OK:
         # 点击正确
         await query.answer("✅ 验证成功！\n✅ Verification successful!", show_alert=False)
         # 发送欢迎消息
@@ -342,11 +824,8 @@ async def callback_query_vcode(update: Update, context: ContextTypes.DEFAULT_TYP
             f"🎉 {mention_html(user.id, user.first_name or str(user.id))}，验证通过，现在可以开始对话了！\n🎉 {mention_html(user.id, user.first_name or str(user.id))}, verification passed, you can now start chatting!",
             parse_mode="HTML",
         )
-        context.user_data["is_human"] = True
-        # 清理 user_data 中的验证码信息
-        context.user_data.pop("vcode", None)
-        context.user_data.pop("vcode_message_id", None)
-        context.user_data.pop("is_human_error_time", None) # 清除错误时间
+        # 记录验证结果 (写入数据库)，同时清除错误禁言
+        user_states.mark_human(user)
         # 删除验证码消息
         try:
             await query.message.delete()
@@ -355,11 +834,8 @@ async def callback_query_vcode(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         # 点击错误
         await query.answer("❌ 验证码错误！请等待 2 分钟后再试。\n❌ Captcha error! Please wait 2 minutes before trying again.", show_alert=True)
-        context.user_data["is_human_error_time"] = time.time() # 记录错误时间
-        # 清理验证码信息，强制用户下次重新获取
-        context.user_data.pop("vcode", None)
-        context.user_data.pop("vcode_message_id", None)
-        # 删除验证码消息
+        state.fail_captcha(CAPTCHA_ERROR_MUTE) # 记录错误禁言，并使之前发出的验证码全部失效
+        # 删除验证码消息，强制用户下次重新获取
         try:
             await query.message.delete()
         except BadRequest:
@@ -370,25 +846,20 @@ async def forwarding_message_u2a(update: Update, context: ContextTypes.DEFAULT_T
     user = update.effective_user
     message = update.message # 确保使用 update.message
 
-    # 1. 人机验证 (如果启用)
+    # 1. 消息频率限制 (内存令牌桶，先于人机验证，避免刷屏触发更多验证码消息)
+    allowed, wait_seconds = flood_guard.check(user.id)
+    if not allowed:
+        # 同一次禁言期间只提示一次，其余消息静默丢弃，不再产生额外的出站请求
+        if wait_seconds:
+            reply_msg = await message.reply_html(f"发送消息过于频繁，请等待 {wait_seconds} 秒后再试。\nSending messages too frequently, please wait {wait_seconds} seconds before trying again.")
+            await delete_message_later(min(wait_seconds, 60), reply_msg.chat_id, reply_msg.message_id, context)
+        return # 中止处理
+
+    # 2. 人机验证 (如果启用)
     if not disable_captcha:
         if not await check_human(update, context):
             return # 未通过验证则中止
 
-    # 2. 消息频率限制 (如果启用)
-    if message_interval > 0: # 仅在设置了间隔时检查
-        current_time = time.time()
-        last_message_time = context.user_data.get("last_message_time", 0)
-        if current_time < last_message_time + message_interval:
-            time_left = round(last_message_time + message_interval - current_time)
-            # 只在剩余时间大于 0 时提示
-            if time_left > 0:
-                reply_msg = await message.reply_html(f"发送消息过于频繁，请等待 {time_left} 秒后再试。\nSending messages too frequently, please wait {time_left} seconds before trying again.")
-                await delete_message_later(5, reply_msg.chat_id, reply_msg.message_id, context)
-                await delete_message_later(3, message.chat.id, message.message_id, context) # 删除用户过快的消息
-            return # 中止处理
-        context.user_data["last_message_time"] = current_time # 更新最后发送时间
-
     # 3. 更新用户信息
     update_user_db(user)
 
@@ -398,49 +869,42 @@ async def forwarding_message_u2a(update: Update, context: ContextTypes.DEFAULT_T
         logger.error(f"User {user.id} not found in DB after update_user_db call.")
         await message.reply_html("发生内部错误，无法处理您的消息。\nAn internal error occurred and your message cannot be processed.")
         return
+    u.last_active_at = datetime.now()
+    db.commit()
     message_thread_id = u.message_thread_id
     # 5. 检查话题状态
     topic_status = "opened" # 默认状态
     if message_thread_id:
         f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).first()
-        if f_status and f_status.status == "closed":
+        if f_status and f_status.status == "auto_closed":
+            await reopen_auto_closed_topic(context, message_thread_id)
+        elif f_status and f_status.status == "closed":
             topic_status = "closed"
             await message.reply_html("对话已被对方关闭。您的消息暂时无法送达。如需继续，请等待或请求对方重新打开对话。\nThe conversation has been closed by him. Your message cannot be delivered temporarily. If you need to continue, please wait or ask him to reopen the conversation.")
             return # 如果话题关闭，则不转发
 
     # 6. 如果没有话题ID，创建新话题
+    new_topic = False
     if not message_thread_id or topic_status == "closed": # 如果话题被非永久删除关闭，也视为需要重开（根据逻辑决定）
         # 如果 !is_delete_topic_as_ban_forever 且 topic_status == "closed"，理论上不应到这里，但作为保险
         if topic_status == "closed" and is_delete_topic_as_ban_forever:
             return # 确认不再处理
 
-        try:
-            # 使用你修改后的话题名称格式
-            topic_name = f"{user.full_name}|{user.id}"
-            # 限制话题名称长度 (Telegram API 限制 128 字符)
-            topic_name = topic_name[:128]
-            forum_topic = await context.bot.create_forum_topic(
-                admin_group_id,
-                name=topic_name,
-            )
-            message_thread_id = forum_topic.message_thread_id
-            u.message_thread_id = message_thread_id
-            db.add(u)
-            # 记录新话题状态
-            new_f_status = FormnStatus(message_thread_id=message_thread_id, status="opened")
-            db.add(new_f_status)
-            db.commit()
-            logger.info(f"Created new topic {message_thread_id} for user {user.id} ({user.full_name})")
-
-            # 发送欢迎和联系人卡片到新话题
-            await context.bot.send_message(
-                admin_group_id,
-                f"🆕 新的用户 {mention_html(user.id, user.full_name)} ({user.id}) 发起了新的对话。",
-                message_thread_id=message_thread_id,
-                parse_mode="HTML",
-            )
-            await send_contact_card(admin_group_id, message_thread_id, u, update, context)
+        # 刷屏攻击期间：新用户的消息先进入隔离区，暂不创建话题 (避免刷爆管理群组)
+        release_quarantined = False
+        if raid_detector.enabled:
+            if user.id in quarantine.users:
+                if raid_detector.under_attack() or quarantine.is_spam_only(user.id):
+                    quarantine.add(user.id, message.message_id, content_hash(message))
+                    return
+                release_quarantined = True # 攻击已平息，随本条消息一起放行
+            elif raid_detector.should_quarantine(user.id, content_hash(message)):
+                logger.info(f"Raid detected, quarantined first message of user {user.id}")
+                quarantine.add(user.id, message.message_id, content_hash(message))
+                return
 
+        try:
+            message_thread_id, new_topic = await create_topic(context, u, user.full_name)
         except BadRequest as e:
              logger.error(f"Failed to create topic for user {user.id}: {e}")
              await message.reply_html(f"创建会话失败，请稍后再试或联系对方。\nFailed to create session, please try again later or contact him.\nError: {e}")
@@ -449,32 +913,42 @@ async def forwarding_message_u2a(update: Update, context: ContextTypes.DEFAULT_T
              logger.error(f"Unexpected error creating topic for user {user.id}: {e}", exc_info=True)
              await message.reply_html("创建会话时发生未知错误。\nAn unknown error occurred while creating the session.")
              return
+        # 被隔离过的消息在话题创建后才取出 (创建失败时仍留在隔离区)，按原顺序先于本条消息投递
+        if release_quarantined:
+            for message_id in quarantine.pop(user.id):
+                outbox.enqueue(user.id, message_id)
+
+    # 更新对话统计 (等待回复的起始时间等)
+    record_user_message(db, user.id, message_thread_id)
+    db.commit()
 
     # 7. 每日首次消息回执
     try:
         today_str = datetime.now().strftime("%Y-%m-%d")
-        last_ack_date = context.user_data.get("last_ack_date")
-        if last_ack_date != today_str:
+        state = user_states.get(user.id)
+        if state.last_ack_date != today_str:
             ack_msg = await message.reply_text("您的消息已送达\nYour message has been delivered")
-            context.user_data["last_ack_date"] = today_str
+            state.last_ack_date = today_str
             # 10 秒后自动删除回执
             await delete_message_later(3, ack_msg.chat.id, ack_msg.message_id, context)
     except Exception as e:
         logger.warning(f"Failed to send daily ack to user {user.id}: {e}")
 
     # 8. 准备转发参数
-    params = {"message_thread_id": message_thread_id}
+    params = {}
     if message.reply_to_message:
         reply_in_user_chat = message.reply_to_message.message_id
-        msg_map = db.query(MessageMap).filter(MessageMap.user_chat_message_id == reply_in_user_chat).first()
-        if msg_map and msg_map.group_chat_message_id:
-            params["reply_to_message_id"] = msg_map.group_chat_message_id
+        group_msg_id = lookup_group_msg_id(user.id, reply_in_user_chat)
+        if group_msg_id:
+            params["reply_to_message_id"] = group_msg_id
         else:
             logger.debug(f"Original message for reply {reply_in_user_chat} not found in group map.")
             # 可以选择不引用，或者通知用户无法引用
 
     # 9. 处理转发逻辑 (包括媒体组)
     try:
+        # 群组消息 ID 要等投递后才知道，先暂存待索引的内容
+        search_index.stage(user.id, message.message_id, message.text or message.caption)
         if message.media_group_id:
             # 处理媒体组
             # 检查这条消息是否是这个媒体组的第一条带标题的消息
@@ -500,7 +974,7 @@ async def forwarding_message_u2a(update: Update, context: ContextTypes.DEFAULT_T
                 await send_media_group_later(
                     3, # 延迟3秒发送媒体组
                     user.id,
-                    admin_group_id,
+                    tenant.admin_group_id,
                     message.media_group_id,
                     "u2a",
                     context
@@ -509,60 +983,91 @@ async def forwarding_message_u2a(update: Update, context: ContextTypes.DEFAULT_T
                  logger.debug(f"Received subsequent message of media group {message.media_group_id} from user {user.id}")
 
         else:
-            # 处理单条消息
-            chat = await context.bot.get_chat(admin_group_id) # 目标是管理群组
-            sent_msg = await chat.send_copy(
-                from_chat_id=message.chat.id, # 来源是用户私聊
-                message_id=message.message_id,
-                **params # 包括 thread_id 和可能的 reply_to_message_id
-            )
-            # 记录消息映射
-            msg_map = MessageMap(
-                user_chat_message_id=message.id,
-                group_chat_message_id=sent_msg.message_id,
-                user_id=user.id,
-            )
-            db.add(msg_map)
-            db.commit()
-            logger.debug(f"Forwarded u2a: user({user.id}) msg({message.id}) -> group msg({sent_msg.message_id}) in topic({message_thread_id})")
-    except BadRequest as e:
-            logger.warning(f"Failed to forward message u2a (user: {user.id}, topic: {message_thread_id}): {e}")
-            # === 修改开始: 修正 if 条件 ===
-            # 使用 .lower() 进行大小写不敏感比较
-            error_text = str(e).lower()
-            if "message thread not found" in error_text or "topic deleted" in error_text or ("chat not found" in error_text and str(admin_group_id) in error_text):
-            # === 修改结束: 修正 if 条件 ===
-                original_thread_id = u.message_thread_id # 保存旧 ID 用于日志和清理
-                logger.info(f"Topic {original_thread_id} seems deleted. Cleared thread_id for user {user.id}.")
-                # 清理数据库
-                u.message_thread_id = None # 使用 None 更标准
-                db.add(u)
-                db.query(FormnStatus).filter(FormnStatus.message_thread_id == original_thread_id).delete()
-                db.commit()
-                # 检查是否允许重开话题
-                if not is_delete_topic_as_ban_forever:
-                     await message.reply_html(
-                         "发送失败：你之前的对话已被删除。请重新发送一次当前消息。\nSend failed: Your previous conversation has been deleted. Please resend the current message."
-                     )
-                else:
-                     # 如果是永久禁止，则发送提示给用户，并确保不重试
-                     await message.reply_html(
-                         "发送失败：你的对话已被永久删除。消息无法送达。\nSend failed: Your conversation has been permanently deleted. Message cannot be delivered."
-                     )
-                    # retry_attempt = False # 确保不重试
-            else:
-                 # 如果是其他类型的 BadRequest 错误，通知用户并停止重试
-                 await message.reply_html(f"发送消息时遇到问题，请稍后再试。\nEncountered a problem while sending the message, please try again later.\nError: {e}")
-                 retry_attempt = False # 停止重试
+            # 处理单条消息：先写入发件箱，再由发件箱 worker 投递并记录消息映射
+            outbox.enqueue(user.id, message.message_id, params.get("reply_to_message_id"))
     except Exception as e:
         logger.error(f"Unexpected error forwarding message u2a (user: {user.id}): {e}", exc_info=True)
         await message.reply_html("发送消息时发生未知错误。\nAn unknown error occurred while sending the message.")
 
+    # 10. 新对话的联系人卡片：在首条消息进入发件箱之后才安排，保证卡片在消息之后送达
+    if new_topic:
+        schedule_contact_card(context, user.id, message_thread_id, user.full_name)
+
+
+# 发件箱投递 u2a 单条消息
+async def _deliver_u2a(bot: telegram.Bot, session, item: OutboxMessage):
+    # 幂等检查：已有映射说明之前已投递成功 (例如发送后、删除发件箱记录前进程崩溃)
+    if lookup_group_msg_id(item.user_id, item.message_id, session):
+        logger.debug(f"Outbox msg {item.message_id} of user {item.user_id} already delivered, skipping.")
+        return
+    u = session.query(User).filter(User.user_id == item.user_id).first()
+    if not u or not u.message_thread_id:
+        # 话题在投递前被删除，按话题丢失处理
+        raise BadRequest("Message thread not found")
+    sent_msg = await bot.copy_message(
+        chat_id=tenant.admin_group_id,
+        from_chat_id=item.user_id,
+        message_id=item.message_id,
+        message_thread_id=u.message_thread_id,
+        reply_to_message_id=item.reply_to_message_id,
+        allow_sending_without_reply=True,
+    )
+    record_message_map(session, item.user_id, item.message_id, sent_msg.message_id, "u2a")
+    search_index.resolve(item.user_id, item.message_id, sent_msg.message_id)
+    logger.debug(f"Forwarded u2a: user({item.user_id}) msg({item.message_id}) -> group msg({sent_msg.message_id}) in topic({u.message_thread_id})")
+
+
+# 发件箱投递最终失败
+async def _on_u2a_failed(bot: telegram.Bot, item: OutboxMessage, e: Exception):
+    user_id = item.user_id
+    logger.warning(f"Failed to forward message u2a (user: {user_id}, msg: {item.message_id}): {e}")
+    search_index.discard(user_id, item.message_id)
+    reply = {"reply_to_message_id": item.message_id, "allow_sending_without_reply": True, "parse_mode": "HTML"}
+    # 使用 .lower() 进行大小写不敏感比较
+    error_text = str(e).lower()
+    if isinstance(e, BadRequest) and ("message thread not found" in error_text or "topic deleted" in error_text or ("chat not found" in error_text and str(tenant.admin_group_id) in error_text)):
+        u = db.query(User).filter(User.user_id == user_id).first()
+        original_thread_id = u.message_thread_id if u else None # 保存旧 ID 用于日志和清理
+        if not original_thread_id:
+            # 同一用户排队中的后续消息会接连失败，只在第一条 (清除话题 ID 时) 通知用户
+            return
+        logger.info(f"Topic {original_thread_id} seems deleted. Cleared thread_id for user {user_id}.")
+        # 清理数据库
+        if u:
+            u.message_thread_id = None # 使用 None 更标准
+            db.add(u)
+        if original_thread_id:
+            db.query(FormnStatus).filter(FormnStatus.message_thread_id == original_thread_id).delete()
+        db.commit()
+        # 检查是否允许重开话题
+        if not is_delete_topic_as_ban_forever:
+            await bot.send_message(
+                user_id,
+                "发送失败：你之前的对话已被删除。请重新发送一次当前消息。\nSend failed: Your previous conversation has been deleted. Please resend the current message.",
+                **reply,
+            )
+        else:
+            # 如果是永久禁止，则发送提示给用户
+            await bot.send_message(
+                user_id,
+                "发送失败：你的对话已被永久删除。消息无法送达。\nSend failed: Your conversation has been permanently deleted. Message cannot be delivered.",
+                **reply,
+            )
+    else:
+        await bot.send_message(
+            user_id,
+            f"发送消息时遇到问题，请稍后再试。\nEncountered a problem while sending the message, please try again later.\nError: {e}",
+            **reply,
+        )
+
+
+outbox = TenantLocal(lambda: Outbox(_deliver_u2a, _on_u2a_failed, workers=outbox_workers, max_attempts=outbox_max_attempts))
+
 
 # 转发消息 a2u (管理员到用户)
 async def forwarding_message_a2u(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 仅处理来自管理群组的消息
-    if not update.message or update.message.chat.id != admin_group_id:
+    if not update.message or update.message.chat.id != tenant.admin_group_id:
         return
 
     message = update.message
@@ -580,46 +1085,22 @@ async def forwarding_message_a2u(update: Update, context: ContextTypes.DEFAULT_T
     if message.forum_topic_created:
         # 理论上创建时 u2a 流程已处理，但可以加个保险或日志
         logger.info(f"Topic {message_thread_id} created event received in group.")
-        f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).first()
-        if not f_status:
-            f = FormnStatus(message_thread_id=message_thread_id, status="opened")
-            db.add(f)
-            db.commit()
-        elif f_status.status != "opened":
-             f_status.status = "opened"
-             db.add(f_status)
-             db.commit()
+        set_topic_status([message_thread_id], "opened")
         return # 不转发话题创建事件本身
 
     if message.forum_topic_closed:
         logger.info(f"Topic {message_thread_id} closed event received.")
-        # 更新数据库状态
-        f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).first()
-        if f_status:
-            f_status.status = "closed"
-            db.add(f_status)
-            db.commit()
-        else:
-            # 如果记录不存在，也创建一个标记为 closed
-            f = FormnStatus(message_thread_id=message_thread_id, status="closed")
-            db.add(f)
-            db.commit()
+        set_topic_status([message_thread_id], "closed")
         return # 不转发话题关闭事件本身
 
     if message.forum_topic_reopened:
         logger.info(f"Topic {message_thread_id} reopened event received.")
-        # 更新数据库状态
-        f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).first()
-        if f_status:
-            f_status.status = "opened"
-            db.add(f_status)
-            db.commit()
-        else:
-             f = FormnStatus(message_thread_id=message_thread_id, status="opened")
-             db.add(f)
-             db.commit()
+        set_topic_status([message_thread_id], "opened")
         return # 不转发话题重开事件本身
 
+    if message.forum_topic_edited or message.pinned_message:
+        return # 话题改名、置顶等服务消息不转发，也不算作回复
+
     # 4. 查找目标用户 ID
     target_user = db.query(User).filter(User.message_thread_id == message_thread_id).first()
     if not target_user:
@@ -628,10 +1109,14 @@ async def forwarding_message_a2u(update: Update, context: ContextTypes.DEFAULT_T
         # await message.reply_html("错误：找不到与此话题关联的用户。", quote=True)
         return
     user_id = target_user.user_id # 目标用户 chat_id
+    target_user.last_active_at = datetime.now()
+    db.commit()
 
     # 5. 检查话题是否关闭 (如果管理员在关闭的话题里发言)
     f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).first()
-    if f_status and f_status.status == "closed":
+    if f_status and f_status.status == "auto_closed":
+        await reopen_auto_closed_topic(context, message_thread_id)
+    elif f_status and f_status.status == "closed":
         # 根据策略决定是否允许转发
         # if not allow_admin_reply_in_closed_topic: # 假设有这样一个配置
         await message.reply_html("提醒：此对话已关闭。用户的消息可能不会被发送，除非你重新打开对话。", quote=True)
@@ -642,13 +1127,14 @@ async def forwarding_message_a2u(update: Update, context: ContextTypes.DEFAULT_T
     if message.reply_to_message:
         reply_in_admin_group = message.reply_to_message.message_id
         # 查找这条被回复的消息在用户私聊中的对应 ID
-        msg_map = db.query(MessageMap).filter(MessageMap.group_chat_message_id == reply_in_admin_group).first()
-        if msg_map and msg_map.user_chat_message_id:
-            params["reply_to_message_id"] = msg_map.user_chat_message_id
+        mapped = lookup_user_msg(reply_in_admin_group)
+        if mapped and mapped[0] == user_id:
+            params["reply_to_message_id"] = mapped[1]
         else:
             logger.debug(f"Original message for reply {reply_in_admin_group} not found in user map.")
 
     # 7. 处理转发逻辑 (包括媒体组)
+    search_index.add(message.message_id, user_id, "a2u", message.text or message.caption)
     try:
         target_chat = await context.bot.get_chat(user_id) # 获取目标用户 chat 对象
 
@@ -673,11 +1159,12 @@ async def forwarding_message_a2u(update: Update, context: ContextTypes.DEFAULT_T
                 logger.debug(f"Received first message of media group {message.media_group_id} from admin {user.id} in topic {message_thread_id}")
                 await send_media_group_later(
                     3, # 延迟3秒
-                    admin_group_id, # 来源 chat_id
+                    tenant.admin_group_id, # 来源 chat_id
                     user_id,       # 目标 chat_id
                     message.media_group_id,
                     "a2u",
-                    context
+                    context,
+                    admin_id=user.id, # 媒体组送达后记为该管理员的回复
                 )
             else:
                 logger.debug(f"Received subsequent message of media group {message.media_group_id} from admin {user.id}")
@@ -687,16 +1174,13 @@ async def forwarding_message_a2u(update: Update, context: ContextTypes.DEFAULT_T
             sent_msg = await target_chat.send_copy(
                 from_chat_id=message.chat.id, # 来源是管理群组
                 message_id=message.message_id,
+                allow_sending_without_reply=True,
                 **params # 可能包含 reply_to_message_id
             )
             # 记录消息映射
-            msg_map = MessageMap(
-                group_chat_message_id=message.id,
-                user_chat_message_id=sent_msg.message_id,
-                user_id=user_id, # 记录是哪个用户的对话
-            )
-            db.add(msg_map)
+            record_message_map(db, user_id, sent_msg.message_id, message.id, "a2u")
             db.commit()
+            record_delivered_admin_reply(user_id, user.id, user.full_name)
             logger.debug(f"Forwarded a2u: group msg({message.id}) in topic({message_thread_id}) -> user({user_id}) msg({sent_msg.message_id})")
 
     except BadRequest as e:
@@ -726,62 +1210,18 @@ async def handle_edited_user_message(update: Update, context: ContextTypes.DEFAU
     logger.debug(f"处理来自用户 {user_id} 的已编辑消息 {edited_msg_id}")
 
     # 查找对应的群组消息
-    msg_map = db.query(MessageMap).filter(MessageMap.user_chat_message_id == edited_msg_id).first()
-    if not msg_map or not msg_map.group_chat_message_id:
+    group_msg_id = lookup_group_msg_id(user_id, edited_msg_id)
+    if not group_msg_id:
         logger.debug(f"未找到用户编辑消息 {edited_msg_id} 在群组中的映射记录")
         return # 没有映射，无法同步
 
-    # 查找用户的话题 ID
-    u = db.query(User).filter(User.user_id == user_id).first()
-    if not u or not u.message_thread_id:
-        logger.debug(f"用户 {user_id} 编辑消息 {edited_msg_id} 时未找到话题 ID")
-        return
-
-    # 检查话题是否关闭 (通常编辑已不重要，但以防万一)
-    f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == u.message_thread_id).first()
-    if f_status and f_status.status == "closed":
-        logger.info(f"话题 {u.message_thread_id} 已关闭，忽略用户 {user_id} 的编辑同步请求。")
-        return
-
-    group_msg_id = msg_map.group_chat_message_id
-    # message_thread_id = u.message_thread_id # 编辑时不需要显式传入 thread_id
-
-    try:
-        if edited_msg.text is not None: # 检查是否有文本内容 (空字符串也算)
-            await context.bot.edit_message_text(
-                chat_id=admin_group_id,
-                message_id=group_msg_id,
-                text=edited_msg.text_html, # 使用 HTML 格式
-                parse_mode='HTML',
-                # 不指定 reply_markup 会保留原来的按钮 (如果有)
-            )
-            logger.info(f"已同步用户编辑 (文本) user_msg({edited_msg_id}) 到 group_msg({group_msg_id})")
-        elif edited_msg.caption is not None: # 检查是否有说明文字
-             await context.bot.edit_message_caption(
-                chat_id=admin_group_id,
-                message_id=group_msg_id,
-                caption=edited_msg.caption_html, # 使用 HTML 格式
-                parse_mode='HTML',
-             )
-             logger.info(f"已同步用户编辑 (说明) user_msg({edited_msg_id}) 到 group_msg({group_msg_id})")
-        # 暂不支持编辑媒体内容本身的同步
-        else:
-            logger.debug(f"用户编辑的消息 {edited_msg_id} 类型 (非文本/说明) 不支持同步。")
-
-    except BadRequest as e:
-        # 忽略 "Message is not modified" 错误，这是正常的
-        if "Message is not modified" in str(e):
-            logger.debug(f"同步用户编辑 user_msg({edited_msg_id}) 到 group_msg({group_msg_id}) 时消息无变化。")
-        else:
-            logger.warning(f"同步用户编辑 user_msg({edited_msg_id}) 到 group_msg({group_msg_id}) 失败: {e}")
-    except Exception as e:
-        logger.error(f"同步用户编辑 user_msg({edited_msg_id}) 到 group_msg({group_msg_id}) 时发生意外错误: {e}", exc_info=True)
+    queue_edit_sync(context, tenant.admin_group_id, group_msg_id, edited_msg, "u2a")
 
 
 # --- 新增：处理管理员编辑的消息 ---
 async def handle_edited_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理来自管理群组话题的已编辑消息。"""
-    if not update.edited_message or update.edited_message.chat.id != admin_group_id:
+    if not update.edited_message or update.edited_message.chat.id != tenant.admin_group_id:
         return
 
     edited_msg = update.edited_message
@@ -795,52 +1235,100 @@ async def handle_edited_admin_message(update: Update, context: ContextTypes.DEFA
     logger.debug(f"处理来自管理群组话题 {message_thread_id} 的已编辑消息 {edited_msg_id}")
 
     # 查找对应的用户私聊消息
-    msg_map = db.query(MessageMap).filter(MessageMap.group_chat_message_id == edited_msg_id).first()
-    if not msg_map or not msg_map.user_chat_message_id:
+    mapped = lookup_user_msg(edited_msg_id)
+    if not mapped:
         logger.debug(f"未找到管理员编辑消息 {edited_msg_id} 在用户私聊中的映射记录")
         return
 
-    user_chat_msg_id = msg_map.user_chat_message_id
-    user_id = msg_map.user_id # 从映射记录获取目标用户 ID
+    user_id, user_chat_msg_id = mapped # 从映射记录获取目标用户 ID
+    queue_edit_sync(context, user_id, user_chat_msg_id, edited_msg, "a2u")
+
 
-    # 检查话题状态 (可选，管理员可能希望编辑关闭话题中的消息)
-    # f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).first()
-    # if f_status and f_status.status == "closed":
-    #     logger.info(f"Topic {message_thread_id} is closed. Skipping admin edit sync.")
-    #     # await edited_msg.reply_html("提醒：话题已关闭，编辑可能不会同步给用户。", quote=True)
-    #     return
+# 登记一次编辑同步：同一目标消息在 EDIT_SYNC_DELAY 秒内的多次编辑只同步最后一次
+def queue_edit_sync(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, edited_msg, dir: str):
+    target = (chat_id, message_id)
+    if edit_coalescer.submit(target, (edited_msg, dir)):
+        context.job_queue.run_once(
+            _sync_edit_later, edit_sync_delay, data=target, name=f"editsync_{chat_id}_{message_id}"
+        )
+
+
+async def _sync_edit_later(context: ContextTypes.DEFAULT_TYPE):
+    target = context.job.data
+    pending = edit_coalescer.take(target)
+    if not pending:
+        return
+    edited_msg, dir = pending
+    chat_id, message_id = target
+    source = f"user_msg({edited_msg.message_id})" if dir == "u2a" else f"group_msg({edited_msg.message_id})"
+    dest = f"group_msg({message_id})" if dir == "u2a" else f"user_msg({message_id})"
+    who = "用户" if dir == "u2a" else "管理员"
+
+    digest = edit_digest(edited_msg)
+    last = edit_coalescer.last_synced(target)
+    if last == digest:
+        logger.debug(f"{who}编辑 {source} 与上次同步到 {dest} 的内容相同，跳过。")
+        return
 
+    if dir == "u2a":
+        # 检查话题是否关闭 (通常编辑已不重要，但以防万一)
+        u = db.query(User).filter(User.user_id == edited_msg.from_user.id).first()
+        if not u or not u.message_thread_id:
+            logger.debug(f"用户 {edited_msg.from_user.id} 编辑消息 {edited_msg.message_id} 时未找到话题 ID")
+            return
+        f_status = db.query(FormnStatus).filter(FormnStatus.message_thread_id == u.message_thread_id).first()
+        if f_status and f_status.status == "closed":
+            logger.info(f"话题 {u.message_thread_id} 已关闭，忽略用户 {u.user_id} 的编辑同步请求。")
+            return
+
+    # 直接传递 entities，不经过 HTML 序列化再解析
     try:
-        if edited_msg.text is not None:
+        if edited_msg.text is not None: # 检查是否有文本内容 (空字符串也算)
             await context.bot.edit_message_text(
-                chat_id=user_id,
-                message_id=user_chat_msg_id,
-                text=edited_msg.text_html,
-                parse_mode='HTML',
+                chat_id=chat_id,
+                message_id=message_id,
+                text=edited_msg.text,
+                entities=edited_msg.entities,
+                # 不指定 reply_markup 会保留原来的按钮 (如果有)
+            )
+            logger.info(f"已同步{who}编辑 (文本) {source} 到 {dest}")
+        elif digest[0] and (not last or last[0] != digest[0]):
+            # 媒体被替换 (或尚无同步记录，无法确定)：连同说明文字一起替换媒体，相册中的每一项分别映射，同样适用
+            await context.bot.edit_message_media(
+                chat_id=chat_id,
+                message_id=message_id,
+                media=input_media_of(edited_msg),
             )
-            logger.info(f"已同步管理员编辑 (文本) group_msg({edited_msg_id}) 到 user_msg({user_chat_msg_id})")
-        elif edited_msg.caption is not None:
-             await context.bot.edit_message_caption(
-                chat_id=user_id,
-                message_id=user_chat_msg_id,
-                caption=edited_msg.caption_html,
-                parse_mode='HTML',
-             )
-             logger.info(f"已同步管理员编辑 (说明) group_msg({edited_msg_id}) 到 user_msg({user_chat_msg_id})")
+            logger.info(f"已同步{who}编辑 (媒体) {source} 到 {dest}")
+        elif edited_msg.caption is not None or digest[0]: # 只修改了说明文字 (包括删除说明文字)
+            await context.bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=edited_msg.caption,
+                caption_entities=edited_msg.caption_entities,
+            )
+            logger.info(f"已同步{who}编辑 (说明) {source} 到 {dest}")
+        else:
+            logger.debug(f"{who}编辑的消息 {edited_msg.message_id} 类型不支持同步。")
+            return
+        edit_coalescer.mark_synced(target, digest)
+        # 更新全文索引 (索引以管理群组中的消息 ID 为键)
+        if dir == "u2a":
+            search_index.add(message_id, edited_msg.from_user.id, dir, edited_msg.text or edited_msg.caption)
         else:
-             logger.debug(f"管理员编辑的消息 {edited_msg_id} 类型 (非文本/说明) 不支持同步。")
+            search_index.add(edited_msg.message_id, chat_id, dir, edited_msg.text or edited_msg.caption)
 
     except BadRequest as e:
+        # 忽略 "Message is not modified" 错误，这是正常的
         if "Message is not modified" in str(e):
-             logger.debug(f"同步管理员编辑 group_msg({edited_msg_id}) 到 user_msg({user_chat_msg_id}) 时消息无变化。")
-        elif "bot was blocked by the user" in str(e) or "user is deactivated" in str(e) or "chat not found" in str(e).lower():
-             logger.warning(f"同步管理员编辑 group_msg({edited_msg_id}) 到 user_msg({user_chat_msg_id}) 失败: 用户可能已拉黑或停用。")
-             # 可以考虑通知管理员
-             # await edited_msg.reply_html(f"⚠️ 无法向用户 {user_id} 同步编辑：用户可能已拉黑或停用。", quote=True)
+            edit_coalescer.mark_synced(target, digest)
+            logger.debug(f"同步{who}编辑 {source} 到 {dest} 时消息无变化。")
+        elif dir == "a2u" and ("bot was blocked by the user" in str(e) or "user is deactivated" in str(e) or "chat not found" in str(e).lower()):
+            logger.warning(f"同步管理员编辑 {source} 到 {dest} 失败: 用户可能已拉黑或停用。")
         else:
-             logger.warning(f"同步管理员编辑 group_msg({edited_msg_id}) 到 user_msg({user_chat_msg_id}) 失败: {e}")
+            logger.warning(f"同步{who}编辑 {source} 到 {dest} 失败: {e}")
     except Exception as e:
-        logger.error(f"同步管理员编辑 group_msg({edited_msg_id}) 到 user_msg({user_chat_msg_id}) 时发生意外错误: {e}", exc_info=True)
+        logger.error(f"同步{who}编辑 {source} 到 {dest} 时发生意外错误: {e}", exc_info=True)
 
 
 # 清理话题 (clear 命令)
@@ -849,7 +1337,7 @@ async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
 
     # 权限检查
-    if user.id not in admin_user_ids:
+    if user.id not in tenant.admin_user_ids:
         await message.reply_html("你没有权限执行此操作。")
         return
 
@@ -865,20 +1353,23 @@ async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # 删除话题
         await context.bot.delete_forum_topic(
-            chat_id=admin_group_id,
+            chat_id=tenant.admin_group_id,
             message_thread_id=message_thread_id
         )
         logger.info(f"Admin {user.id} cleared topic {message_thread_id}")
+        if target_user:
+            search_index.drop_users([target_user.user_id])
 
         # 从数据库移除话题状态和用户关联
         db.query(FormnStatus).filter(FormnStatus.message_thread_id == message_thread_id).delete()
         if target_user:
             target_user.message_thread_id = None
             db.add(target_user)
+            end_waiting(db, [target_user.user_id])
         # 提交更改
         db.commit()
         # 可选：发送一个确认消息到 General (如果 General 可用)
-        # await context.bot.send_message(admin_group_id, f"管理员 {mention_html(user.id, user.full_name)} 清除了话题 {message_thread_id}", parse_mode='HTML')
+        # await context.bot.send_message(tenant.admin_group_id, f"管理员 {mention_html(user.id, user.full_name)} 清除了话题 {message_thread_id}", parse_mode='HTML')
 
     except BadRequest as e:
         logger.error(f"Failed to delete topic {message_thread_id} by admin {user.id}: {e}")
@@ -888,89 +1379,320 @@ async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if target_user:
             target_user.message_thread_id = None
             db.add(target_user)
+            end_waiting(db, [target_user.user_id])
         db.commit()
     except Exception as e:
          logger.error(f"Unexpected error clearing topic {message_thread_id} by admin {user.id}: {e}", exc_info=True)
          await message.reply_html(f"清除话题时发生意外错误: {e}", quote=True)
 
-    # --- 用户消息删除逻辑 ---
+    # --- 用户消息删除逻辑 (后台执行，不阻塞命令处理) ---
     if is_delete_user_messages and target_user:
-        logger.info(f"Attempting to delete messages for user {target_user.user_id} related to cleared topic {message_thread_id}")
-        # 查找该用户所有映射过的消息
-        all_user_messages_map = db.query(MessageMap).filter(MessageMap.user_id == target_user.user_id).all()
-        user_message_ids_to_delete = [msg.user_chat_message_id for msg in all_user_messages_map if msg.user_chat_message_id]
-
-        if user_message_ids_to_delete:
-            deleted_count = 0
-            batch_size = 100 # Telegram 一次最多删除 100 条
-            for i in range(0, len(user_message_ids_to_delete), batch_size):
-                batch = user_message_ids_to_delete[i:i + batch_size]
-                try:
-                    success = await context.bot.delete_messages(
-                        chat_id=target_user.user_id,
-                        message_ids=batch
-                    )
-                    if success:
-                        deleted_count += len(batch)
-                    else:
-                        logger.warning(f"Failed to delete a batch of messages for user {target_user.user_id}.")
-                        # 可以尝试逐条删除作为后备，但会很慢
-                except BadRequest as e:
-                     logger.warning(f"Error deleting messages batch for user {target_user.user_id}: {e}")
-                     # 如果是 "Message ids must be unique"，说明列表有重复，需要去重
-                     # 如果是 "Message can't be deleted"，可能是消息太旧或权限问题
-                except Exception as e:
-                     logger.error(f"Unexpected error deleting messages for user {target_user.user_id}: {e}", exc_info=True)
-
-            logger.info(f"Deleted {deleted_count} out of {len(user_message_ids_to_delete)} messages for user {target_user.user_id}.")
-            # 清除该用户的所有消息映射记录
-            db.query(MessageMap).filter(MessageMap.user_id == target_user.user_id).delete()
+        target_user_id = target_user.user_id
+        if target_user_id in clear_tasks:
+            await context.bot.send_message(tenant.admin_group_id, f"用户 {target_user_id} 的消息正在清理中，请勿重复执行。")
+            return
+        clear_tasks.add(target_user_id)
+        drain.track(
+            context.application.create_task(_clear_user_messages(context, target_user_id, message_thread_id), update=update),
+            "clear",
+        )
+
+
+# 正在后台清理消息的用户，避免同一用户重复清理
+clear_tasks = TenantLocal(set)
+
+
+# 后台删除用户私聊中的消息，并在管理群组中报告进度
+async def _clear_user_messages(context: ContextTypes.DEFAULT_TYPE, user_id: int, message_thread_id: int):
+    logger.info(f"Attempting to delete messages for user {user_id} related to cleared topic {message_thread_id}")
+    # 话题已被删除，进度消息发到群组的 General
+    status_msg = None
+    try:
+        status_msg = await context.bot.send_message(tenant.admin_group_id, f"🧹 正在清理用户 {user_id} 的消息...")
+    except Exception as e:
+        logger.warning(f"Failed to send clear progress message for user {user_id}: {e}")
+
+    async def report(deleted, total):
+        if status_msg:
+            await status_msg.edit_text(f"🧹 正在清理用户 {user_id} 的消息：已删除 {deleted} / 已扫描 {total}")
+
+    try:
+        deleted, total = await clear_user_messages(context.bot, user_id, on_progress=report)
+        msg_cache.drop_user(user_id)
+        logger.info(f"Deleted {deleted} out of {total} messages for user {user_id}. Cleared message map entries.")
+        if status_msg:
+            await status_msg.edit_text(f"✅ 用户 {user_id} 的消息清理完成：删除 {deleted} / 共 {total} 条。")
+    except Exception as e:
+        logger.error(f"Unexpected error clearing messages for user {user_id}: {e}", exc_info=True)
+        if status_msg:
+            await status_msg.edit_text(f"⚠️ 清理用户 {user_id} 的消息时发生错误: {e}")
+    finally:
+        clear_tasks.discard(user_id)
+
+
+BULK_USAGE = (
+    "用法：/bulk &lt;close|reopen|clear&gt; &lt;条件&gt;\n"
+    "条件：\n"
+    "  inactive N — 超过 N 天没有任何消息的对话\n"
+    "  noreply — 管理员从未回复过的对话\n"
+    "  users ID1,ID2,... — 指定用户的对话"
+)
+BULK_ACTION_NAMES = {"close": "关闭", "reopen": "重开", "clear": "清除"}
+
+
+# 按条件筛选拥有话题的用户
+def select_bulk_users(criteria: list) -> list:
+    query = db.query(User).filter(User.message_thread_id != None, User.message_thread_id != 0)
+    kind = criteria[0]
+    if kind == "inactive":
+        cutoff = datetime.now() - timedelta(days=int(criteria[1]))
+        # 没有活跃记录的对话 (升级前的旧数据) 不会被选中
+        query = query.filter(User.last_active_at < cutoff)
+    elif kind == "noreply":
+        # 升级前的旧对话同样没有回复记录，无法判断是否回复过，不会被选中
+        query = query.filter(User.last_admin_reply_at == None, User.last_active_at != None)
+    elif kind == "users":
+        user_ids = [int(x) for x in ",".join(criteria[1:]).split(",") if x.strip()]
+        if not user_ids:
+            raise ValueError("empty user list")
+        query = query.filter(User.user_id.in_(user_ids))
+    else:
+        raise ValueError(f"unknown criteria {kind}")
+    return query.all()
+
+
+# 批量管理命令 (/bulk)
+async def bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    message = update.message
+    if user.id not in tenant.admin_user_ids:
+        await message.reply_html("你没有权限执行此操作。")
+        return
+
+    args = context.args or []
+    if len(args) < 2 or args[0] not in BULK_ACTION_NAMES:
+        await message.reply_html(BULK_USAGE)
+        return
+    try:
+        users = select_bulk_users(args[1:])
+    except (ValueError, IndexError):
+        await message.reply_html(BULK_USAGE)
+        return
+    if not users:
+        await message.reply_html("没有符合条件的对话。")
+        return
+
+    action = args[0]
+    targets = [(u.user_id, u.message_thread_id) for u in users]
+    await message.reply_html(f"⏳ 开始批量{BULK_ACTION_NAMES[action]} {len(targets)} 个对话...")
+    logger.info(f"Admin {user.id} started bulk {action} on {len(targets)} topics ({' '.join(args[1:])})")
+    drain.track(context.application.create_task(_run_bulk(context, action, targets), update=update), "bulk")
+
+
+# 后台执行批量操作：并发调用 API，数据库状态一次性批量更新
+async def _run_bulk(context: ContextTypes.DEFAULT_TYPE, action: str, targets: list):
+    thread_ids = [tid for _, tid in targets]
+    cleared_messages = 0
+    try:
+        if action == "close":
+            done = await apply_to_topics(context.bot.close_forum_topic, tenant.admin_group_id, thread_ids, ok_errors=("topic_not_modified",))
+            set_topic_status(done, "closed")
+        elif action == "reopen":
+            done = await apply_to_topics(context.bot.reopen_forum_topic, tenant.admin_group_id, thread_ids, ok_errors=("topic_not_modified",))
+            set_topic_status(done, "opened")
+        else:
+            done = await apply_to_topics(
+                context.bot.delete_forum_topic, tenant.admin_group_id, thread_ids,
+                ok_errors=("message thread not found", "topic_id_invalid"),
+            )
+            done_set = set(done)
+            search_index.drop_users([user_id for user_id, tid in targets if tid in done_set])
+            for chunk in chunked(done):
+                db.query(FormnStatus).filter(FormnStatus.message_thread_id.in_(chunk)).delete(synchronize_session=False)
+                end_waiting(db, [uid for (uid,) in db.query(User.user_id).filter(User.message_thread_id.in_(chunk))])
+                db.query(User).filter(User.message_thread_id.in_(chunk)).update(
+                    {User.message_thread_id: None}, synchronize_session=False
+                )
             db.commit()
-            logger.info(f"Cleared message map entries for user {target_user.user_id}.")
+            if is_delete_user_messages:
+                for user_id, tid in targets:
+                    if tid not in done_set or user_id in clear_tasks:
+                        continue
+                    clear_tasks.add(user_id)
+                    try:
+                        deleted, _ = await clear_user_messages(context.bot, user_id)
+                        msg_cache.drop_user(user_id)
+                        cleared_messages += deleted
+                    finally:
+                        clear_tasks.discard(user_id)
+        summary = f"✅ 批量{BULK_ACTION_NAMES[action]}完成：成功 {len(done)} / 共 {len(targets)} 个对话。"
+        if cleared_messages:
+            summary += f"\n已删除用户侧消息 {cleared_messages} 条。"
+        logger.info(f"Bulk {action} finished: {len(done)}/{len(targets)} topics.")
+    except Exception as e:
+        logger.error(f"Unexpected error in bulk {action}: {e}", exc_info=True)
+        summary = f"⚠️ 批量{BULK_ACTION_NAMES[action]}时发生错误: {e}"
+    # 执行命令的话题可能已被删除，结果发到 General
+    await context.bot.send_message(tenant.admin_group_id, summary)
 
 
-# 广播回调 (保持不变)
-async def _broadcast(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
-    if not isinstance(job_data, str) or "_" not in job_data:
-        logger.error(f"Invalid job data format for broadcast: {job_data}")
+# 对话统计 (stats 命令)：在话题内显示该对话的统计，在 General 中显示全局和各管理员的统计
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    message = update.message
+
+    if user.id not in tenant.admin_user_ids:
+        await message.reply_html("你没有权限执行此操作。")
+        return
+
+    now = datetime.now()
+    message_thread_id = message.message_thread_id if message.is_topic_message else None
+    if message_thread_id:
+        topic = db.query(TopicStats).filter(TopicStats.message_thread_id == message_thread_id).first()
+        if not topic:
+            await message.reply_html("此对话暂无统计数据。")
+            return
+        average = topic.response_seconds / topic.response_count if topic.response_count else None
+        waiting = (now - topic.awaiting_since).total_seconds() if topic.awaiting_since else None
+        lines = [
+            "📊 <b>对话统计</b>",
+            f"用户消息: {topic.user_messages}  管理员消息: {topic.admin_messages}",
+            f"首次回复耗时: {format_duration(topic.first_response_seconds)}",
+            f"平均回复耗时: {format_duration(average)} ({topic.response_count} 次)",
+        ]
+        if waiting is not None:
+            lines.append(f"⏳ 等待回复: {format_duration(waiting)}，未回复消息 {topic.unanswered} 条")
+        await message.reply_html("\n".join(lines))
+        return
+
+    totals = global_stats(db)
+    responses = totals.get("responses", 0)
+    average = totals.get("response_seconds", 0) / responses if responses else None
+    oldest = totals["oldest_awaiting"]
+    lines = [
+        "📊 <b>全局统计</b>",
+        f"用户消息: {totals.get('user_messages', 0)}  管理员消息: {totals.get('admin_messages', 0)}",
+        f"平均回复耗时: {format_duration(average)} ({responses} 次)",
+        f"等待回复的对话: {totals.get('backlog', 0)}",
+    ]
+    if oldest:
+        lines.append(f"最久等待: {format_duration((now - oldest).total_seconds())}")
+    admins = db.query(AdminStats).order_by(AdminStats.replies.desc()).limit(20).all()
+    if admins:
+        lines.append("\n<b>管理员</b>")
+        for a in admins:
+            avg = a.response_seconds / a.response_count if a.response_count else None
+            lines.append(f"{mention_html(a.admin_id, a.name or str(a.admin_id))}: 回复 {a.replies} 条，平均耗时 {format_duration(avg)}")
+    await message.reply_html("\n".join(lines))
+
+
+# 搜索历史消息 (search 命令)，返回按相关度排序的结果和跳转链接
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    message = update.message
+
+    if user.id not in tenant.admin_user_ids:
+        await message.reply_html("你没有权限执行此操作。")
+        return
+
+    keywords = " ".join(context.args or [])
+    if not keywords:
+        await message.reply_html("用法：/search 关键词")
+        return
+    if min(len(t) for t in keywords.split()) < search_index.min_query_length:
+        await message.reply_html(f"每个关键词至少需要 {search_index.min_query_length} 个字符。")
         return
 
     try:
-        msg_id, chat_id = job_data.split("_", 1)
-        msg_id = int(msg_id)
-        chat_id = int(chat_id)
-    except ValueError:
-        logger.error(f"Could not parse msg_id and chat_id from broadcast job data: {job_data}")
+        hits = search_index.search(keywords)
+    except Exception as e:
+        logger.warning(f"Search for {keywords!r} failed: {e}")
+        await message.reply_html(f"搜索失败: {e}")
+        return
+    if not hits:
+        await message.reply_html("没有找到相关消息。")
         return
 
-    users = db.query(User).filter(User.message_thread_id != None).all() # 只广播给活跃用户? 或 all()?
-    logger.info(f"Starting broadcast of message {msg_id} from chat {chat_id} to {len(users)} users.")
+    threads = dict(
+        db.query(User.user_id, User.message_thread_id).filter(User.user_id.in_({uid for _, uid, _ in hits}))
+    )
+    chat_path = str(tenant.admin_group_id).removeprefix("-100")
+    lines = [f"🔍 找到 {len(hits)} 条相关消息："]
+    for group_msg_id, user_id, snippet in hits:
+        thread_id = threads.get(user_id)
+        if thread_id:
+            link = f"https://t.me/c/{chat_path}/{thread_id}/{group_msg_id}"
+            lines.append(f'• <a href="{link}">{user_id}</a>: {snippet_html(snippet)}')
+        else:
+            lines.append(f"• {user_id} (对话已删除): {snippet_html(snippet)}")
+    await message.reply_html("\n".join(lines), disable_web_page_preview=True)
+
+
+async def _flush_search_index(context: ContextTypes.DEFAULT_TYPE):
+    search_index.flush()
+
+
+async def _purge_search_index(context: ContextTypes.DEFAULT_TYPE):
+    purged = search_index.purge()
+    if purged:
+        logger.info(f"Purged {purged} expired messages from the search index.")
+
+
+BROADCAST_PAGE_SIZE = 200
+
+
+# 广播回调 (任务记录：chat_id/ref_id 为要广播的消息，arg 为已发送到的 User.id，用于重启后继续)
+async def _broadcast(context: ContextTypes.DEFAULT_TYPE, job):
+    chat_id = job.chat_id
+    msg_id = job.ref_id
+    last_id = job.arg or 0
+    if last_id:
+        logger.info(f"Resuming broadcast of message {msg_id} from chat {chat_id} after user row {last_id}.")
+    else:
+        logger.info(f"Starting broadcast of message {msg_id} from chat {chat_id}.")
     success = 0
     failed = 0
     block_or_deactivated = 0
 
-    for u in users:
-        try:
-            # 使用 copy_message 更灵活，允许添加按钮等
-            await context.bot.copy_message(
-                chat_id=u.user_id,
-                from_chat_id=chat_id,
-                message_id=msg_id
-            )
-            success += 1
-            await asyncio.sleep(0.1) # 稍作延迟防止触发 Flood Limits
-        except BadRequest as e:
-            if "bot was blocked by the user" in str(e) or "user is deactivated" in str(e):
-                block_or_deactivated += 1
-                logger.debug(f"Broadcast failed to user {u.user_id}: Blocked or deactivated.")
-                # 可选：将这些用户标记为非活跃
-            else:
+    while True:
+        # 按主键分页读取，每页完成后保存进度
+        users = (
+            db.query(User.id, User.user_id)
+            .filter(User.message_thread_id != None, User.id > last_id) # 只广播给活跃用户? 或 all()?
+            .order_by(User.id)
+            .limit(BROADCAST_PAGE_SIZE)
+            .all()
+        )
+        if not users:
+            break
+        for row_id, user_id in users:
+            if drain.draining:
+                # 停机：保存到已发送的最后一个用户，重启后从下一个用户继续，不会重复发送
+                job_store.checkpoint(job.id, last_id)
+                logger.info(f"Broadcast paused for shutdown after user row {last_id}. Success so far: {success}, Failed: {failed}")
+                raise JobDeferred()
+            try:
+                # 使用 copy_message 更灵活，允许添加按钮等
+                await context.bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=chat_id,
+                    message_id=msg_id
+                )
+                success += 1
+                await asyncio.sleep(0.1) # 稍作延迟防止触发 Flood Limits
+            except BadRequest as e:
+                if "bot was blocked by the user" in str(e) or "user is deactivated" in str(e):
+                    block_or_deactivated += 1
+                    logger.debug(f"Broadcast failed to user {user_id}: Blocked or deactivated.")
+                    # 可选：将这些用户标记为非活跃
+                else:
+                    failed += 1
+                    logger.warning(f"Broadcast failed to user {user_id}: {e}")
+            except Exception as e:
                 failed += 1
-                logger.warning(f"Broadcast failed to user {u.user_id}: {e}")
-        except Exception as e:
-            failed += 1
-            logger.error(f"Unexpected error broadcasting to user {u.user_id}: {e}", exc_info=True)
+                logger.error(f"Unexpected error broadcasting to user {user_id}: {e}", exc_info=True)
+            last_id = row_id
+        job_store.checkpoint(job.id, last_id)
 
     logger.info(f"Broadcast finished. Success: {success}, Failed: {failed}, Blocked/Deactivated: {block_or_deactivated}")
     # 可以考虑通知发起广播的管理员结果
@@ -979,10 +1701,15 @@ async def _broadcast(context: ContextTypes.DEFAULT_TYPE):
     #     await context.bot.send_message(originator_admin_id, f"广播完成：成功 {success}，失败 {failed}，屏蔽/停用 {block_or_deactivated}")
 
 
+job_store.register("media_group_u2a", _send_media_group_later)
+job_store.register("media_group_a2u", _send_media_group_later)
+job_store.register("broadcast", _broadcast)
+
+
 # 广播命令 (保持不变)
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if user.id not in admin_user_ids:
+    if user.id not in tenant.admin_user_ids:
         await update.message.reply_html("你没有权限执行此操作。")
         return
 
@@ -993,45 +1720,179 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     broadcast_message = update.message.reply_to_message
-    job_data = f"{broadcast_message.id}_{broadcast_message.chat.id}"
-
-    context.job_queue.run_once(
-        _broadcast,
-        when=timedelta(seconds=1), # 延迟1秒开始执行
-        data=job_data,
-        name=f"broadcast_{broadcast_message.id}"
-        # context={"admin_id": user.id} # 如果需要在 _broadcast 回调中知道是谁发起的
+
+    job_store.schedule(
+        context.job_queue,
+        "broadcast",
+        1, # 延迟1秒开始执行
+        f"broadcast_{broadcast_message.id}",
+        chat_id=broadcast_message.chat.id,
+        ref_id=broadcast_message.id,
     )
     await update.message.reply_html(f"📢 广播任务已计划执行。将广播消息 ID: {broadcast_message.id}")
 
 
+PROFILE_DEFAULT_SECONDS = 30
+
+
+# 采样分析事件循环 (profile 命令)，完成后发送 folded 文件 (可用 flamegraph.pl 或 speedscope 查看)
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    message = update.message
+
+    if user.id not in tenant.admin_user_ids:
+        await message.reply_html("你没有权限执行此操作。")
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await message.reply_html(f"用法：/profile [秒数]，默认 {PROFILE_DEFAULT_SECONDS} 秒，最长 {profiler.max_seconds} 秒。")
+        return
+    if profiler.running:
+        await message.reply_html("已有采样正在进行，请稍后再试。")
+        return
+    seconds = max(1, min(seconds, profiler.max_seconds))
+    await message.reply_html(f"⏱ 开始采样 {seconds} 秒...")
+    # 采样期间不阻塞其他更新的处理
+    drain.track(context.application.create_task(_run_profile(message, seconds), update=update), "profile")
+
+
+async def _run_profile(message: telegram.Message, seconds: int):
+    try:
+        path, counts = await profiler.profile(threading.get_ident(), seconds)
+    except RuntimeError as e:
+        await message.reply_html(f"采样失败: {e}")
+        return
+    logger.info(f"Wrote event loop profile to {path}")
+    caption = (
+        f"<pre>{html.escape(summarize(counts))}</pre>\n"
+        f"事件循环最大延迟 {watchdog.max_lag:.3f}s，阻塞超过阈值 {watchdog.stall_count} 次"
+    )
+    with open(path, "rb") as f:
+        await message.reply_document(f, caption=caption[:1024], parse_mode="HTML")
+
+
+# 收到 SIGUSR1 时采样分析，结果只写入文件和日志
+async def _profile_on_signal():
+    if profiler.running:
+        logger.warning("SIGUSR1 ignored: a profile is already running.")
+        return
+    path, counts = await profiler.profile(threading.get_ident(), PROFILE_DEFAULT_SECONDS)
+    logger.info(f"Wrote event loop profile to {path}\n{summarize(counts)}")
+
+
 # 错误处理 (保持不变)
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """记录错误日志。"""
     logger.error(f"处理更新时发生异常: {context.error}", exc_info=context.error)
+    # 数据库操作失败 (例如分片模式下的 database is locked) 后会话需要回滚，否则之后所有处理器都会报 PendingRollbackError
+    db.rollback()
     # 对于特定类型的常见错误，可以添加更详细的处理或用户提示
     # 例如： 处理用户在私聊中发送命令（如果未定义）
     # if isinstance(context.error, CommandInvalid) and isinstance(update, Update) and update.message and update.message.chat.type == ChatType.PRIVATE:
     #     await update.message.reply_text("未知命令。直接发送消息即可与客服沟通。")
 
 
-# --- Main Execution ---
-if __name__ == "__main__":
-    # 使用基于文件的持久化存储用户和聊天数据
-    pickle_persistence = PicklePersistence(filepath=f"./assets/{app_name}.pickle")
+# 停机排空：停止接收新更新，在截止时间内处理完已收到的更新、待同步的编辑、发件箱和后台任务。
+# 广播等持久化任务保存进度后留到重启后继续，最后报告推迟了哪些工作
+async def drain_application(application):
+    started = time.monotonic()
+    drain.begin()
+    logger.info(f"Draining before shutdown (deadline {drain.timeout}s)...")
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    try:
+        await asyncio.wait_for(application.update_queue.join(), drain.remaining())
+    except asyncio.TimeoutError:
+        logger.warning(f"{application.update_queue.qsize()} updates still queued at drain deadline.")
+    # 合并窗口中尚未同步的编辑 (这些任务不持久化)，立即执行
+    edit_jobs = [j for j in application.job_queue.jobs() if j.name and j.name.startswith("editsync_")]
+    for j in edit_jobs:
+        j.schedule_removal()
+    await drain.run([j.run(application) for j in edit_jobs], "edit sync")
+    drain.defer("outbox message", await outbox.drain(drain.remaining()))
+    await drain.finish_tasks()
+    search_index.flush()
+    db.commit()
+    drain.defer("stored job", job_store.pending_count())
+    logger.info(f"Drained in {time.monotonic() - started:.1f}s. Deferred until restart: {drain.summary()}")
+
+
+# 单机器人模式下的 SIGINT/SIGTERM：先排空再停止，再次收到信号时立即停止
+async def _drain_and_stop(application):
+    if drain.draining:
+        application.stop_running()
+        return
+    try:
+        await drain_application(application)
+    finally:
+        application.stop_running()
+
+
+def build_application(shard_index: int = 0, shard_count: int = 1, request=None, base_url: str = bot_api_base_url):
+    # 使用基于文件的持久化存储用户和聊天数据 (分片模式下每个 worker 使用独立文件)
+    if shard_count > 1:
+        persistence_path = f"./assets/{tenant.app_name}.shard{shard_index}.pickle"
+    else:
+        persistence_path = f"./assets/{tenant.app_name}.pickle"
+    pickle_persistence = PicklePersistence(filepath=persistence_path)
+
+    async def post_init(application):
+        watchdog.start()
+        monitor.watch(application)
+        monitor.start(_resource_gauges)
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(_profile_on_signal()))
+        if shard_count == 1 and not tenants_file:
+            # 替换 run_polling 默认的停止信号处理 (多租户模式由 run_tenants 统一排空)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(sig, lambda: application.create_task(_drain_and_stop(application)))
+                except NotImplementedError: # Windows 的事件循环不支持
+                    pass
+        search_index.setup()
+        await outbox.start(application.bot, shard_index, shard_count)
+        # 重新安排重启前未完成的延时任务
+        job_store.rehydrate(application.job_queue, shard_index, shard_count)
+        migrate_user_data(application)
+        topic_pool.split(shard_count)
+        if raid_detector.enabled:
+            raid_detector.split(shard_count)
+            quarantine.load()
+            max_user_id = db.query(func.max(User.user_id)).scalar()
+            raid_detector.note_known_user(max_user_id or 0)
+
+    async def post_shutdown(application):
+        watchdog.stop()
+        monitor.stop()
+        await outbox.stop()
+        search_index.flush()
 
     application = (
         ApplicationBuilder()
-        .token(bot_token)
+        .application_class(TimedApplication)
+        .token(tenant.bot_token)
+        .request(request or build_request()) # 多租户模式下各租户共用同一个连接池
+        .get_updates_request(build_request(get_updates=True))
         .persistence(persistence=pickle_persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .context_types(ContextTypes(context=TenantContext))
+        .base_url(base_url) # 自建的 Bot API 服务器 (测试中为本地的假 Bot API)
         # .concurrent_updates(True) # 可以考虑开启并发处理更新
         .build()
     )
 
     # --- 命令处理器 ---
     application.add_handler(CommandHandler("start", start, filters.ChatType.PRIVATE))
-    application.add_handler(CommandHandler("clear", clear, filters.Chat(admin_group_id) & filters.REPLY)) # clear 需要在话题内回复才能执行
-    application.add_handler(CommandHandler("broadcast", broadcast, filters.Chat(admin_group_id) & filters.REPLY)) # broadcast 需要回复
+    application.add_handler(CommandHandler("clear", clear, filters.Chat(tenant.admin_group_id) & filters.REPLY)) # clear 需要在话题内回复才能执行
+    application.add_handler(CommandHandler("broadcast", broadcast, filters.Chat(tenant.admin_group_id) & filters.REPLY)) # broadcast 需要回复
+    application.add_handler(CommandHandler("bulk", bulk, filters.Chat(tenant.admin_group_id))) # 批量管理多个对话
+    application.add_handler(CommandHandler("stats", stats, filters.Chat(tenant.admin_group_id))) # 回复耗时等统计
+    application.add_handler(CommandHandler("profile", profile, filters.Chat(tenant.admin_group_id))) # 采样分析事件循环
+    if search_index.enabled:
+        application.add_handler(CommandHandler("search", search, filters.Chat(tenant.admin_group_id))) # 搜索历史消息
 
     # --- 消息处理器 ---
     # 1. 用户发送 *新* 消息给机器人 (私聊)
@@ -1044,7 +1905,7 @@ if __name__ == "__main__":
     # 2. 管理员在话题中发送 *新* 消息 (管理群组)
     application.add_handler(
         MessageHandler(
-            filters.Chat(admin_group_id) & filters.IS_TOPIC_MESSAGE & ~filters.COMMAND & ~filters.UpdateType.EDITED_MESSAGE, # 确保是话题内消息
+            filters.Chat(tenant.admin_group_id) & filters.IS_TOPIC_MESSAGE & ~filters.COMMAND & ~filters.UpdateType.EDITED_MESSAGE, # 确保是话题内消息
             forwarding_message_a2u
         )
     )
@@ -1058,7 +1919,7 @@ if __name__ == "__main__":
     # 4. 管理员 *编辑* 话题中的消息 (管理群组)
     application.add_handler(
         MessageHandler(
-            filters.Chat(admin_group_id) & filters.IS_TOPIC_MESSAGE & filters.UpdateType.EDITED_MESSAGE, # 确保是话题内编辑
+            filters.Chat(tenant.admin_group_id) & filters.IS_TOPIC_MESSAGE & filters.UpdateType.EDITED_MESSAGE, # 确保是话题内编辑
             handle_edited_admin_message
         )
     )
@@ -1068,9 +1929,39 @@ if __name__ == "__main__":
         CallbackQueryHandler(callback_query_vcode, pattern="^vcode_")
     )
 
+    # --- 定时任务 ---
+    application.job_queue.run_repeating(_sweep_user_states, interval=600, first=600, name="sweep_user_states")
+    if search_index.enabled:
+        application.job_queue.run_repeating(_flush_search_index, interval=2, first=2, name="flush_search_index")
+        if search_index.retention_days:
+            application.job_queue.run_repeating(_purge_search_index, interval=86400, first=300, name="purge_search_index")
+    # 隔离区和话题池在共用的数据库中，只由 0 号分片维护，避免多个进程重复创建话题
+    if raid_detector.enabled and shard_index == 0:
+        application.job_queue.run_repeating(_release_quarantine, interval=60, first=60, name="release_quarantine")
+    if auto_close_idle_days > 0 and shard_index == 0:
+        application.job_queue.run_repeating(_auto_close_idle_topics, interval=3600, first=60, name="auto_close_idle_topics")
+    if topic_pool.enabled and shard_index == 0:
+        application.job_queue.run_repeating(
+            _maintain_topic_pool, interval=topic_pool.refill_interval, first=5, name="maintain_topic_pool"
+        )
+
     # --- 错误处理器 ---
     application.add_error_handler(error_handler)
+    return application
 
+
+# --- Main Execution ---
+if __name__ == "__main__":
     # --- 启动 Bot ---
     logger.info("Bot starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES) # 接收所有类型的更新
+    if tenants_file:
+        # 多租户模式：一个进程、一个事件循环运行多个机器人 (不支持与分片同时使用)
+        if shard_workers > 1:
+            logger.warning("SHARD_WORKERS is ignored in multi-tenant mode.")
+        run_tenants(build_application, load_tenants(tenants_file), Update.ALL_TYPES, build_request(), drain_application)
+    elif shard_workers > 1:
+        # 多进程分片模式：前端进程拉取更新，按用户/话题分发给各 worker (worker 按模块路径导入 build_application)
+        run_sharded(f"{__package__}.__main__:build_application", shard_workers, Update.ALL_TYPES)
+    else:
+        application = build_application()
+        application.run_polling(allowed_updates=Update.ALL_TYPES) # 接收所有类型的更新
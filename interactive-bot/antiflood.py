@@ -0,0 +1,99 @@
+import time
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "muted_until", "strikes", "last_strike", "notice_until")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.muted_until = 0.0
+        self.strikes = 0
+        self.last_strike = 0.0
+        self.notice_until = 0.0
+
+    def refill(self, rate: float, burst: float, now: float):
+        self.tokens = min(burst, self.tokens + max(0.0, now - self.updated) * rate)
+        self.updated = now
+
+
+class FloodGuard:
+    """内存中的防刷屏限流器：每用户令牌桶 + 逐级加长的临时禁言 + 全局入口上限。
+
+    check() 返回 (allowed, notice)：allowed 表示是否放行；被拒绝时 notice 为需要提示用户
+    的等待秒数，为 None 表示静默丢弃 (同一次禁言期间只提示一次，避免刷屏变成更多的出站请求)。
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = 3,
+        global_rate: float = 0,
+        global_burst: float = None,
+        mute_steps: tuple = (10, 60, 300, 1800),
+        strike_window: float = 600,
+        max_idle: float = 3600,
+    ):
+        self.rate = rate # 每秒补充的令牌数，0 表示不限制单个用户
+        self.burst = max(1, burst)
+        self.global_rate = global_rate # 全局每秒最多接收的消息数，0 表示不限制
+        self.global_burst = global_burst or max(1, global_rate)
+        self.mute_steps = mute_steps
+        self.strike_window = strike_window
+        self.max_idle = max_idle
+        self._buckets = {}
+        self._global = _Bucket(self.global_burst, time.monotonic())
+        self._checks = 0
+
+    def check(self, user_id: int, now: float = None):
+        now = time.monotonic() if now is None else now
+        self._checks += 1
+        if self._checks % 10000 == 0:
+            self.sweep(now)
+
+        bucket = None
+        if self.rate > 0:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+            if bucket.muted_until > now:
+                return False, self._notice(bucket, bucket.muted_until, now)
+            bucket.refill(self.rate, self.burst, now)
+            if bucket.tokens < 1:
+                # 超出突发额度：记一次违规，在窗口期内连续违规则禁言时间逐级加长
+                if now - bucket.last_strike > self.strike_window:
+                    bucket.strikes = 0
+                bucket.strikes += 1
+                bucket.last_strike = now
+                mute = self.mute_steps[min(bucket.strikes, len(self.mute_steps)) - 1]
+                bucket.muted_until = now + mute
+                return False, self._notice(bucket, bucket.muted_until, now)
+
+        if self.global_rate > 0:
+            self._global.refill(self.global_rate, self.global_burst, now)
+            if self._global.tokens < 1:
+                # 全局过载不计入用户违规，仅提示稍后再试
+                retry_at = now + (1 - self._global.tokens) / self.global_rate
+                return False, self._notice(bucket, retry_at, now) if bucket else None
+            self._global.tokens -= 1
+
+        if bucket:
+            bucket.tokens -= 1
+        return True, None
+
+    def _notice(self, bucket: _Bucket, until: float, now: float):
+        if bucket.notice_until > now:
+            return None
+        bucket.notice_until = until
+        return max(1, round(until - now))
+
+    def sweep(self, now: float = None):
+        """清理长时间空闲且未被禁言的用户状态，保持内存占用有界。"""
+        now = time.monotonic() if now is None else now
+        idle = [
+            uid for uid, b in self._buckets.items()
+            if b.muted_until <= now and now - b.updated > self.max_idle
+        ]
+        for uid in idle:
+            del self._buckets[uid]
+        return len(idle)
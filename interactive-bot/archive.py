@@ -0,0 +1,155 @@
+import argparse
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, insert, or_, select, tuple_
+
+from db.database import SessionMaker, current_database
+from db.model import Base, MessageMap, User
+
+from . import logger
+
+ARCHIVE_DIR = "./assets/archive"
+BATCH_SIZE = 5000
+
+# 归档文件格式：gzip 压缩的 JSONL，只追加不修改。每行是一个批次，按列存放：
+# {"table": "message_map", "columns": {"id": [...], "user_id": [...], ...}}
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _write_batch(f, model, rows):
+    columns = [c.name for c in model.__table__.columns]
+    batch = {
+        "table": model.__tablename__,
+        "columns": {name: [_encode(getattr(r, name)) for r in rows] for name in columns},
+    }
+    f.write(json.dumps(batch, ensure_ascii=False, separators=(",", ":")) + "\n")
+    # 先落盘再删除数据库中的记录：flush 只写入操作系统缓存，断电时可能丢失
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _export_query(f, model, criteria, batch_size: int) -> int:
+    """按主键分页导出符合条件的记录，每批写入文件后立即从数据库删除。"""
+    exported = 0
+    last_id = 0
+    while True:
+        with SessionMaker() as session:
+            rows = (
+                session.query(model)
+                .filter(*criteria, model.id > last_id)
+                .order_by(model.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                return exported
+            _write_batch(f, model, rows)
+            ids = [r.id for r in rows]
+            session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            session.commit()
+            last_id = ids[-1]
+            exported += len(rows)
+
+
+def export_inactive(days: int, out_dir: str = ARCHIVE_DIR, batch_size: int = BATCH_SIZE):
+    """把超过 days 天没有活动的用户的消息映射，以及其中没有话题的用户记录导出到归档文件。
+
+    返回 (归档文件路径, 导出的消息映射数, 导出的用户数)。
+    """
+    cutoff = datetime.now() - timedelta(days=days)
+    inactive = User.last_active_at < cutoff
+    # 子查询在 SQLite 中执行，不把用户列表读入内存
+    inactive_users = select(User.user_id).where(inactive)
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"archive-{datetime.now():%Y%m%d-%H%M%S}.jsonl.gz")
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        maps = _export_query(f, MessageMap, [MessageMap.user_id.in_(inactive_users)], batch_size)
+        users = _export_query(
+            f, User, [inactive, or_(User.message_thread_id == 0, User.message_thread_id.is_(None))], batch_size
+        )
+    if not maps and not users:
+        os.remove(path)
+        path = None
+    return path, maps, users
+
+
+def _drop_existing_maps(session, rows: list) -> list:
+    """去掉数据库中已有的消息映射 (同一用户、同一条群组消息)，重复导入同一文件时不产生重复记录。"""
+    keys = {(r["user_id"], r["group_chat_message_id"]) for r in rows}
+    existing = set(session.execute(
+        select(MessageMap.user_id, MessageMap.group_chat_message_id)
+        .where(tuple_(MessageMap.user_id, MessageMap.group_chat_message_id).in_(keys))
+    ).tuples())
+    return [r for r in rows if (r["user_id"], r["group_chat_message_id"]) not in existing]
+
+
+def import_archive(path: str) -> int:
+    """把归档文件导回数据库，逐批插入，已存在的记录会被跳过。
+
+    自增主键不导入，由数据库重新分配：导出后删除的主键可能已被新记录使用 (主键没有 AUTOINCREMENT)，
+    沿用旧值会与新记录冲突而被跳过。用户按唯一的 user_id、消息映射按 (user_id, 群组消息 ID) 判断是否已存在。
+    返回实际插入的记录数。
+    """
+    tables = Base.metadata.tables
+    imported = 0
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            batch = json.loads(line)
+            table = tables[batch["table"]]
+            columns = {
+                name: values for name, values in batch["columns"].items()
+                if name in table.columns and not table.columns[name].primary_key
+            }
+            for name, values in columns.items():
+                if isinstance(table.columns[name].type, DateTime):
+                    columns[name] = [datetime.fromisoformat(v) if v else None for v in values]
+            names = list(columns)
+            rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+            if not rows:
+                continue
+            with SessionMaker() as session:
+                if table is MessageMap.__table__:
+                    rows = _drop_existing_maps(session, rows)
+                    if not rows:
+                        continue
+                result = session.execute(insert(table).prefix_with("OR IGNORE"), rows)
+                session.commit()
+            imported += result.rowcount
+    return imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m interactive-bot.archive",
+        description="导出/导入不活跃用户的对话记录",
+    )
+    parser.add_argument("--database", help="多租户模式下租户的数据库名 (默认使用 ./assets/db.sqlite3)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", help="导出并从数据库中删除不活跃用户的记录")
+    p_export.add_argument("--days", type=int, required=True, help="超过多少天没有活动视为不活跃")
+    p_export.add_argument("--out", default=ARCHIVE_DIR, help="归档文件目录")
+    p_export.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    p_import = sub.add_parser("import", help="把归档文件导回数据库")
+    p_import.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+    current_database.set(args.database)
+
+    if args.command == "export":
+        path, maps, users = export_inactive(args.days, args.out, args.batch_size)
+        if path:
+            logger.info(f"Archived {maps} message maps and {users} users to {path}.")
+        else:
+            logger.info("Nothing to archive.")
+    else:
+        for path in args.files:
+            logger.info(f"Imported {import_archive(path)} archived rows from {path} (existing rows skipped).")
+
+
+if __name__ == "__main__":
+    main()
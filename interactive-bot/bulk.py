@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+from aiolimiter import AsyncLimiter
+from telegram.error import BadRequest, RetryAfter
+
+from db.database import SessionMaker
+from db.model import MessageMap
+
+from . import bulk_api_rate, bulk_concurrency, logger
+from .tenant import TenantLocal
+
+# 批量操作共用的限速器和并发上限，给正常的消息转发留出 API 配额 (API 配额按机器人计算，每个租户各一份)
+api_limiter = TenantLocal(lambda: AsyncLimiter(bulk_api_rate, 1))
+api_semaphore = TenantLocal(lambda: asyncio.Semaphore(bulk_concurrency))
+
+DELETE_BATCH_SIZE = 100 # Telegram 一次最多删除 100 条
+
+
+def iter_message_map_pages(user_id: int, page_size: int = 1000):
+    """按主键分页读取用户的消息映射，每页返回 [(map_id, user_chat_message_id)]。
+
+    使用 id > last_id 的键集分页而不是长时间打开的游标，内存占用恒定，
+    也不会在删除过程中一直持有 SQLite 的读锁。
+    """
+    last_id = 0
+    while True:
+        with SessionMaker() as session:
+            rows = (
+                session.query(MessageMap.id, MessageMap.user_chat_message_id)
+                .filter(MessageMap.user_id == user_id, MessageMap.id > last_id)
+                .order_by(MessageMap.id)
+                .limit(page_size)
+                .all()
+            )
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+async def call_limited(func, *args, **kwargs):
+    """在限速器和并发上限内调用一次 Bot API，遇到 RetryAfter 时等待后重试一次。"""
+    async with api_semaphore:
+        async with api_limiter:
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                return await func(*args, **kwargs)
+
+
+async def delete_messages_in_batches(bot, chat_id: int, message_ids: list) -> int:
+    """并发分批删除消息，返回成功删除的条数。"""
+    message_ids = list(dict.fromkeys(mid for mid in message_ids if mid)) # 去重，避免 "Message ids must be unique"
+    batches = [message_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(message_ids), DELETE_BATCH_SIZE)]
+
+    async def _delete(batch):
+        try:
+            if await call_limited(bot.delete_messages, chat_id=chat_id, message_ids=batch):
+                return len(batch)
+            logger.warning(f"Failed to delete a batch of messages for chat {chat_id}.")
+        except BadRequest as e:
+            # 如果是 "Message can't be deleted"，可能是消息太旧或权限问题
+            logger.warning(f"Error deleting messages batch for chat {chat_id}: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error deleting messages for chat {chat_id}: {e}", exc_info=True)
+        return 0
+
+    return sum(await asyncio.gather(*[_delete(b) for b in batches]))
+
+
+async def clear_user_messages(bot, user_id: int, on_progress=None, progress_interval: float = 3.0):
+    """删除用户私聊中所有已映射的消息并清理映射记录，返回 (已删除数, 总数)。
+
+    on_progress(deleted, total) 最多每 progress_interval 秒调用一次。
+    """
+    deleted = 0
+    total = 0
+    last_report = time.monotonic()
+    for page in iter_message_map_pages(user_id):
+        total += len(page)
+        deleted += await delete_messages_in_batches(bot, user_id, [mid for _, mid in page])
+        # 每页处理完即删除对应的映射记录，事务保持短小
+        with SessionMaker() as session:
+            session.query(MessageMap).filter(
+                MessageMap.id.in_([map_id for map_id, _ in page])
+            ).delete(synchronize_session=False)
+            session.commit()
+        if on_progress and time.monotonic() - last_report >= progress_interval:
+            last_report = time.monotonic()
+            try:
+                await on_progress(deleted, total)
+            except Exception as e:
+                logger.debug(f"Failed to report clear progress for user {user_id}: {e}")
+    return deleted, total
+
+
+async def apply_to_topics(func, chat_id: int, thread_ids: list, ok_errors: tuple = ()) -> list:
+    """对多个话题并发执行同一个话题操作 (关闭/重开/删除)，返回成功的话题 ID 列表。
+
+    ok_errors 中的错误 (如话题本来就已关闭) 视为成功。
+    """
+
+    async def _apply(thread_id):
+        try:
+            await call_limited(func, chat_id=chat_id, message_thread_id=thread_id)
+            return thread_id
+        except BadRequest as e:
+            if any(err in str(e).lower() for err in ok_errors):
+                return thread_id
+            logger.warning(f"Bulk {func.__name__} failed for topic {thread_id}: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error in bulk {func.__name__} for topic {thread_id}: {e}", exc_info=True)
+        return None
+
+    results = await asyncio.gather(*[_apply(t) for t in thread_ids])
+    return [t for t in results if t]
+
+
+def chunked(items: list, size: int = 500):
+    """按固定大小切分列表，避免超出 SQLite 单条语句的参数上限。"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,84 @@
+import base64
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+
+CALLBACK_PREFIX = "vcode"
+
+# verify_callback() 的结果
+OK = "ok"
+WRONG = "wrong"
+EXPIRED = "expired"
+NOT_YOURS = "not_yours"
+INVALID = "invalid"
+
+
+def timestamp_ms(now: float = None) -> int:
+    return int((time.time() if now is None else now) * 1000)
+
+
+def captcha_key(bot_token: str) -> bytes:
+    """从机器人令牌派生验证码的签名密钥：每个机器人不同，重启后不变，不需要额外配置。"""
+    return hashlib.sha256(b"captcha:" + bot_token.encode()).digest()
+
+
+def _sign(key: bytes, user_id: int, issued_at: int, answer: str) -> str:
+    mac = hmac.new(key, f"{user_id}:{issued_at}:{answer}".encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(mac).decode() # 12 字节正好 16 个字符，没有填充
+
+
+def challenge_callback_data(key: bytes, user_id: int, answer: str, choices: list, issued_at: int) -> list:
+    """为每个选项生成回调数据 vcode_<选项>_<用户 ID>_<发出时间 (毫秒)>_<签名> (不超过 Telegram 的 64 字节限制)。
+
+    签名由正确答案计算，所有按钮携带同一个签名，因此不会泄露哪个选项正确；
+    校验时用点击的选项重新计算签名即可，答案不需要保存在服务端。
+    """
+    token = _sign(key, user_id, issued_at, answer)
+    return [f"{CALLBACK_PREFIX}_{choice}_{user_id}_{issued_at}_{token}" for choice in choices]
+
+
+def verify_callback(key: bytes, data: str, user_id: int, ttl: float, not_before: int = 0, now: float = None) -> str:
+    """校验回调数据。发出超过 ttl 秒，或发出时间早于 not_before (毫秒，该用户最新一次发出验证码
+    或答错的时间) 的验证码视为过期，因此同一时间只有最新的一个验证码有效。"""
+    parts = data.split("_", 4) # 签名是 base64url，可能包含 "_"，放在最后
+    if len(parts) == 3:
+        return EXPIRED # 旧版本发出的验证码
+    if len(parts) != 5 or parts[0] != CALLBACK_PREFIX:
+        return INVALID
+    _, choice, target_user_id, issued_at, token = parts
+    if target_user_id != str(user_id):
+        return NOT_YOURS
+    try:
+        issued_at = int(issued_at)
+    except ValueError:
+        return INVALID
+    if issued_at < not_before or issued_at + ttl * 1000 <= timestamp_ms(now):
+        return EXPIRED
+    if hmac.compare_digest(_sign(key, user_id, issued_at, choice), token):
+        return OK
+    return WRONG
+
+
+class CallbackDeduper:
+    """同一条验证码消息在 ttl 秒内只处理第一次点击，重复点击不再调用 API。"""
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict() # 键 -> 过期时间，ttl 固定，插入顺序即过期顺序 (从头部淘汰，普通字典反复删除头部会越来越慢)
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def first(self, key, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        while self._seen:
+            oldest, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) < self.max_size:
+                break
+            self._seen.popitem(last=False)
+        if key in self._seen:
+            return False
+        self._seen[key] = now + self.ttl
+        return True
@@ -0,0 +1,54 @@
+import asyncio
+import collections
+import time
+
+
+class Drain:
+    """停机排空：收到停止信号后在 timeout 秒内完成或保存进行中的工作。
+
+    长时间运行的任务用 track() 登记，循环中检查 draining 以便保存进度后提前结束；
+    未能在截止时间前完成的工作用 defer() 计数，停机时汇总报告，重启后继续。
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.draining = False
+        self.deferred = collections.Counter()
+        self._deadline = 0.0
+        self._tasks = {} # 后台任务 -> 种类
+
+    def begin(self):
+        self.draining = True
+        self._deadline = time.monotonic() + self.timeout
+
+    def remaining(self) -> float:
+        return max(0.0, self._deadline - time.monotonic())
+
+    def track(self, task: asyncio.Task, kind: str) -> asyncio.Task:
+        self._tasks[task] = kind
+        task.add_done_callback(lambda t: self._tasks.pop(t, None))
+        return task
+
+    def defer(self, kind: str, count: int = 1):
+        if count:
+            self.deferred[kind] += count
+
+    async def run(self, coros: list, kind: str):
+        """在剩余时间内执行这些协程，超时未完成的取消并计入推迟。"""
+        await self._wait({asyncio.ensure_future(c): kind for c in coros})
+
+    async def finish_tasks(self):
+        """等待登记的后台任务完成，到截止时间仍未完成的取消并计入推迟。"""
+        await self._wait(dict(self._tasks))
+
+    async def _wait(self, tasks: dict):
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=self.remaining())
+        for task in pending:
+            self.defer(tasks[task])
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def summary(self) -> str:
+        return ", ".join(f"{kind} {count}" for kind, count in self.deferred.items()) or "nothing"
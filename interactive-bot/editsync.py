@@ -0,0 +1,80 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+from telegram import (
+    InputMediaAnimation,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
+
+
+def media_unique_id(message):
+    """返回消息中可替换媒体的 file_unique_id，没有媒体时返回 None。"""
+    if message.photo:
+        return message.photo[-1].file_unique_id
+    for attachment in (message.animation, message.video, message.audio, message.document):
+        if attachment:
+            return attachment.file_unique_id
+    return None
+
+
+def edit_digest(message) -> tuple:
+    """返回 (媒体 file_unique_id, 文本/说明文字及其格式的摘要)，用于判断编辑是否需要同步。"""
+    if message.text is not None:
+        parts = ["text", message.text, [e.to_dict() for e in message.entities]]
+    else:
+        parts = ["caption", message.caption, [e.to_dict() for e in message.caption_entities]]
+    text_hash = hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    return media_unique_id(message), text_hash
+
+
+def input_media_of(message):
+    """把消息中的媒体转换为 edit_message_media 使用的 InputMedia (复用 file_id，不重新上传)。"""
+    caption = {"caption": message.caption, "caption_entities": message.caption_entities}
+    spoiler = bool(message.has_media_spoiler)
+    if message.photo:
+        return InputMediaPhoto(message.photo[-1].file_id, has_spoiler=spoiler, **caption)
+    # 动图消息同时带有 document 字段，需要先判断
+    if message.animation:
+        return InputMediaAnimation(message.animation.file_id, has_spoiler=spoiler, **caption)
+    if message.video:
+        return InputMediaVideo(message.video.file_id, has_spoiler=spoiler, **caption)
+    if message.audio:
+        return InputMediaAudio(message.audio.file_id, **caption)
+    if message.document:
+        return InputMediaDocument(message.document.file_id, **caption)
+    return None
+
+
+class EditCoalescer:
+    """合并短时间内对同一条目标消息的多次编辑，只同步最后一个版本。
+
+    目标消息以 (chat_id, message_id) 为键。第一次编辑到达时由调用方安排一次延时同步，
+    窗口内的后续编辑只替换待同步的内容；同步时若内容摘要与上次成功同步的相同则跳过 API 调用。
+    """
+
+    def __init__(self, max_hashes: int = 100000):
+        self.max_hashes = max_hashes
+        self._pending = {} # 目标消息 -> 待同步的内容
+        self._synced = OrderedDict() # 目标消息 -> 上次成功同步的内容摘要，按更新顺序淘汰
+
+    def submit(self, target: tuple, payload) -> bool:
+        """登记一次编辑，返回是否需要安排新的同步任务 (窗口内已有任务时返回 False)。"""
+        first = target not in self._pending
+        self._pending[target] = payload
+        return first
+
+    def take(self, target: tuple):
+        return self._pending.pop(target, None)
+
+    def last_synced(self, target: tuple):
+        return self._synced.get(target)
+
+    def mark_synced(self, target: tuple, digest: tuple):
+        self._synced[target] = digest
+        self._synced.move_to_end(target)
+        while len(self._synced) > self.max_hashes:
+            self._synced.popitem(last=False)
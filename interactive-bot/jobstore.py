@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+from db.database import SessionMaker
+from db.model import ScheduledJob
+
+from . import logger
+
+
+class JobDeferred(Exception):
+    """任务回调在停机前保存进度后抛出，保留任务记录，重启后由 rehydrate() 继续执行。"""
+
+
+class JobStore:
+    """持久化的延时任务：任务记录先写入数据库，再交给 job_queue 执行，执行完成后删除记录。
+
+    每种任务 (kind) 注册一个回调 callback(context, job)，job 是 ScheduledJob 记录。
+    进程重启后 rehydrate() 按到期时间重新安排未完成的任务，停机期间已到期的任务按限定速率补执行。
+    """
+
+    def __init__(self, catch_up_rate: float = 5):
+        self.catch_up_rate = catch_up_rate # 补执行过期任务的速率 (个/秒)
+        self._callbacks = {}
+
+    def register(self, kind: str, callback):
+        self._callbacks[kind] = callback
+
+    def schedule(
+        self,
+        job_queue,
+        kind: str,
+        delay: float,
+        name: str,
+        chat_id: int = None,
+        target_id: int = None,
+        ref_id: int = None,
+        arg: int = None,
+        replace: bool = False,
+    ) -> str:
+        """登记并安排一个任务，replace=True 时先取消同名的旧任务。"""
+        with SessionMaker() as session:
+            if replace:
+                self._cancel(session, job_queue, name)
+            job = ScheduledJob(
+                name=name,
+                kind=kind,
+                chat_id=chat_id,
+                target_id=target_id,
+                ref_id=ref_id,
+                arg=arg,
+                due_at=datetime.now() + timedelta(seconds=delay),
+            )
+            session.add(job)
+            session.commit()
+            job_queue.run_once(self._run, delay, name=name, data=job.id)
+        return name
+
+    def cancel(self, job_queue, name: str) -> bool:
+        with SessionMaker() as session:
+            removed = self._cancel(session, job_queue, name)
+            session.commit()
+        return removed
+
+    def _cancel(self, session, job_queue, name: str) -> bool:
+        removed = session.query(ScheduledJob).filter(ScheduledJob.name == name).delete(synchronize_session=False)
+        for job in job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+            removed = True
+        return bool(removed)
+
+    def checkpoint(self, job_id: int, arg: int):
+        """保存长任务的进度，重启后从该进度继续。"""
+        with SessionMaker() as session:
+            session.query(ScheduledJob).filter(ScheduledJob.id == job_id).update(
+                {ScheduledJob.arg: arg}, synchronize_session=False
+            )
+            session.commit()
+
+    def rehydrate(self, job_queue, shard_index: int = 0, shard_count: int = 1) -> int:
+        """重新安排数据库中未完成的任务 (分片模式下按 chat_id 分配给各分片)，返回安排的任务数。"""
+        now = datetime.now()
+        overdue = 0
+        count = 0
+        with SessionMaker() as session:
+            jobs = session.query(ScheduledJob).order_by(ScheduledJob.due_at, ScheduledJob.id).all()
+            for job in jobs:
+                if abs(job.chat_id or 0) % shard_count != shard_index:
+                    continue
+                if job.kind not in self._callbacks:
+                    logger.warning(f"Dropping stored job {job.name} of unknown kind {job.kind}")
+                    session.delete(job)
+                    continue
+                delay = (job.due_at - now).total_seconds() if job.due_at else 0
+                if delay <= 0:
+                    # 停机期间已到期：按顺序错开执行，避免启动时瞬间发出大量请求
+                    delay = overdue / self.catch_up_rate
+                    overdue += 1
+                job_queue.run_once(self._run, delay, name=job.name, data=job.id)
+                count += 1
+            session.commit()
+        if count:
+            logger.info(f"Rehydrated {count} stored jobs ({overdue} overdue).")
+        return count
+
+    async def _run(self, context):
+        job_id = context.job.data
+        with SessionMaker(expire_on_commit=False) as session:
+            job = session.get(ScheduledJob, job_id)
+        if not job:
+            return # 已被取消或替换
+        deferred = False
+        try:
+            await self._callbacks[job.kind](context, job)
+        except JobDeferred:
+            deferred = True
+            logger.info(f"Stored job {job.name} ({job.kind}) deferred until restart.")
+        except Exception as e:
+            logger.error(f"Stored job {job.name} ({job.kind}) failed: {e}", exc_info=True)
+        finally:
+            if not deferred:
+                self._delete(job_id)
+
+    def _delete(self, job_id: int):
+        with SessionMaker() as session:
+            session.query(ScheduledJob).filter(ScheduledJob.id == job_id).delete(synchronize_session=False)
+            session.commit()
+
+    def exists(self, name: str) -> bool:
+        """任务是否仍未执行完成 (记录在回调结束后才删除)。"""
+        with SessionMaker() as session:
+            return session.query(ScheduledJob.id).filter(ScheduledJob.name == name).first() is not None
+
+    def pending_count(self) -> int:
+        with SessionMaker() as session:
+            return session.query(ScheduledJob).count()
+
+
+job_store = JobStore()
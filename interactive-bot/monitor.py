@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import gc
+import os
+import time
+
+from telegram.ext import Application
+
+from . import logger, monitor_interval, monitor_rss_growth_mb
+
+MB = 1024 * 1024
+
+
+def current_rss() -> int:
+    """当前进程的常驻内存 (字节)，无法获取时 (非 Linux) 返回 0。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def object_counts() -> collections.Counter:
+    """按类型统计 gc 跟踪的对象数量 (需要遍历整个堆，只在采样时调用)。"""
+    return collections.Counter(type(o).__qualname__ for o in gc.get_objects())
+
+
+class ResourceMonitor:
+    """长时间运行的资源采样：定期记录 RSS、各类型对象数量、任务数、会话缓存等指标和更新处理耗时，
+    与第一次采样的基线比较，内存增长或处理耗时超过阈值时记录警告，并列出增长最多的对象类型。
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        rss_growth_mb: float = 256,
+        latency_factor: float = 3,
+        min_latency: float = 0.2,
+        top_types: int = 8,
+    ):
+        self.interval = interval # 采样间隔 (秒)，0 表示关闭
+        self.rss_growth_mb = rss_growth_mb
+        self.latency_factor = latency_factor
+        self.min_latency = min_latency # 平均耗时低于此值时不报警
+        self.top_types = top_types
+        self.applications = []
+        self.last_sample = None
+        self._gauges = None
+        self._task = None
+        self._baseline_rss = None
+        self._baseline_counts = None
+        self._baseline_latency = None
+        self._reset_window()
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def _reset_window(self):
+        self._updates = 0
+        self._update_seconds = 0.0
+        self._update_max = 0.0
+
+    def watch(self, application: Application):
+        if application not in self.applications:
+            self.applications.append(application)
+
+    def start(self, gauges=None):
+        """在事件循环中调用，gauges() 返回额外的 {指标名: 数值}。重复调用无效。
+        未开启定期采样时只记录 gauges，供 sample() 手动采样 (soak 测试) 使用。"""
+        self._gauges = gauges
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run(), name="resource-monitor")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def observe_update(self, seconds: float):
+        self._updates += 1
+        self._update_seconds += seconds
+        self._update_max = max(self._update_max, seconds)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Resource sampling failed: {e}", exc_info=True)
+
+    def sample(self) -> dict:
+        rss = current_rss()
+        counts = object_counts()
+        updates = self._updates
+        latency = self._update_seconds / updates if updates else None
+        peak = self._update_max
+        self._reset_window()
+
+        gauges = {
+            "jobs": sum(len(a.job_queue.jobs()) for a in self.applications if a.job_queue),
+            "user_data": sum(len(a.user_data) for a in self.applications),
+            "chat_data": sum(len(a.chat_data) for a in self.applications),
+            "tasks": len(asyncio.all_tasks()),
+        }
+        if self._gauges:
+            gauges.update(self._gauges())
+
+        if self._baseline_rss is None:
+            self._baseline_rss = rss
+            self._baseline_counts = counts
+        if self._baseline_latency is None and latency is not None:
+            self._baseline_latency = latency
+        growth = (counts - self._baseline_counts).most_common(self.top_types)
+        rss_growth = rss - self._baseline_rss
+
+        self.last_sample = {
+            "rss": rss,
+            "rss_growth": rss_growth,
+            "objects": sum(counts.values()),
+            "updates": updates,
+            "latency": latency,
+            "latency_max": peak,
+            "growth": growth,
+            **gauges,
+        }
+        logger.info(
+            f"Resources: rss {rss / MB:.1f}MB ({rss_growth / MB:+.1f}), objects {sum(counts.values())}, "
+            f"updates {updates} avg {(latency or 0) * 1000:.1f}ms max {peak * 1000:.0f}ms, "
+            + ", ".join(f"{k} {v}" for k, v in gauges.items())
+        )
+        growth_text = ", ".join(f"{name} +{n}" for name, n in growth) or "none"
+        if rss and rss_growth > self.rss_growth_mb * MB:
+            logger.warning(f"RSS grew {rss_growth / MB:.1f}MB since the first sample. Fastest-growing types: {growth_text}")
+        if (
+            latency is not None
+            and self._baseline_latency
+            and latency > self.min_latency
+            and latency > self._baseline_latency * self.latency_factor
+        ):
+            logger.warning(
+                f"Average update latency {latency * 1000:.0f}ms is over {self.latency_factor}x "
+                f"the baseline {self._baseline_latency * 1000:.0f}ms. Fastest-growing types: {growth_text}"
+            )
+        return self.last_sample
+
+
+# 进程内共用 (多租户模式下汇总所有 Application)
+monitor = ResourceMonitor(monitor_interval * 60, monitor_rss_growth_mb)
+
+
+class TimedApplication(Application):
+    """记录每个更新的处理耗时，供 monitor 检测性能退化。"""
+
+    async def process_update(self, update: object) -> None:
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            monitor.observe_update(time.perf_counter() - started)
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+
+class MessageMapCache:
+    """最近消息映射的双向内存索引：(用户 ID, 用户侧消息 ID) <-> 群组侧消息 ID。
+
+    两侧都用整数作键 (用户 ID 与消息 ID 打包成一个整数)，不创建元组或 ORM 对象，
+    按条目数量限制大小，超出后淘汰最久未使用的条目。未命中时由调用方回退到数据库查询。
+    LRU 顺序用 OrderedDict 维护：普通字典反复从头部删除会留下空槽，next(iter()) 每次都要跳过它们，缓存满后淘汰越来越慢。
+    """
+
+    __slots__ = ("capacity", "hits", "misses", "_u2g", "_g2u")
+
+    def __init__(self, capacity: int = 200000):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._u2g = OrderedDict() # 打包键 -> 群组侧消息 ID，顺序即 LRU 顺序
+        self._g2u = {} # 群组侧消息 ID -> 打包键
+
+    @staticmethod
+    def _pack(user_id: int, user_msg_id: int) -> int:
+        return (user_id << 32) | user_msg_id # 消息 ID 不超过 2^31
+
+    def __len__(self) -> int:
+        return len(self._u2g)
+
+    def put(self, user_id: int, user_msg_id: int, group_msg_id: int):
+        if self.capacity <= 0 or not user_msg_id or not group_msg_id:
+            return
+        key = self._pack(user_id, user_msg_id)
+        old = self._u2g.pop(key, None)
+        if old is not None:
+            self._g2u.pop(old, None)
+        self._u2g[key] = group_msg_id
+        self._g2u[group_msg_id] = key
+        while len(self._u2g) > self.capacity:
+            _, oldest = self._u2g.popitem(last=False)
+            self._g2u.pop(oldest, None)
+
+    def group_msg_id(self, user_id: int, user_msg_id: int):
+        key = self._pack(user_id, user_msg_id)
+        group_msg_id = self._u2g.get(key)
+        if group_msg_id is None:
+            self.misses += 1
+            return None
+        self._u2g.move_to_end(key) # 标记为最近使用
+        self.hits += 1
+        return group_msg_id
+
+    def user_msg(self, group_msg_id: int):
+        """返回 (用户 ID, 用户侧消息 ID)，未命中返回 None。"""
+        key = self._g2u.get(group_msg_id)
+        if key is None:
+            self.misses += 1
+            return None
+        self._u2g.move_to_end(key)
+        self.hits += 1
+        return key >> 32, key & 0xFFFFFFFF
+
+    def drop_user(self, user_id: int):
+        """删除某个用户的全部条目 (清理对话后调用)。"""
+        for key in [k for k in self._u2g if k >> 32 == user_id]:
+            self._g2u.pop(self._u2g.pop(key), None)
@@ -0,0 +1,61 @@
+import httpx
+from telegram.request import HTTPXRequest
+
+from . import (
+    http2_enabled,
+    http_connect_timeout,
+    http_keepalive_expiry,
+    http_pool_size,
+    http_pool_timeout,
+    http_read_timeout,
+    http_write_timeout,
+    get_updates_pool_size,
+)
+
+
+class TunedHTTPXRequest(HTTPXRequest):
+    """在 PTB 默认 HTTPXRequest 的基础上允许设置 keep-alive 空闲连接的过期时间。"""
+
+    def __init__(self, keepalive_expiry: float = 5.0, **kwargs):
+        # 父类构造函数会调用 _build_client，需先设置
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(**kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs["limits"]
+        client_kwargs = dict(
+            self._client_kwargs,
+            limits=httpx.Limits(
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=self._keepalive_expiry,
+            ),
+        )
+        return httpx.AsyncClient(**client_kwargs)
+
+
+def build_request(get_updates: bool = False) -> TunedHTTPXRequest:
+    """按配置创建 Bot API 请求对象。getUpdates 使用独立的小连接池。"""
+    return TunedHTTPXRequest(
+        connection_pool_size=get_updates_pool_size if get_updates else http_pool_size,
+        connect_timeout=http_connect_timeout,
+        read_timeout=http_read_timeout,
+        write_timeout=http_write_timeout,
+        pool_timeout=http_pool_timeout,
+        http_version="2" if http2_enabled else "1.1",
+        keepalive_expiry=http_keepalive_expiry,
+    )
+
+
+def build_client(timeout: float) -> httpx.AsyncClient:
+    """分片前端直接使用的 httpx 客户端，沿用相同的 HTTP/2 与 keep-alive 设置。"""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=http_connect_timeout, pool=http_pool_timeout),
+        limits=httpx.Limits(
+            max_connections=get_updates_pool_size,
+            max_keepalive_connections=get_updates_pool_size,
+            keepalive_expiry=http_keepalive_expiry,
+        ),
+        http1=not http2_enabled,
+        http2=http2_enabled,
+    )
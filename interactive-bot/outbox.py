@@ -0,0 +1,206 @@
+import asyncio
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from db.database import SessionMaker
+from db.model import OutboxMessage
+
+from . import logger
+
+
+class Outbox:
+    """持久化发件箱：消息先落库，再由 worker 池按用户顺序投递，临时错误自动重试。
+
+    deliver(bot, session, item) 负责实际发送并在 session 中写入映射，
+    on_failed(bot, item, error) 在消息最终投递失败时调用。
+    分片模式下每个进程只投递属于本分片的用户；其他进程 (例如 0 号分片的隔离区放行任务) 写入的消息
+    由所属分片定期检查数据库后接手，同一条消息不会被两个进程同时投递。
+    """
+
+    def __init__(self, deliver, on_failed, workers: int = 4, max_attempts: int = 8, poll_interval: float = 5):
+        self._deliver = deliver
+        self._on_failed = on_failed
+        self._workers = max(1, workers)
+        self._max_attempts = max(1, max_attempts)
+        self._poll_interval = poll_interval
+        self._shard_index = 0
+        self._shard_count = 1
+        self._queue: asyncio.Queue = None
+        self._scheduled = set() # 已排队或正在投递的用户，保证同一用户的消息串行有序
+        self._backoff = set() # 等待重试的用户，退避结束前新消息不会提前触发重试
+        self._tasks = []
+        self._poller = None
+        self._bot = None
+        self._stopping = False
+
+    async def start(self, bot, shard_index: int = 0, shard_count: int = 1):
+        self._bot = bot
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"outbox-{i}") for i in range(self._workers)]
+        # 重启后立即排空积压的消息
+        resumed = self._resume_pending()
+        if resumed:
+            logger.info(f"Outbox resumed pending messages for {resumed} users.")
+        if shard_count > 1:
+            self._poller = asyncio.create_task(self._poll_pending(), name="outbox-poll")
+
+    def _owns(self, user_id: int) -> bool:
+        return abs(user_id) % self._shard_count == self._shard_index
+
+    def _resume_pending(self) -> int:
+        """为数据库中有待投递消息、属于本分片且未在排队的用户安排投递，返回用户数。"""
+        with SessionMaker() as session:
+            user_ids = [row[0] for row in session.query(OutboxMessage.user_id).distinct()]
+        user_ids = [
+            uid for uid in user_ids
+            if self._owns(uid) and uid not in self._scheduled and uid not in self._backoff
+        ]
+        for user_id in user_ids:
+            self._signal(user_id)
+        return len(user_ids)
+
+    async def _poll_pending(self):
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                self._resume_pending()
+            except Exception as e:
+                logger.warning(f"Outbox failed to check pending messages: {e}")
+
+    async def drain(self, timeout: float) -> int:
+        """停机前在 timeout 秒内投递已排队的消息，正在发送的消息发完后才停止 worker。
+        返回仍留在数据库中 (重启后继续投递) 的消息数。"""
+        if self._queue is not None and self._tasks:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            # 不再开始新的投递，worker 处理完手上的消息后退出 (至少留 1 秒给正在进行的请求)
+            self._stopping = True
+            for _ in self._tasks:
+                self._queue.put_nowait(None)
+            await asyncio.wait(self._tasks, timeout=max(1.0, deadline - loop.time()))
+        await self.stop()
+        with SessionMaker() as session:
+            return session.query(OutboxMessage).count()
+
+    async def stop(self):
+        tasks = self._tasks + ([self._poller] if self._poller else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._poller = None
+
+    async def wait_idle(self, user_id: int, timeout: float = 10):
+        """等待该用户已写入的消息投递完成 (或超时)。消息可能由其他分片进程投递，因此以数据库中的记录为准。"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline and (user_id in self._scheduled or self._has_pending(user_id)):
+            await asyncio.sleep(0.05)
+
+    def _has_pending(self, user_id: int) -> bool:
+        with SessionMaker() as session:
+            return session.query(OutboxMessage.id).filter(OutboxMessage.user_id == user_id).first() is not None
+
+    def enqueue(self, user_id: int, message_id: int, reply_to_message_id: int = None):
+        with SessionMaker() as session:
+            session.add(OutboxMessage(
+                user_id=user_id,
+                message_id=message_id,
+                reply_to_message_id=reply_to_message_id,
+                attempts=0,
+            ))
+            session.commit()
+        self._signal(user_id)
+
+    def _signal(self, user_id: int):
+        if user_id in self._scheduled or user_id in self._backoff or self._queue is None:
+            return
+        if not self._owns(user_id):
+            return # 由所属分片的 _poll_pending 接手
+        self._scheduled.add(user_id)
+        self._queue.put_nowait(user_id)
+
+    def _retry_later(self, user_id: int, delay: float):
+        self._backoff.add(user_id)
+        asyncio.get_running_loop().call_later(delay, self._end_backoff, user_id)
+
+    def _end_backoff(self, user_id: int):
+        self._backoff.discard(user_id)
+        self._signal(user_id)
+
+    async def _worker(self):
+        while True:
+            user_id = await self._queue.get()
+            if user_id is None: # drain() 发出的停止信号
+                self._queue.task_done()
+                return
+            try:
+                await self._drain_user(user_id)
+            except Exception as e:
+                logger.error(f"Outbox worker failed for user {user_id}: {e}", exc_info=True)
+                self._retry_later(user_id, 5)
+            finally:
+                self._scheduled.discard(user_id)
+                self._queue.task_done()
+
+    async def _drain_user(self, user_id: int):
+        # expire_on_commit=False：删除并提交后 item 的字段仍可用于失败回调
+        with SessionMaker(expire_on_commit=False) as session:
+            while not self._stopping:
+                item = (
+                    session.query(OutboxMessage)
+                    .filter(OutboxMessage.user_id == user_id)
+                    .order_by(OutboxMessage.id)
+                    .first()
+                )
+                if not item:
+                    return
+                try:
+                    await self._deliver(self._bot, session, item)
+                except RetryAfter as e:
+                    if not self._record_attempt(session, item):
+                        await self._fail(session, item, e)
+                        continue
+                    self._retry_later(user_id, e.retry_after)
+                    return
+                except (BadRequest, Forbidden) as e:
+                    # 永久性错误，重试无意义
+                    await self._fail(session, item, e)
+                    continue
+                except NetworkError as e:
+                    # 超时/5xx 等临时错误：指数退避后重试，保持该用户后续消息的顺序
+                    if not self._record_attempt(session, item):
+                        await self._fail(session, item, e)
+                        continue
+                    delay = min(2 ** item.attempts, 60)
+                    logger.warning(f"Outbox delivery for user {user_id} msg {item.message_id} failed (attempt {item.attempts}), retry in {delay}s: {e}")
+                    self._retry_later(user_id, delay)
+                    return
+                except Exception as e:
+                    logger.error(f"Unexpected error delivering outbox msg {item.message_id} of user {user_id}: {e}", exc_info=True)
+                    await self._fail(session, item, e)
+                    continue
+                session.delete(item)
+                session.commit()
+
+    def _record_attempt(self, session, item: OutboxMessage) -> bool:
+        """记录一次失败尝试，返回是否还可以重试。"""
+        item.attempts = (item.attempts or 0) + 1
+        session.commit()
+        return item.attempts < self._max_attempts
+
+    async def _fail(self, session, item: OutboxMessage, error: Exception):
+        session.rollback()
+        session.refresh(item)
+        session.delete(item)
+        session.commit()
+        try:
+            await self._on_failed(self._bot, item, error)
+        except Exception as e:
+            logger.error(f"Outbox failure callback error for user {item.user_id}: {e}", exc_info=True)
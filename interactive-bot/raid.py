@@ -0,0 +1,152 @@
+import hashlib
+import math
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from telegram import Message
+
+from db.database import SessionMaker
+from db.model import QuarantineMessage
+
+
+def content_hash(message: Message) -> str:
+    """计算消息内容指纹：文本/说明文字归一化后的内容 + 媒体文件的 file_unique_id。"""
+    parts = [" ".join((message.text or message.caption or "").lower().split())]
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)): # 图片是不同尺寸的列表
+        attachment = attachment[-1] if attachment else None
+    file_unique_id = getattr(attachment, "file_unique_id", None)
+    if file_unique_id:
+        parts.append(file_unique_id)
+    return hashlib.sha1("\x00".join(parts).encode()).hexdigest()
+
+
+class RaidDetector:
+    """新用户涌入 (刷屏攻击) 检测。
+
+    统计窗口内新用户的到达数量和首条消息的内容指纹。到达速率超过阈值或同一内容被多个新用户
+    重复发送时进入攻击状态，并在 calm_seconds 内没有新的触发后解除。攻击期间，ID 大于攻击前
+    已知最大用户 ID 的账号 (Telegram 用户 ID 大致随注册时间递增，即新注册账号) 或发送重复内容的
+    新用户会被隔离，暂不创建话题。
+    """
+
+    def __init__(self, new_users_per_minute: int, duplicate_threshold: int = 3, calm_seconds: float = 300, window: float = 60):
+        self.threshold = new_users_per_minute # 0 表示关闭检测
+        self.duplicate_threshold = max(2, duplicate_threshold)
+        self.calm_seconds = calm_seconds
+        self.window = window
+        self.reference_id = 0 # 攻击前已知的最大用户 ID
+        self._arrivals = deque() # (时间, 内容指纹)
+        self._hash_counts = Counter()
+        self._attack_until = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def split(self, parts: int):
+        """分片模式下每个进程只看到约 1/parts 的新用户，阈值按比例缩小。"""
+        if self.enabled and parts > 1:
+            self.threshold = max(1, math.ceil(self.threshold / parts))
+            self.duplicate_threshold = max(2, math.ceil(self.duplicate_threshold / parts))
+
+    def note_known_user(self, user_id: int):
+        self.reference_id = max(self.reference_id, user_id)
+
+    def under_attack(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return self._attack_until > now
+
+    def should_quarantine(self, user_id: int, digest: str, now: float = None) -> bool:
+        """记录一个新用户的首条消息，返回是否应当隔离。"""
+        if not self.enabled:
+            return False
+        now = time.monotonic() if now is None else now
+        while self._arrivals and self._arrivals[0][0] < now - self.window:
+            _, old = self._arrivals.popleft()
+            self._hash_counts[old] -= 1
+            if self._hash_counts[old] <= 0:
+                del self._hash_counts[old]
+        self._arrivals.append((now, digest))
+        self._hash_counts[digest] += 1
+
+        duplicate = self._hash_counts[digest] >= self.duplicate_threshold
+        if len(self._arrivals) >= self.threshold * self.window / 60 or duplicate:
+            self._attack_until = now + self.calm_seconds
+
+        if not self.under_attack(now):
+            self.note_known_user(user_id)
+            return False
+        return duplicate or user_id > self.reference_id
+
+
+class Quarantine:
+    """隔离区：攻击期间暂不创建话题的用户消息，持久化在数据库中，放行时按原顺序转发。"""
+
+    def __init__(self, duplicate_threshold: int = 3, ttl: timedelta = timedelta(days=1)):
+        self.duplicate_threshold = max(2, duplicate_threshold)
+        self.ttl = ttl
+        self.users = set() # 有消息处于隔离中的用户
+
+    def load(self):
+        with SessionMaker() as session:
+            self.users = {uid for (uid,) in session.query(QuarantineMessage.user_id).distinct()}
+
+    def add(self, user_id: int, message_id: int, digest: str):
+        with SessionMaker() as session:
+            session.add(QuarantineMessage(user_id=user_id, message_id=message_id, content_hash=digest))
+            session.commit()
+        self.users.add(user_id)
+
+    def _spam_hashes(self, session) -> set:
+        """被多个隔离用户重复发送的内容视为垃圾内容。"""
+        return {
+            h for (h,) in session.query(QuarantineMessage.content_hash)
+            .group_by(QuarantineMessage.content_hash)
+            .having(func.count(func.distinct(QuarantineMessage.user_id)) >= self.duplicate_threshold)
+        }
+
+    def is_spam_only(self, user_id: int) -> bool:
+        with SessionMaker() as session:
+            spam = self._spam_hashes(session)
+            hashes = {h for (h,) in session.query(QuarantineMessage.content_hash).filter(QuarantineMessage.user_id == user_id)}
+        return bool(hashes) and hashes <= spam
+
+    def candidates(self, limit: int) -> list:
+        """按进入隔离区的先后顺序返回可以放行的用户 (至少有一条非垃圾内容)。"""
+        with SessionMaker() as session:
+            spam = self._spam_hashes(session)
+            query = session.query(QuarantineMessage.user_id).group_by(QuarantineMessage.user_id).order_by(func.min(QuarantineMessage.id))
+            if spam:
+                query = query.filter(QuarantineMessage.content_hash.notin_(spam))
+            return [uid for (uid,) in query.limit(limit)]
+
+    def pop(self, user_id: int) -> list:
+        """取出并删除用户的隔离消息，返回按原顺序排列的消息 ID。
+
+        逐条按 ID 删除，只返回本次删除成功的消息：放行任务和用户所在的分片同时取出时每条消息只会被取出一次。
+        """
+        with SessionMaker() as session:
+            rows = session.query(QuarantineMessage.id, QuarantineMessage.message_id).filter(
+                QuarantineMessage.user_id == user_id
+            ).order_by(QuarantineMessage.id).all()
+            message_ids = [
+                message_id for row_id, message_id in rows
+                if session.query(QuarantineMessage).filter(QuarantineMessage.id == row_id).delete()
+            ]
+            session.commit()
+        self.users.discard(user_id)
+        return message_ids
+
+    def purge(self) -> int:
+        """丢弃超过保留时间仍未放行的消息 (通常是垃圾内容)。"""
+        with SessionMaker() as session:
+            count = session.query(QuarantineMessage).filter(
+                QuarantineMessage.created_at < datetime.utcnow() - self.ttl
+            ).delete(synchronize_session=False)
+            session.commit()
+        if count:
+            self.load()
+        return count
@@ -0,0 +1,196 @@
+import html
+import time
+
+from sqlalchemy import bindparam, text
+
+from db.database import get_engine
+
+from . import logger
+
+HIT_START = "\x02"
+HIT_END = "\x03"
+
+
+def fts_query(terms: list) -> str:
+    """把关键词转换为 FTS5 查询：每个词作为短语加引号，多个词之间为 AND。"""
+    return " ".join('"{}"'.format(t.replace('"', '""')) for t in terms)
+
+
+def like_pattern(term: str) -> str:
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def snippet_html(snippet: str) -> str:
+    """转义片段中的 HTML，再把命中标记替换为加粗。"""
+    return html.escape(snippet).replace(HIT_START, "<b>").replace(HIT_END, "</b>")
+
+
+def relevance(content: str, terms: list, average_length: float, k1: float = 1.2, b: float = 0.75) -> float:
+    """BM25 的词频部分：关键词出现次数越多、消息越短得分越高。
+
+    不使用 FTS5 的 bm25()：它要遍历每个词在整个索引中的全部匹配来统计文档频率，高频词在百万条消息中需要数百毫秒。
+    候选消息都包含全部关键词，文档频率对排序的影响很小，省略。
+    """
+    lowered = content.lower()
+    norm = k1 * (1 - b + b * len(content) / max(1.0, average_length))
+    score = 0.0
+    for term in terms:
+        tf = lowered.count(term.lower())
+        score += tf * (k1 + 1) / (tf + norm)
+    return score
+
+
+class SearchIndex:
+    """可选的全文索引：转发的文本/说明文字写入 SQLite FTS5 虚拟表，rowid 为管理群组中的消息 ID。
+
+    写入先进入内存缓冲，由 flush() 批量提交。u2a 消息在发件箱投递前还没有群组消息 ID，
+    先用 stage() 暂存，投递后由 resolve() 移入缓冲。
+    按相关度排序时只对最近 rank_window 条匹配评分 (见 relevance)：高频词在百万条消息中有几十万条匹配，全部评分需要数秒。
+    """
+
+    def __init__(
+        self, enabled: bool, retention_days: int = 0, batch_size: int = 200, max_staged: int = 10000, rank_window: int = 1000
+    ):
+        self.enabled = enabled
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.max_staged = max_staged
+        self.rank_window = rank_window
+        self.trigram = False
+        self.min_query_length = 1
+        self._buffer = {} # 群组消息 ID -> (user_id, direction, text, created_at)
+        self._staged = {} # (user_id, 用户侧消息 ID) -> text
+
+    def setup(self):
+        if not self.enabled:
+            return
+        with get_engine().begin() as conn:
+            try:
+                # trigram 分词器支持中文等没有空格分词的语言 (SQLite 3.34+)
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+                    "content, user_id UNINDEXED, direction UNINDEXED, created_at UNINDEXED, tokenize='trigram')"
+                ))
+                self.trigram = True
+                self.min_query_length = 2
+            except Exception as e:
+                logger.warning(f"FTS5 trigram tokenizer unavailable, falling back to unicode61: {e}")
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+                    "content, user_id UNINDEXED, direction UNINDEXED, created_at UNINDEXED)"
+                ))
+
+    def add(self, group_msg_id: int, user_id: int, direction: str, content: str):
+        if not self.enabled or not content or not group_msg_id:
+            return
+        # 同一条消息 (编辑) 只保留最新内容
+        self._buffer[group_msg_id] = (user_id, direction, content, int(time.time()))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def stage(self, user_id: int, user_msg_id: int, content: str):
+        if not self.enabled or not content:
+            return
+        self._staged[(user_id, user_msg_id)] = content
+        while len(self._staged) > self.max_staged:
+            del self._staged[next(iter(self._staged))]
+
+    def resolve(self, user_id: int, user_msg_id: int, group_msg_id: int):
+        content = self._staged.pop((user_id, user_msg_id), None)
+        if content:
+            self.add(group_msg_id, user_id, "u2a", content)
+
+    def discard(self, user_id: int, user_msg_id: int):
+        self._staged.pop((user_id, user_msg_id), None)
+
+    def flush(self) -> int:
+        if not self._buffer:
+            return 0
+        batch, self._buffer = self._buffer, {}
+        rows = [
+            {"rowid": rowid, "content": content, "user_id": user_id, "direction": direction, "created_at": created_at}
+            for rowid, (user_id, direction, content, created_at) in batch.items()
+        ]
+        try:
+            with get_engine().begin() as conn:
+                # FTS5 不支持 UPSERT，先删除被编辑的旧内容
+                conn.execute(text("DELETE FROM message_fts WHERE rowid = :rowid"), [{"rowid": r["rowid"]} for r in rows])
+                conn.execute(
+                    text(
+                        "INSERT INTO message_fts (rowid, content, user_id, direction, created_at) "
+                        "VALUES (:rowid, :content, :user_id, :direction, :created_at)"
+                    ),
+                    rows,
+                )
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} messages to search index: {e}", exc_info=True)
+            return 0
+        return len(rows)
+
+    def search(self, keywords: str, limit: int = 10) -> list:
+        """返回按相关度排序的 [(群组消息 ID, 用户 ID, 片段)]。"""
+        self.flush()
+        terms = keywords.split()
+        # trigram 索引只能匹配 3 个字符以上的词，更短的词 (如两个字的中文词) 用 LIKE 过滤
+        match_terms = [t for t in terms if len(t) >= 3 or not self.trigram]
+        like_terms = [t for t in terms if t not in match_terms]
+        conditions = []
+        params = {"start": HIT_START, "end": HIT_END, "limit": limit}
+        if match_terms:
+            conditions.append("message_fts MATCH :query")
+            params["query"] = fts_query(match_terms)
+        for i, term in enumerate(like_terms):
+            conditions.append(f"content LIKE :like{i} ESCAPE '\\'")
+            params[f"like{i}"] = like_pattern(term)
+        where = " AND ".join(conditions)
+        with get_engine().connect() as conn:
+            if not match_terms:
+                # 只有短词时无法计算相关度，按时间倒序返回。没有 MATCH 时 snippet() 返回整段内容，截断以免消息过长
+                rows = conn.execute(
+                    text(f"SELECT rowid, user_id, content FROM message_fts WHERE {where} ORDER BY rowid DESC LIMIT :limit"),
+                    params,
+                ).all()
+                return [
+                    (rowid, int(user_id), content if len(content) <= 120 else content[:120] + "…")
+                    for rowid, user_id, content in rows
+                ]
+            # 按 rowid 倒序读取匹配不需要计算相关度，先找到最近 rank_window 条匹配的下界
+            floor = conn.execute(
+                text(f"SELECT rowid FROM message_fts WHERE {where} ORDER BY rowid DESC LIMIT 1 OFFSET :window"),
+                {**params, "window": self.rank_window},
+            ).scalar()
+            if floor is not None:
+                where += " AND rowid > :floor"
+                params["floor"] = floor
+            candidates = conn.execute(text(f"SELECT rowid, user_id, content FROM message_fts WHERE {where}"), params).all()
+            if not candidates:
+                return []
+            average_length = sum(len(content) for _, _, content in candidates) / len(candidates)
+            top = sorted(candidates, key=lambda row: (relevance(row[2], terms, average_length), row[0]), reverse=True)[:limit]
+            snippets = dict(conn.execute(
+                text(
+                    "SELECT rowid, snippet(message_fts, 0, :start, :end, '…', 16) FROM message_fts "
+                    "WHERE message_fts MATCH :query AND rowid IN :rowids"
+                ).bindparams(bindparam("rowids", expanding=True)),
+                {"start": HIT_START, "end": HIT_END, "query": params["query"], "rowids": [row[0] for row in top]},
+            ).all())
+        return [(rowid, int(user_id), snippets.get(rowid, "")) for rowid, user_id, _ in top]
+
+    def purge(self, now: float = None) -> int:
+        """删除超过保留期的索引内容，返回删除条数。"""
+        if not self.retention_days:
+            return 0
+        cutoff = int((now or time.time()) - self.retention_days * 86400)
+        with get_engine().begin() as conn:
+            return conn.execute(text("DELETE FROM message_fts WHERE created_at < :cutoff"), {"cutoff": cutoff}).rowcount
+
+    def drop_users(self, user_ids: list) -> int:
+        """删除这些用户的全部索引内容 (对话被删除后调用)。"""
+        if not self.enabled or not user_ids:
+            return 0
+        self.flush()
+        with get_engine().begin() as conn:
+            return conn.execute(
+                text("DELETE FROM message_fts WHERE user_id IN :user_ids").bindparams(bindparam("user_ids", expanding=True)),
+                {"user_ids": list(user_ids)},
+            ).rowcount
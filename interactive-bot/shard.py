@@ -0,0 +1,219 @@
+import asyncio
+import collections
+import importlib
+import json
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+
+import httpx
+from telegram import Update
+
+from . import bot_api_base_url, bot_token, logger
+from .network import build_client
+
+
+def shard_key(update: dict) -> int:
+    """计算更新的分片键：私聊按用户 ID，管理群组内按话题 ID。"""
+    for field in ("message", "edited_message"):
+        message = update.get(field)
+        if message:
+            if message.get("chat", {}).get("type") == "private":
+                return message["chat"]["id"]
+            if message.get("message_thread_id"):
+                return message["message_thread_id"]
+            return message.get("chat", {}).get("id", 0)
+    callback_query = update.get("callback_query")
+    if callback_query:
+        return callback_query["from"]["id"]
+    for field in ("my_chat_member", "chat_member", "chat_join_request"):
+        if update.get(field):
+            return update[field]["from"]["id"]
+    return 0
+
+
+def pick_shard(update: dict, shard_count: int) -> int:
+    return abs(shard_key(update)) % shard_count
+
+
+def _load_factory(path: str):
+    """按 "模块:函数名" 导入构建 Application 的函数。
+
+    spawn 子进程不会重新导入以 python -m 运行的 __main__ 模块，不能直接把其中的函数传给 worker。
+    """
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+# worker 进程：运行完整的处理器集合，从队列中取出前端分发的更新。
+# 停止由前端统一协调 (队列中的 None)，忽略发给整个进程组的 SIGINT/SIGTERM
+def _run_worker(index: int, shard_count: int, update_queue, processed, factory_path: str, base_url: str, ready):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    build_application = _load_factory(factory_path)
+    asyncio.run(_worker_loop(index, shard_count, update_queue, processed, build_application, base_url, ready))
+
+
+async def _worker_loop(index: int, shard_count: int, update_queue, processed, build_application, base_url: str, ready):
+    application = build_application(shard_index=index, shard_count=shard_count, base_url=base_url)
+    loop = asyncio.get_running_loop()
+    async with application:
+        # 不经过 run_polling 时需要手动调用生命周期钩子
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        ready.set()
+        logger.info(f"Shard worker {index}/{shard_count} started.")
+        while True:
+            try:
+                data = await loop.run_in_executor(None, update_queue.get, True, 1.0)
+            except queue.Empty:
+                if not multiprocessing.parent_process().is_alive():
+                    logger.warning(f"Shard worker {index}: front process is gone, stopping.")
+                    break
+                continue
+            if data is None: # 前端发出的停止信号
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except Exception as e:
+                logger.error(f"Shard worker {index} failed to decode update: {e}", exc_info=True)
+            else:
+                # 按顺序处理 (与单进程模式不开启 concurrent_updates 时相同)，处理完才向前端确认
+                await application.process_update(update)
+            processed.value = data["update_id"]
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    logger.info(f"Shard worker {index} stopped.")
+
+
+def _dead_workers(workers: list) -> list:
+    return [w.name for w in workers if not w.is_alive()]
+
+
+def _wait_ready(workers: list, events: list) -> list:
+    """等待所有 worker 启动完成，返回启动期间退出的 worker。"""
+    while not all(e.is_set() for e in events):
+        dead = _dead_workers(workers)
+        if dead:
+            return dead
+        time.sleep(0.2)
+    return []
+
+
+async def _wait_progress(processed: list, timeout: float = 0.5):
+    """等待任一 worker 确认新的更新，最多 timeout 秒。"""
+    before = [v.value for v in processed]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+        if [v.value for v in processed] != before:
+            return
+
+
+# 前端进程：只做长轮询、JSON 解析和按键分发，不运行任何处理器。
+# getUpdates 的 offset 只推进到所有 worker 都处理完的位置：Telegram 以 offset 确认更新，
+# 已分发但未处理完的更新在前端或 worker 退出后会重新投递 (可能重复处理少量已处理的更新)。
+# 未确认的更新会在每次 getUpdates 中重复返回，前端跳过已分发的部分；
+# 单次最多返回 100 个更新，因此处理中的更新达到 100 个时暂停拉取新更新，起到背压作用。
+# 有 worker 退出时停止拉取并返回其名称
+async def _poll_updates(queues: list, processed: list, workers: list, allowed_updates: list, base_url: str) -> list:
+    next_offset = 0 # 下一个未分发的 update_id
+    in_flight = [collections.deque() for _ in queues] # 每个 worker 已分发、未确认的 update_id
+    url = f"{base_url}{bot_token}/getUpdates"
+    async with build_client(timeout=40.0) as client:
+        while True:
+            dead = _dead_workers(workers)
+            if dead:
+                return dead
+            for ids, value in zip(in_flight, processed):
+                done = value.value
+                while ids and ids[0] <= done:
+                    ids.popleft()
+            waiting = [ids[0] for ids in in_flight if ids]
+            try:
+                resp = await client.post(
+                    url,
+                    json={
+                        "offset": min(waiting) if waiting else next_offset,
+                        "timeout": 30,
+                        "allowed_updates": allowed_updates,
+                    },
+                )
+                result = resp.json()
+            except (httpx.HTTPError, json.JSONDecodeError) as e:
+                logger.warning(f"Shard front failed to fetch updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not result.get("ok"):
+                logger.warning(f"Shard front got error from getUpdates: {result}")
+                await asyncio.sleep(result.get("parameters", {}).get("retry_after", 1))
+                continue
+            new = [update for update in result["result"] if update["update_id"] >= next_offset]
+            for update in new:
+                shard = pick_shard(update, len(queues))
+                in_flight[shard].append(update["update_id"])
+                queues[shard].put(update)
+                next_offset = update["update_id"] + 1
+            if not new and waiting:
+                # 只返回了处理中的更新，等待 worker 确认后再拉取，避免空转
+                await _wait_progress(processed)
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
+
+
+def run_sharded(factory_path: str, shard_count: int, allowed_updates: list, base_url: str = bot_api_base_url):
+    """以 1 个前端进程 + shard_count 个 worker 进程的方式运行机器人。
+
+    factory_path 为 "模块:函数名"，worker 进程导入该函数构建 Application。
+    SIGINT/SIGTERM 时停止拉取，等待 worker 处理完已分发的更新后退出。
+    任一 worker 退出时前端随之退出 (退出码 1)，由进程管理器整体重启。
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(shard_count)]
+    processed = [ctx.Value("q", 0) for _ in range(shard_count)] # 每个 worker 最后处理完的 update_id
+    events = [ctx.Event() for _ in range(shard_count)]
+    workers = [
+        ctx.Process(
+            target=_run_worker,
+            args=(i, shard_count, queues[i], processed[i], factory_path, base_url, events[i]),
+            name=f"shard-{i}",
+            daemon=True,
+        )
+        for i in range(shard_count)
+    ]
+    for w in workers:
+        w.start()
+    # 默认的 SIGTERM 会直接结束前端而不执行 finally，worker 失去前端后无人停止
+    signal.signal(signal.SIGTERM, _raise_exit)
+    dead = []
+    try:
+        dead = _wait_ready(workers, events)
+        if not dead:
+            logger.info(f"Shard front started with {shard_count} workers.")
+            dead = asyncio.run(_poll_updates(queues, processed, workers, allowed_updates, base_url))
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Shard front stopping...")
+    finally:
+        # 停止过程中不再响应信号，保证 worker 被停止并回收
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for q in queues:
+            try:
+                q.put(None)
+            except (ValueError, queue.Full):
+                pass
+        for w in workers:
+            w.join(timeout=30)
+            if w.is_alive():
+                logger.warning(f"Shard worker {w.name} did not stop in time, terminating.")
+                w.terminate()
+                w.join()
+    if dead:
+        logger.error(f"Shard workers exited unexpectedly: {', '.join(dead)}. Stopping the shard front.")
+        sys.exit(1)
@@ -0,0 +1,114 @@
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from db.model import AdminStats, StatCounter, TopicStats
+
+# 全局计数器名称
+USER_MESSAGES = "user_messages"
+ADMIN_MESSAGES = "admin_messages"
+RESPONSES = "responses"
+RESPONSE_SECONDS = "response_seconds"
+BACKLOG = "backlog" # 等待管理员回复的对话数
+
+
+def _bump(session, **deltas):
+    """原子地增加全局计数器 (不存在则创建)。"""
+    for name, delta in deltas.items():
+        session.execute(
+            insert(StatCounter)
+            .values(name=name, value=delta)
+            .on_conflict_do_update(index_elements=["name"], set_={"value": StatCounter.value + delta})
+        )
+
+
+def _topic(session, user_id: int, message_thread_id: int) -> TopicStats:
+    topic = session.query(TopicStats).filter(TopicStats.user_id == user_id).first()
+    if not topic:
+        topic = TopicStats(
+            user_id=user_id,
+            user_messages=0,
+            admin_messages=0,
+            unanswered=0,
+            response_count=0,
+            response_seconds=0,
+        )
+        session.add(topic)
+    topic.message_thread_id = message_thread_id
+    return topic
+
+
+def record_user_message(session, user_id: int, message_thread_id: int, now: datetime = None):
+    """用户发来一条消息：累加计数，对话从已回复变为等待回复时开始计时。由调用方提交。"""
+    now = now or datetime.now()
+    topic = _topic(session, user_id, message_thread_id)
+    topic.user_messages += 1
+    topic.unanswered += 1
+    counters = {USER_MESSAGES: 1}
+    if topic.awaiting_since is None:
+        topic.awaiting_since = now
+        counters[BACKLOG] = 1
+    _bump(session, **counters)
+
+
+def record_admin_reply(session, user_id: int, message_thread_id: int, admin_id: int, admin_name: str = None, now: datetime = None):
+    """管理员的一条回复已送达用户：如果对话在等待回复，记录本次回复耗时并计入该管理员。由调用方提交。
+
+    admin_name 为空时 (如延时发送的媒体组) 保留已记录的名字。
+    """
+    now = now or datetime.now()
+    topic = _topic(session, user_id, message_thread_id)
+    topic.admin_messages += 1
+    stats = session.query(AdminStats).filter(AdminStats.admin_id == admin_id).first()
+    if not stats:
+        stats = AdminStats(admin_id=admin_id, replies=0, response_count=0, response_seconds=0)
+        session.add(stats)
+    stats.name = (admin_name or stats.name or str(admin_id))[:128]
+    stats.replies += 1
+    stats.last_reply_at = now
+    counters = {ADMIN_MESSAGES: 1}
+    if topic.awaiting_since is not None:
+        seconds = max(0, int((now - topic.awaiting_since).total_seconds()))
+        if topic.first_response_seconds is None:
+            topic.first_response_seconds = seconds
+        topic.response_count += 1
+        topic.response_seconds += seconds
+        topic.awaiting_since = None
+        topic.unanswered = 0
+        stats.response_count += 1
+        stats.response_seconds += seconds
+        counters.update({RESPONSES: 1, RESPONSE_SECONDS: seconds, BACKLOG: -1})
+    _bump(session, **counters)
+
+
+def end_waiting(session, user_ids: list):
+    """对话被删除时不再计入等待回复的对话数。由调用方提交。"""
+    ended = (
+        session.query(TopicStats)
+        .filter(TopicStats.user_id.in_(user_ids), TopicStats.awaiting_since.isnot(None))
+        .update({TopicStats.awaiting_since: None, TopicStats.unanswered: 0}, synchronize_session=False)
+    )
+    if ended:
+        _bump(session, **{BACKLOG: -ended})
+
+
+def global_stats(session) -> dict:
+    """返回全局计数器以及最久未回复对话的等待起始时间。"""
+    result = {name: value for name, value in session.query(StatCounter.name, StatCounter.value)}
+    # awaiting_since 有索引，MIN 查询不需要扫描全表
+    result["oldest_awaiting"] = session.query(func.min(TopicStats.awaiting_since)).scalar()
+    return result
+
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    if seconds < 86400:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 86400}d{seconds % 86400 // 3600:02d}h"
@@ -0,0 +1,207 @@
+import asyncio
+import contextvars
+import json
+import signal
+
+from telegram.ext import CallbackContext
+
+from db.database import current_database
+
+from . import admin_group_id, admin_user_ids, app_name, bot_token, logger, welcome_message
+
+
+class Tenant:
+    """一个机器人及其管理群组。每个租户使用独立的数据库文件和持久化文件。"""
+
+    def __init__(
+        self,
+        name: str,
+        bot_token: str,
+        admin_group_id: int,
+        admin_user_ids: list,
+        welcome_message: str = "欢迎使用本机器人",
+        app_name: str = None,
+        database: str = None,
+    ):
+        self.name = name
+        self.bot_token = bot_token
+        self.admin_group_id = int(admin_group_id)
+        self.admin_user_ids = [int(x) for x in admin_user_ids]
+        self.welcome_message = welcome_message
+        self.app_name = app_name or name
+        self.database = database # 为空时使用默认数据库 ./assets/db.sqlite3
+
+    def __repr__(self):
+        return f"Tenant({self.name!r})"
+
+
+# 单机器人模式下唯一的租户，配置来自环境变量
+default_tenant = Tenant(app_name, bot_token, admin_group_id, admin_user_ids, welcome_message)
+
+current_tenant = contextvars.ContextVar("current_tenant", default=None)
+_tenants_by_token = {}
+
+
+def activate(t: Tenant):
+    """把 t 设为当前上下文 (以及之后在此上下文中创建的任务) 的租户。"""
+    current_tenant.set(t)
+    current_database.set(t.database)
+
+
+def get_tenant() -> Tenant:
+    return current_tenant.get() or default_tenant
+
+
+class _CurrentTenant:
+    """当前租户的配置，例如 tenant.admin_group_id。"""
+
+    def __getattr__(self, name):
+        return getattr(get_tenant(), name)
+
+
+tenant = _CurrentTenant()
+
+
+class TenantLocal:
+    """按租户隔离的单例：每个租户第一次使用时调用 factory() 创建自己的实例，其余用法与实例相同。"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances = {}
+
+    def _get(self):
+        t = get_tenant()
+        instance = self._instances.get(t.name)
+        if instance is None:
+            instance = self._instances[t.name] = self._factory()
+        return instance
+
+    def instances(self) -> list:
+        """所有租户已创建的实例。"""
+        return list(self._instances.values())
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __len__(self):
+        return len(self._get())
+
+    def __contains__(self, item):
+        return item in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+
+    def __delitem__(self, key):
+        del self._get()[key]
+
+    async def __aenter__(self):
+        return await self._get().__aenter__()
+
+    async def __aexit__(self, *exc_info):
+        return await self._get().__aexit__(*exc_info)
+
+
+def load_tenants(path: str) -> list:
+    """读取租户配置文件 (JSON 数组)，每项包含 name、bot_token、admin_group_id、admin_user_ids，可选 welcome_message。"""
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    tenants = []
+    for entry in entries:
+        entry.setdefault("database", entry["name"])
+        tenants.append(Tenant(**entry))
+    names = [t.name for t in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"duplicate tenant names in {path}")
+    return tenants
+
+
+class TenantContext(CallbackContext):
+    """处理更新、任务和错误前先切换到该 Application 所属的租户。"""
+
+    @staticmethod
+    def _activate_for(application):
+        activate(_tenants_by_token.get(application.bot.token, default_tenant))
+
+    @classmethod
+    def from_update(cls, update, application):
+        cls._activate_for(application)
+        return super().from_update(update, application)
+
+    @classmethod
+    def from_job(cls, job, application):
+        cls._activate_for(application)
+        return super().from_job(job, application)
+
+    @classmethod
+    def from_error(cls, update, error, application, job=None, coroutine=None):
+        cls._activate_for(application)
+        return super().from_error(update, error, application, job=job, coroutine=coroutine)
+
+
+async def _run_tenants(build_application, tenants: list, allowed_updates: list, request, drain=None):
+    running = []
+    for t in tenants:
+        # 启动期间创建的任务 (轮询、发件箱 worker 等) 会继承当前租户
+        activate(t)
+        _tenants_by_token[t.bot_token] = t
+        application = build_application(request=request)
+        try:
+            await application.initialize()
+            if application.post_init:
+                await application.post_init(application)
+            await application.updater.start_polling(allowed_updates=allowed_updates)
+            await application.start()
+        except Exception as e:
+            logger.error(f"Tenant {t.name} failed to start, skipping: {e}", exc_info=True)
+            continue
+        running.append((t, application))
+        logger.info(f"Tenant {t.name} started.")
+    logger.info(f"{len(running)}/{len(tenants)} tenants running.")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    if drain:
+        # 各租户并行排空 (任务创建时继承当前租户)
+        tasks = []
+        for t, application in running:
+            activate(t)
+            tasks.append(asyncio.create_task(drain(application)))
+
+        # 排空期间再次收到停止信号时放弃排空，立即停止
+        def abort_drain():
+            logger.warning("Stop signal received again, aborting drain.")
+            for task in tasks:
+                task.cancel()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, abort_drain)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    # 先停止所有轮询和处理，最后再关闭共用的 HTTP 连接池
+    for t, application in running:
+        activate(t)
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+    for t, application in running:
+        activate(t)
+        await application.shutdown()
+        logger.info(f"Tenant {t.name} stopped.")
+
+
+def run_tenants(build_application, tenants: list, allowed_updates: list, request, drain=None):
+    """在一个进程、一个事件循环中运行多个租户的 Application，共用 request (HTTP 连接池)。
+    收到停止信号后先对每个租户调用 drain(application)，再次收到信号时放弃排空立即停止。"""
+    asyncio.run(_run_tenants(build_application, tenants, allowed_updates, request, drain))
@@ -0,0 +1,105 @@
+import math
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from db.database import SessionMaker
+from db.model import TopicPool as TopicPoolRow
+
+POOL_TOPIC_NAME = "💬 新对话"
+
+
+class TopicPool:
+    """预先创建的空闲话题池，新用户到来时直接分配，改名在后台完成。
+
+    池的目标大小按最近一小时的新话题速率估算：保证在一个补充周期内的新用户都能拿到现成的话题。
+    分配记录保存在数据库中，进程崩溃后未完成改名的话题由维护任务补做，未绑定成功的话题放回池中或删除。
+    """
+
+    def __init__(self, max_size: int, min_size: int = 1, refill_interval: float = 60):
+        self.max_size = max_size # 0 表示关闭话题池
+        self.min_size = min(min_size, max_size)
+        self.refill_interval = refill_interval
+        self._arrival_scale = 1
+        self._arrivals = deque()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def split(self, parts: int):
+        """分片模式下本进程只看到约 1/parts 的新对话，估算池大小时按比例放大。"""
+        self._arrival_scale = max(1, parts)
+
+    def record_arrival(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        self._arrivals.append(now)
+        while self._arrivals and self._arrivals[0] < now - 3600:
+            self._arrivals.popleft()
+
+    def target_size(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        recent = sum(1 for t in self._arrivals if t >= now - 3600) * self._arrival_scale
+        # 按两个补充周期的预计到达数留出余量
+        expected = math.ceil(recent / 3600 * self.refill_interval * 2)
+        return max(self.min_size, min(self.max_size, expected))
+
+    def free_count(self) -> int:
+        with SessionMaker() as session:
+            return session.query(TopicPoolRow).filter(TopicPoolRow.user_id == None).count()
+
+    def add(self, message_thread_id: int):
+        with SessionMaker() as session:
+            session.add(TopicPoolRow(message_thread_id=message_thread_id))
+            session.commit()
+
+    def acquire(self, user_id: int):
+        """取出一个空闲话题并标记为分配给该用户，没有空闲话题时返回 None。"""
+        with SessionMaker() as session:
+            while True:
+                row = session.query(TopicPoolRow).filter(TopicPoolRow.user_id == None).order_by(TopicPoolRow.id).first()
+                if not row:
+                    return None
+                # 条件更新：分片模式下其他进程可能同时取到同一个话题，未抢到时换下一个
+                taken = session.query(TopicPoolRow).filter(
+                    TopicPoolRow.id == row.id, TopicPoolRow.user_id == None
+                ).update({TopicPoolRow.user_id: user_id, TopicPoolRow.acquired_at: datetime.now()}, synchronize_session=False)
+                session.commit()
+                if taken:
+                    return row.message_thread_id
+
+    def put_back(self, message_thread_id: int):
+        """分配后未使用的话题 (仍然存在) 放回池中，可以再次分配。"""
+        with SessionMaker() as session:
+            session.query(TopicPoolRow).filter(TopicPoolRow.message_thread_id == message_thread_id).update(
+                {TopicPoolRow.user_id: None, TopicPoolRow.acquired_at: None}, synchronize_session=False
+            )
+            session.commit()
+
+    def complete(self, message_thread_id: int):
+        """改名完成，话题正式归属用户，从池中移除。"""
+        self._remove(message_thread_id)
+
+    def discard(self, message_thread_id: int):
+        """分配后未能绑定到用户、已不存在或已被删除的话题从池中移除，不再分配。"""
+        self._remove(message_thread_id)
+
+    def _remove(self, message_thread_id: int):
+        with SessionMaker() as session:
+            session.query(TopicPoolRow).filter(TopicPoolRow.message_thread_id == message_thread_id).delete()
+            session.commit()
+
+    def pending(self, min_age: float = 60) -> list:
+        """分配超过 min_age 秒仍未完成改名的话题 [(message_thread_id, user_id)]。
+
+        刚分配的话题可能正由其他分片进程绑定到用户，留出时间避免误判为绑定失败。
+        """
+        cutoff = datetime.now() - timedelta(seconds=min_age)
+        with SessionMaker() as session:
+            return [
+                (row.message_thread_id, row.user_id)
+                for row in session.query(TopicPoolRow).filter(
+                    TopicPoolRow.user_id != None,
+                    (TopicPoolRow.acquired_at == None) | (TopicPoolRow.acquired_at < cutoff),
+                )
+            ]
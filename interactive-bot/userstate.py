@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+
+class UserState:
+    """单个用户的运行时状态。错误禁言带有过期时间，过期后视为不存在。
+    (验证码的答案签名在按钮的回调数据中，见 captcha.py，这里只记录此前的验证码从何时起失效)"""
+
+    __slots__ = ("is_human", "muted_until", "captcha_not_before", "last_ack_date", "last_seen")
+
+    def __init__(self, is_human: bool = False):
+        self.is_human = is_human
+        self.muted_until = 0.0
+        self.captcha_not_before = 0 # 毫秒，早于此时间发出的验证码无效
+        self.last_ack_date = None
+        self.last_seen = 0.0
+
+    def mute(self, seconds: float, now: float = None):
+        self.muted_until = (time.time() if now is None else now) + seconds
+
+    def issue_captcha(self, issued_at: int):
+        """发出新的验证码 (issued_at 为毫秒)，此前发出的验证码全部失效。"""
+        self.captcha_not_before = max(self.captcha_not_before, issued_at)
+
+    def fail_captcha(self, mute_seconds: float, now: float = None):
+        """验证码答错：禁言，并使此前发出的验证码全部失效。"""
+        now = time.time() if now is None else now
+        self.mute(mute_seconds, now)
+        self.captcha_not_before = max(self.captcha_not_before, int(now * 1000))
+
+    def is_muted(self, now: float = None) -> bool:
+        return self.muted_until > (time.time() if now is None else now)
+
+    def expire(self, now: float):
+        """清除已过期的临时字段。"""
+        if self.muted_until <= now:
+            self.muted_until = 0.0
+
+
+class UserStateStore:
+    """有上限的用户状态表：冷用户被淘汰，只有 is_human 这类需要长期保留的字段写入数据库。
+
+    load_human(user_id) 在用户状态不在内存中时从数据库读取验证结果，
+    save_human(user) 在用户通过验证时写入数据库，因此淘汰时不需要再回写。
+    """
+
+    def __init__(self, load_human, save_human, max_users: int = 100000, idle_ttl: float = 6 * 3600):
+        self._load_human = load_human
+        self._save_human = save_human
+        self.max_users = max(1, max_users)
+        self.idle_ttl = idle_ttl
+        self._states = OrderedDict() # user_id -> UserState，顺序即 LRU 顺序 (从头部淘汰，普通字典反复删除头部会越来越慢)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get(self, user_id: int, now: float = None) -> UserState:
+        now = time.time() if now is None else now
+        state = self._states.get(user_id)
+        if state is None:
+            state = self._states[user_id] = UserState(is_human=bool(self._load_human(user_id)))
+            while len(self._states) > self.max_users:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(user_id) # 标记为最近使用
+        state.last_seen = now
+        return state
+
+    def mark_human(self, user, now: float = None):
+        state = self.get(user.id, now)
+        state.is_human = True
+        state.muted_until = 0.0
+        self._save_human(user)
+
+    def sweep(self, now: float = None) -> int:
+        """清除过期字段，淘汰长时间未活动且没有未过期临时状态的用户，返回淘汰数。"""
+        now = time.time() if now is None else now
+        cold = []
+        for user_id, state in self._states.items():
+            state.expire(now)
+            if now - state.last_seen > self.idle_ttl and not state.muted_until:
+                cold.append(user_id)
+        for user_id in cold:
+            del self._states[user_id]
+        return len(cold)
@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+
+from . import logger
+
+PROFILE_DIR = "./assets/profiles"
+# 事件循环空闲时停在 selector 的 select() 上 (Windows 的 proactor 为 _poll())
+IDLE_FUNCTIONS = {"select", "_poll"}
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def thread_stack(thread_id: int, limit: int = None) -> list:
+    """返回线程当前的调用栈标签，最外层在前。线程不存在时返回空列表。"""
+    frame = sys._current_frames().get(thread_id)
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack[-limit:] if limit else stack
+
+
+def is_idle(stack: list) -> bool:
+    return bool(stack) and stack[-1].split(" ", 1)[0] in IDLE_FUNCTIONS
+
+
+class LoopWatchdog:
+    """测量事件循环延迟：循环内的心跳任务定期更新时间戳，后台线程发现心跳停止超过阈值时，
+    记录事件循环线程当前的调用栈 (也就是阻塞事件循环的代码)。"""
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1, max_stalls: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls = collections.deque(maxlen=max_stalls) # 最近的 (时间, 阻塞秒数, 调用栈)
+        self.loop_thread_id = None
+        self._last_beat = 0.0
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def start(self):
+        """在事件循环中调用，重复调用无效 (多租户模式下各 Application 共用一个看门狗)。"""
+        if not self.enabled or self._task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-watchdog")
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - expected
+            self.max_lag = max(self.max_lag, lag)
+            self._last_beat = now
+            if lag > self.threshold:
+                logger.warning(f"Event loop lag {lag:.3f}s (threshold {self.threshold}s).")
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            stalled = time.monotonic() - beat
+            if stalled <= self.threshold or beat == reported_beat:
+                continue
+            # 每次阻塞只采样一次，心跳恢复后才会再次记录
+            reported_beat = beat
+            stack = thread_stack(self.loop_thread_id, limit=20)
+            self.stall_count += 1
+            self.stalls.append((time.time(), stalled, stack))
+            logger.warning(f"Event loop blocked for {stalled:.3f}s at:\n  " + "\n  ".join(stack))
+
+
+class SamplingProfiler:
+    """按固定频率采样事件循环线程的调用栈，输出 flamegraph.pl / speedscope 可读取的 folded 格式。"""
+
+    def __init__(self, rate: int = 100, max_seconds: int = 120):
+        self.rate = rate
+        self.max_seconds = max_seconds
+        self.running = False
+
+    def sample(self, thread_id: int, seconds: float) -> collections.Counter:
+        """在当前 (非事件循环) 线程中阻塞采样 seconds 秒，返回 调用栈 -> 采样次数。"""
+        counts = collections.Counter()
+        deadline = time.monotonic() + seconds
+        period = 1 / self.rate
+        while time.monotonic() < deadline:
+            stack = thread_stack(thread_id)
+            if stack:
+                counts[";".join(stack)] += 1
+            time.sleep(period)
+        return counts
+
+    async def profile(self, thread_id: int, seconds: float, out_dir: str = PROFILE_DIR):
+        """采样 seconds 秒并写入 folded 文件，返回 (文件路径, 采样结果)。同一时间只允许一个采样。"""
+        if self.running:
+            raise RuntimeError("a profile is already running")
+        seconds = max(1, min(seconds, self.max_seconds))
+        self.running = True
+        try:
+            counts = await asyncio.to_thread(self.sample, thread_id, seconds)
+        finally:
+            self.running = False
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        return path, counts
+
+
+def summarize(counts: collections.Counter, top: int = 5) -> str:
+    """采样摘要：空闲比例，以及非空闲采样中自身耗时最多的几行代码。"""
+    total = sum(counts.values())
+    if not total:
+        return "no samples"
+    idle = sum(n for stack, n in counts.items() if is_idle(stack.split(";")))
+    leaves = collections.Counter()
+    for stack, n in counts.items():
+        frames = stack.split(";")
+        if not is_idle(frames):
+            leaves[frames[-1]] += n
+    lines = [f"{total} samples, {idle * 100 // total}% idle"]
+    lines += [f"{n * 100 // total:>3}% {frame}" for frame, n in leaves.most_common(top)]
+    return "\n".join(lines)
+
+
+# 进程内共用 (多租户模式下所有 Application 运行在同一个事件循环上)
+profiler = SamplingProfiler()
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from soak import setup_environment
+
+# 包在导入时读取配置并在当前目录创建 log.txt，测试使用假的配置和临时工作目录。
+# 包名含 "-"，测试中用 importlib.import_module("interactive-bot.<模块>") 导入
+WORK_DIR = setup_environment()
+
+
+@pytest.fixture
+def database(request):
+    """每个测试使用独立的 SQLite 文件 (./assets/<名称>.sqlite3)。"""
+    from db.database import current_database
+
+    name = f"test-{request.node.name}".replace("[", "-").replace("]", "")
+    path = os.path.join(WORK_DIR, "assets", f"{name}.sqlite3")
+    if os.path.exists(path):
+        os.remove(path)
+    token = current_database.set(name)
+    yield name
+    current_database.reset(token)
@@ -0,0 +1,194 @@
+import asyncio
+import collections
+import contextvars
+import itertools
+import json
+import time
+from email.parser import BytesParser
+from urllib.parse import parse_qsl
+
+
+# 当前请求的机器人令牌 (每个连接在自己的任务中处理)
+request_token = contextvars.ContextVar("request_token", default=None)
+
+
+class FakeBotAPI:
+    """本地的假 Bot API 服务器：接受 PTB 的 HTTP 请求，记录每次调用并返回合法的结果。
+
+    getUpdates 返回 push_update() 放入的更新 (长轮询)，其他方法返回最小可用的 Message / 布尔值。
+    push_update(update, token) 指定令牌时只有该机器人能取到这条更新 (多租户)，否则任何令牌都能取到。
+    latency 为每个请求的模拟处理时间 (秒)。长时间运行时只保留最近 keep_calls 次调用，避免自身占用内存增长。
+    """
+
+    def __init__(self, bot_id: int = 123456, latency: float = 0.0, keep_calls: int = 10000):
+        self.bot_id = bot_id
+        self.latency = latency
+        self.calls = collections.deque(maxlen=keep_calls) # 最近的 (方法名, 参数)
+        self.counts = collections.Counter() # 方法名 -> 调用次数
+        self.topics = {} # 话题 ID -> 话题名称
+        self.url = None
+        self._server = None
+        self._connections = set()
+        self._updates = []
+        self._token_updates = {} # 令牌 -> 只发给该机器人的更新
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(10000)
+        self._thread_id = itertools.count(100)
+        self._new_updates = asyncio.Event()
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        # 加大监听队列，基准测试中大量连接同时建立时不会因 SYN 重传而出现秒级的延迟
+        self._server = await asyncio.start_server(self._serve, host, 0, backlog=1024)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # 关闭保持中的连接，让连接处理协程正常结束
+            for writer in list(self._connections):
+                writer.close()
+            while self._connections:
+                await asyncio.sleep(0.01)
+            await self._server.wait_closed()
+            self._server = None
+
+    def push_update(self, update: dict, token: str = None) -> int:
+        update_id = next(self._update_id)
+        queue = self._updates if token is None else self._token_updates.setdefault(token, [])
+        queue.append({"update_id": update_id, **update})
+        self._new_updates.set()
+        return update_id
+
+    def pending_updates(self) -> int:
+        return len(self._updates) + sum(len(queue) for queue in self._token_updates.values())
+
+    def methods(self) -> list:
+        return [method for method, _ in self.calls]
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = request_line.split()[1].decode()
+                prefix, _, method = path.rpartition("/")
+                request_token.set(prefix.rpartition("/bot")[2])
+                params = self._parse(headers.get("content-type", ""), body)
+                status, payload = await self._call(method, params)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    def _parse(content_type: str, body: bytes) -> dict:
+        if "multipart/form-data" in content_type:
+            # 上传文件：解析普通字段，文件内容只记为 "<file>"
+            message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            fields = [
+                (part.get_param("name", header="content-disposition"),
+                 "<file>" if part.get_filename() else part.get_payload(decode=True).decode())
+                for part in message.get_payload()
+            ]
+        elif "application/x-www-form-urlencoded" in content_type:
+            fields = parse_qsl(body.decode(), keep_blank_values=True)
+        elif "application/json" in content_type:
+            return json.loads(body or b"{}") # 分片前端直接用 httpx 发送 JSON
+        else:
+            return {}
+        params = {}
+        for key, value in fields:
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def _call(self, method: str, params: dict):
+        if method != "getUpdates":
+            self.calls.append((method, params))
+            self.counts[method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        handler = getattr(self, f"_api_{method}", None)
+        result = await handler(params) if handler else True
+        return 200, {"ok": True, "result": result}
+
+    def _message(self, chat_id, **fields) -> dict:
+        chat_id = int(chat_id)
+        chat = {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}
+        return {"message_id": next(self._message_id), "date": int(time.time()), "chat": chat, **fields}
+
+    async def _api_getMe(self, params):
+        return {"id": self.bot_id, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    async def _api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        token = request_token.get()
+        pending = lambda: self._token_updates.get(token) or self._updates
+        for queue in (self._updates, self._token_updates.get(token, [])):
+            queue[:] = [u for u in queue if u["update_id"] >= offset]
+        if not pending():
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(params.get("timeout") or 0), 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return pending()[:int(params.get("limit") or 100)]
+
+    async def _api_getChat(self, params):
+        chat_id = int(params["chat_id"])
+        if chat_id < 0:
+            chat = {"id": chat_id, "type": "supergroup", "title": "Admin", "is_forum": True}
+        else:
+            chat = {"id": chat_id, "type": "private", "first_name": "User"}
+        return {**chat, "accent_color_id": 0, "max_reaction_count": 11}
+
+    async def _api_sendMessage(self, params):
+        return self._message(params["chat_id"], text=params.get("text", ""))
+
+    async def _api_sendPhoto(self, params):
+        photo = [{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1, "file_size": 1}]
+        return self._message(params.get("chat_id", 0), photo=photo)
+
+    async def _api_copyMessage(self, params):
+        return {"message_id": next(self._message_id)}
+
+    async def _api_copyMessages(self, params):
+        return [{"message_id": next(self._message_id)} for _ in params.get("message_ids", [])]
+
+    async def _api_createForumTopic(self, params):
+        thread_id = next(self._thread_id)
+        self.topics[thread_id] = str(params.get("name", ""))
+        return {"message_thread_id": thread_id, "name": self.topics[thread_id], "icon_color": 0}
+
+    async def _api_editForumTopic(self, params):
+        if "name" in params:
+            self.topics[int(params["message_thread_id"])] = str(params["name"])
+        return True
+
+    async def _api_deleteForumTopic(self, params):
+        self.topics.pop(int(params["message_thread_id"]), None)
+        return True
+
+    async def _api_getUserProfilePhotos(self, params):
+        return {"total_count": 0, "photos": []}
@@ -0,0 +1,255 @@
+"""长时间运行测试 (soak)：用合成流量驱动真实的处理器，连接本地的假 Bot API，
+定期采样 RSS、各类型对象数量、数据库会话 identity map、任务数和每个更新的处理耗时，
+内存或处理耗时相对预热后的基线漂移超过阈值时失败。
+
+    python tests/soak.py --minutes 120 --rate 30 --users 2000
+
+退出码 0 表示通过，1 表示检测到漂移。tests/test_soak.py 以较短的时长运行同一流程。
+"""
+import argparse
+import asyncio
+import gc
+import importlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS_DIR)
+
+ADMIN_GROUP_ID = -1001
+ADMIN_ID = 1
+
+# 包在导入时读取配置，必须在导入前设置。关闭验证码和限流，限制缓存大小以便在预热期内达到稳定
+ENV = {
+    "BOT_TOKEN": "123456:TEST",
+    "APP_NAME": "interactive-bot-test",
+    "ADMIN_GROUP_ID": str(ADMIN_GROUP_ID),
+    "ADMIN_USER_IDS": str(ADMIN_ID),
+    "DISABLE_CAPTCHA": "TRUE",
+    "MESSAGE_INTERVAL": "0",
+    "MESSAGE_CACHE_SIZE": "5000",
+    "USER_STATE_MAX": "1000",
+    "EDIT_SYNC_DELAY": "0.5",
+    "LOOP_LAG_THRESHOLD": "0",
+}
+
+
+def setup_environment(work_dir: str = None) -> str:
+    """设置测试配置并切换到临时工作目录 (数据库、持久化文件和 log.txt 写在这里)，返回该目录。"""
+    for key, value in ENV.items():
+        os.environ[key] = value
+    os.environ.pop("TENANTS_FILE", None)
+    work_dir = work_dir or tempfile.mkdtemp(prefix="interactive-bot-test-")
+    os.makedirs(os.path.join(work_dir, "assets"), exist_ok=True)
+    os.chdir(work_dir)
+    for path in (ROOT, TESTS_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return work_dir
+
+
+class Traffic:
+    """合成流量：固定数量的用户发消息、编辑消息，管理员在话题中回复。随机数种子固定，结果可复现。"""
+
+    def __init__(self, api, users: int, seed: int = 0):
+        self.api = api
+        self.random = random.Random(seed)
+        self.user_ids = [100000 + i for i in range(users)]
+        self.last_message = {} # 用户 ID -> 最近一条消息 ID
+        self.group_message_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _private(self, user_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def next_update(self) -> dict:
+        r = self.random.random()
+        if r < 0.2 and self.api.topics:
+            # 管理员在某个话题中回复
+            thread_id = self.random.choice(list(self.api.topics))
+            self.group_message_id += 1
+            return {"message": {
+                "message_id": self.group_message_id,
+                "date": int(time.time()),
+                "chat": {"id": ADMIN_GROUP_ID, "type": "supergroup", "title": "Admin", "is_forum": True},
+                "from": self._user(ADMIN_ID),
+                "message_thread_id": thread_id,
+                "is_topic_message": True,
+                "text": f"reply {self.group_message_id}",
+            }}
+        user_id = self.random.choice(self.user_ids)
+        if r < 0.3 and user_id in self.last_message:
+            # 用户编辑自己最近的消息
+            message = self._private(user_id, self.last_message[user_id], f"edited {self.random.random()}")
+            message["edit_date"] = int(time.time())
+            return {"edited_message": message}
+        message_id = self.last_message.get(user_id, 0) + 1
+        self.last_message[user_id] = message_id
+        return {"message": self._private(user_id, message_id, f"hello {message_id}")}
+
+
+class SoakReport:
+    def __init__(self, samples: list, warmup: float, max_rss_growth_mb: float, latency_factor: float,
+                 min_latency: float, max_backlog: int):
+        self.samples = samples
+        self.failures = []
+        after = [s for s in samples if s["elapsed"] >= warmup]
+        if len(after) < 2:
+            self.failures.append(f"only {len(after)} samples after the {warmup}s warm-up")
+            return
+        baseline, final = after[0], after[-1]
+        self.rss_growth_mb = (final["rss"] - baseline["rss"]) / 2**20
+        if final["rss"] and self.rss_growth_mb > max_rss_growth_mb:
+            self.failures.append(f"RSS grew {self.rss_growth_mb:.1f}MB after warm-up (limit {max_rss_growth_mb}MB)")
+
+        # 处理耗时取开头和结尾几个采样窗口的平均值，减少抖动
+        window = max(1, len(after) // 4)
+        first = self._latency(after[:window])
+        last = self._latency(after[-window:])
+        self.latency = (first, last)
+        if first and last and last > min_latency and last > first * latency_factor:
+            self.failures.append(
+                f"average update latency rose from {first * 1000:.1f}ms to {last * 1000:.1f}ms "
+                f"(limit {latency_factor}x)"
+            )
+        if final["backlog"] > max_backlog:
+            self.failures.append(f"{final['backlog']} updates waiting at the end (limit {max_backlog})")
+
+        self.growth = {
+            key: final[key] - baseline[key]
+            for key in ("objects", "db identity map", "jobs", "user_data", "chat_data", "tasks")
+            if key in final
+        }
+        self.fastest_growing = final["growth_since_warmup"]
+
+    @staticmethod
+    def _latency(samples: list):
+        updates = sum(s["updates"] for s in samples)
+        return sum(s["update_seconds"] for s in samples) / updates if updates else None
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+    def summary(self) -> str:
+        lines = ["elapsed  rss(MB)  objects  identity  jobs  user_data  updates  avg(ms)  backlog"]
+        for s in self.samples:
+            lines.append(
+                f"{s['elapsed']:>7.0f}  {s['rss'] / 2**20:>7.1f}  {s['objects']:>7}  {s['db identity map']:>8}  "
+                f"{s['jobs']:>4}  {s['user_data']:>9}  {s['updates']:>7}  {(s['latency'] or 0) * 1000:>7.2f}  "
+                f"{s['backlog']:>7}"
+            )
+        if hasattr(self, "growth"):
+            lines.append("growth after warm-up: " + ", ".join(f"{k} {v:+}" for k, v in self.growth.items()))
+            lines.append("fastest-growing types: " + (", ".join(f"{n} +{c}" for n, c in self.fastest_growing) or "none"))
+        lines.append("PASS" if self.ok else "FAIL: " + "; ".join(self.failures))
+        return "\n".join(lines)
+
+
+async def soak(
+    duration: float,
+    rate: float = 30,
+    users: int = 500,
+    sample_interval: float = 60,
+    warmup: float = None,
+    api_latency: float = 0.005,
+    max_rss_growth_mb: float = 64,
+    latency_factor: float = 2,
+    min_latency: float = 0.02,
+    max_backlog: int = None,
+    seed: int = 0,
+) -> SoakReport:
+    """运行 duration 秒，每秒约 rate 个更新，返回报告。warmup 默认为总时长的 1/4。"""
+    from telegram import Update
+
+    from fakebotapi import FakeBotAPI
+
+    main = importlib.import_module("interactive-bot.__main__")
+    monitor = importlib.import_module("interactive-bot.monitor").monitor
+    object_counts = importlib.import_module("interactive-bot.monitor").object_counts
+
+    warmup = duration / 4 if warmup is None else warmup
+    max_backlog = int(rate * 10) if max_backlog is None else max_backlog
+    api = FakeBotAPI(latency=api_latency)
+    url = await api.start()
+    application = main.build_application(base_url=f"{url}/bot")
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, allowed_updates=Update.ALL_TYPES)
+    await application.start()
+
+    traffic = Traffic(api, users, seed)
+    samples = []
+    warm_counts = None
+    started = time.monotonic()
+    next_sample = started + sample_interval
+    monitor.sample() # 丢弃启动期间的处理耗时
+    try:
+        while time.monotonic() - started < duration:
+            for _ in range(max(1, round(rate / 10))):
+                api.push_update(traffic.next_update())
+            await asyncio.sleep(0.1)
+            if time.monotonic() < next_sample:
+                continue
+            next_sample += sample_interval
+            gc.collect()
+            sample = monitor.sample()
+            elapsed = time.monotonic() - started
+            if warm_counts is None and elapsed >= warmup:
+                warm_counts = object_counts()
+            sample.update(
+                elapsed=elapsed,
+                update_seconds=(sample["latency"] or 0) * sample["updates"],
+                backlog=api.pending_updates() + application.update_queue.qsize(),
+                growth_since_warmup=(object_counts() - warm_counts).most_common(8) if warm_counts else [],
+            )
+            samples.append(sample)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+        await api.stop()
+    return SoakReport(samples, warmup, max_rss_growth_mb, latency_factor, min_latency, max_backlog)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--minutes", type=float, default=60, help="运行时长 (分钟)")
+    parser.add_argument("--rate", type=float, default=30, help="每秒更新数")
+    parser.add_argument("--users", type=int, default=500, help="模拟用户数")
+    parser.add_argument("--sample-interval", type=float, default=60, help="采样间隔 (秒)")
+    parser.add_argument("--warmup", type=float, default=None, help="预热时长 (秒)，默认为总时长的 1/4")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=64)
+    parser.add_argument("--latency-factor", type=float, default=2, help="平均处理耗时相对基线的最大倍数")
+    parser.add_argument("--work-dir", default=None, help="工作目录 (数据库等)，默认为新的临时目录")
+    args = parser.parse_args()
+
+    work_dir = setup_environment(args.work_dir)
+    print(f"Soak test running in {work_dir}")
+    report = asyncio.run(soak(
+        args.minutes * 60,
+        rate=args.rate,
+        users=args.users,
+        sample_interval=args.sample_interval,
+        warmup=args.warmup,
+        max_rss_growth_mb=args.max_rss_growth_mb,
+        latency_factor=args.latency_factor,
+    ))
+    print(report.summary())
+    sys.exit(0 if report.ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import importlib
+from datetime import datetime, timedelta
+
+from db.database import SessionMaker
+from db.model import MessageMap, User
+
+archive = importlib.import_module("interactive-bot.archive")
+
+
+def test_import_does_not_collide_with_reused_ids(database, tmp_path):
+    old = datetime.now() - timedelta(days=100)
+    with SessionMaker() as session:
+        session.add(User(user_id=501, first_name="Old", message_thread_id=0, last_active_at=old))
+        for i in range(3):
+            session.add(MessageMap(user_id=501, user_chat_message_id=i + 1, group_chat_message_id=100 + i, direction="u2a"))
+        session.commit()
+
+    path, maps, users = archive.export_inactive(30, str(tmp_path))
+    assert (maps, users) == (3, 1)
+
+    # 导出后新写入的记录重新使用了被删除的主键
+    with SessionMaker() as session:
+        session.add(User(user_id=502, first_name="New"))
+        for i in range(3):
+            session.add(MessageMap(user_id=502, user_chat_message_id=i + 1, group_chat_message_id=200 + i, direction="u2a"))
+        session.commit()
+        assert session.query(MessageMap.id).filter(MessageMap.user_id == 502).count() == 3
+
+    assert archive.import_archive(path) == 4
+    with SessionMaker() as session:
+        assert session.query(MessageMap).filter(MessageMap.user_id == 501).count() == 3
+        assert session.query(User).filter(User.user_id == 501).count() == 1
+
+    # 再次导入同一文件不产生重复记录
+    assert archive.import_archive(path) == 0
+    with SessionMaker() as session:
+        assert session.query(MessageMap).count() == 6
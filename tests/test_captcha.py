@@ -0,0 +1,215 @@
+import asyncio
+import importlib
+import os
+import shutil
+import time
+
+import pytest
+
+from conftest import WORK_DIR
+from fakebotapi import FakeBotAPI
+
+captcha = importlib.import_module("interactive-bot.captcha")
+userstate = importlib.import_module("interactive-bot.userstate")
+
+KEY = captcha.captcha_key("123456:TEST")
+CODE = "ABCDE"
+CHOICES = ["XYZ23", CODE, "PQRS4"]
+USER_ID = 4242
+
+
+def challenge(issued_at: int, user_id: int = USER_ID) -> dict:
+    """选项 -> 回调数据"""
+    return dict(zip(CHOICES, captcha.challenge_callback_data(KEY, user_id, CODE, CHOICES, issued_at)))
+
+
+def test_verify_callback_results():
+    now = 1_700_000_000.0
+    data = challenge(captcha.timestamp_ms(now))
+    verify = lambda d, **kw: captcha.verify_callback(KEY, d, USER_ID, 60, now=now + 1, **kw)
+
+    assert verify(data[CODE]) == captcha.OK
+    assert verify(data["XYZ23"]) == captcha.WRONG
+    assert captcha.verify_callback(KEY, data[CODE], USER_ID, 60, now=now + 60) == captcha.EXPIRED
+    assert captcha.verify_callback(KEY, data[CODE], USER_ID + 1, 60, now=now + 1) == captcha.NOT_YOURS
+    assert verify("vcode_ABCDE_4242_soon_AAAAAAAAAAAAAAAA") == captcha.INVALID
+    assert verify("other_ABCDE_4242_1_AAAAAAAAAAAAAAAA") == captcha.INVALID
+    assert verify(f"vcode_{CODE}_{USER_ID}") == captcha.EXPIRED # 旧版本的回调数据
+    # 篡改答案或签名
+    assert verify(data[CODE][:-1] + ("A" if data[CODE][-1] != "A" else "B")) == captcha.WRONG
+    assert verify(data["XYZ23"].replace("XYZ23", CODE, 1)) == captcha.OK # 答案不在回调数据中，换选项等于点击该选项
+
+
+def test_verify_callback_rejects_challenges_before_not_before():
+    now = 1_700_000_000.0
+    older = challenge(captcha.timestamp_ms(now))
+    newer = challenge(captcha.timestamp_ms(now + 5))
+    not_before = captcha.timestamp_ms(now + 5)
+    verify = lambda d: captcha.verify_callback(KEY, d, USER_ID, 60, not_before, now=now + 6)
+
+    assert verify(older[CODE]) == captcha.EXPIRED
+    assert verify(newer[CODE]) == captcha.OK
+
+
+def test_callback_data_fits_telegram_limit():
+    data = captcha.challenge_callback_data(KEY, 2**52, CODE, CHOICES, captcha.timestamp_ms())
+    assert all(len(d.encode()) <= 64 for d in data)
+
+
+def test_user_state_failure_invalidates_open_challenges():
+    state = userstate.UserState()
+    state.issue_captcha(1000)
+    state.issue_captcha(900) # 发出顺序乱序时不回退
+    assert state.captcha_not_before == 1000
+    state.fail_captcha(120, now=5.0)
+    assert state.is_muted(now=6.0)
+    assert state.captcha_not_before == 5000
+
+
+def test_deduper_drops_expired_and_oldest_taps():
+    deduper = captcha.CallbackDeduper(60, max_size=3)
+    assert deduper.first("a", now=0)
+    assert not deduper.first("a", now=1)
+    assert deduper.first("b", now=30)
+    assert deduper.first("a", now=61) # "a" 已过期
+    assert deduper.first("c", now=62)
+    assert deduper.first("d", now=63) # 超过上限，淘汰最早的 "b"
+    assert len(deduper) == 3
+    assert deduper.first("b", now=64)
+    assert not deduper.first("d", now=64)
+
+
+def test_save_is_human_inserts_or_updates_user(database, monkeypatch):
+    from telegram import User as TelegramUser
+
+    from db.database import SessionMaker
+    from db.model import User
+
+    main = importlib.import_module("interactive-bot.__main__")
+    monkeypatch.setattr(main, "db", SessionMaker())
+    main._save_is_human(TelegramUser(6001, "New", False))
+    with SessionMaker() as session:
+        session.add(User(user_id=6002, first_name="Known"))
+        session.commit()
+    main._save_is_human(TelegramUser(6002, "Known", False))
+
+    assert main._load_is_human(6001) and main._load_is_human(6002)
+    with SessionMaker() as session:
+        assert session.query(User).count() == 2
+
+
+@pytest.fixture
+def captcha_images():
+    img_dir = os.path.join(WORK_DIR, "assets", "imgs")
+    os.makedirs(img_dir, exist_ok=True)
+    with open(os.path.join(img_dir, f"image_{CODE}.png"), "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+    yield img_dir
+    shutil.rmtree(img_dir)
+
+
+class CaptchaSession:
+    """连接假 Bot API 的真实 Application，用于发出验证码并模拟点击按钮。"""
+
+    def __init__(self, main, api, application):
+        self.main = main
+        self.api = api
+        self.application = application
+        self.message_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+            "from": self._user(user_id),
+            "text": "hi",
+        }
+
+    async def issue(self, user_id: int) -> dict:
+        """用户发消息触发 check_human，返回本次验证码的 选项 -> (回调数据, 消息 ID)。"""
+        from telegram import Update
+        from telegram.ext import CallbackContext
+
+        update = Update.de_json({"update_id": 0, "message": self._message(user_id)}, self.application.bot)
+        assert await self.main.check_human(update, CallbackContext.from_update(update, self.application)) is False
+        await asyncio.sleep(0.002) # 发出时间精确到毫秒
+        keyboard = [params for method, params in self.api.calls if method == "sendPhoto"][-1]["reply_markup"]
+        self.message_id += 1
+        return {
+            button["text"]: (button["callback_data"], self.message_id)
+            for row in keyboard["inline_keyboard"] for button in row
+        }
+
+    async def tap(self, user_id: int, button: tuple) -> str:
+        """点击验证码按钮，返回 answerCallbackQuery 的提示文字。"""
+        from telegram import Update
+
+        data, message_id = button
+        message = self._message(user_id)
+        message["message_id"] = message_id
+        update = {
+            "update_id": 0,
+            "callback_query": {
+                "id": str(message_id), "from": self._user(user_id), "chat_instance": "1",
+                "data": data, "message": message,
+            },
+        }
+        await self.application.process_update(Update.de_json(update, self.application.bot))
+        return [params for method, params in self.api.calls if method == "answerCallbackQuery"][-1]["text"]
+
+
+async def run_session(scenario):
+    main = importlib.import_module("interactive-bot.__main__")
+    api = FakeBotAPI()
+    url = await api.start()
+    application = main.build_application(base_url=f"{url}/bot")
+    await application.initialize()
+    try:
+        await scenario(CaptchaSession(main, api, application))
+    finally:
+        await application.shutdown()
+        await api.stop()
+
+
+def test_wrong_answer_invalidates_other_open_challenges(database, captcha_images):
+    async def scenario(session):
+        # 在限流前领取多个验证码，逐个猜测
+        first = await session.issue(5001)
+        second = await session.issue(5001)
+        third = await session.issue(5001)
+        wrong = next(button for text, button in third.items() if text != CODE)
+        assert "错误" in await session.tap(5001, wrong)
+        assert "过期" in await session.tap(5001, second[CODE])
+        # 禁言结束后，答错之前发出的验证码仍然无效
+        session.main.user_states.get(5001).muted_until = 0
+        assert "过期" in await session.tap(5001, first[CODE])
+        assert not session.main.user_states.get(5001).is_human
+
+    asyncio.run(run_session(scenario))
+
+
+def test_muted_user_cannot_pass(database, captcha_images):
+    async def scenario(session):
+        latest = await session.issue(5003)
+        session.main.user_states.get(5003).mute(120)
+        assert "禁言" in await session.tap(5003, latest[CODE])
+        assert not session.main.user_states.get(5003).is_human
+
+    asyncio.run(run_session(scenario))
+
+
+def test_only_latest_challenge_is_valid(database, captcha_images):
+    async def scenario(session):
+        older = await session.issue(5002)
+        newer = await session.issue(5002)
+        assert "过期" in await session.tap(5002, older[CODE])
+        assert not session.main.user_states.get(5002).is_human
+        assert "成功" in await session.tap(5002, newer[CODE])
+        assert session.main.user_states.get(5002).is_human
+
+    asyncio.run(run_session(scenario))
@@ -0,0 +1,98 @@
+import asyncio
+import importlib
+
+from telegram.error import BadRequest, NetworkError
+
+from db.database import SessionMaker
+from db.model import User
+
+outbox_module = importlib.import_module("interactive-bot.outbox")
+
+
+def test_new_message_does_not_cut_backoff_short(database):
+    attempts = []
+
+    async def deliver(bot, session, item):
+        attempts.append((item.message_id, asyncio.get_running_loop().time()))
+        if len(attempts) == 1:
+            raise NetworkError("timed out")
+
+    async def on_failed(bot, item, error):
+        raise AssertionError(f"unexpected failure: {error}")
+
+    async def scenario():
+        outbox = outbox_module.Outbox(deliver, on_failed, workers=2)
+        await outbox.start(None)
+        started = asyncio.get_running_loop().time()
+        outbox.enqueue(7, 1)
+        await asyncio.sleep(0.2)
+        # 第一次投递失败后退避 2 秒，期间的新消息不应触发立即重试
+        outbox.enqueue(7, 2)
+        await asyncio.sleep(0.5)
+        assert len(attempts) == 1
+        await asyncio.sleep(2)
+        await outbox.stop()
+        assert [message_id for message_id, _ in attempts] == [1, 1, 2]
+        assert attempts[1][1] - started >= 2
+
+    asyncio.run(scenario())
+
+
+def test_messages_of_other_shards_are_left_to_their_owner(database):
+    delivered = {0: [], 1: []}
+
+    def deliver_on(shard):
+        async def deliver(bot, session, item):
+            delivered[shard].append(item.message_id)
+        return deliver
+
+    async def on_failed(bot, item, error):
+        raise AssertionError(f"unexpected failure: {error}")
+
+    async def scenario():
+        shard0 = outbox_module.Outbox(deliver_on(0), on_failed, poll_interval=0.1)
+        shard1 = outbox_module.Outbox(deliver_on(1), on_failed, poll_interval=0.1)
+        await shard0.start(None, 0, 2)
+        await shard1.start(None, 1, 2)
+        # 0 号分片的放行任务为 1 号分片的用户写入消息，由 1 号分片投递
+        shard0.enqueue(9, 1)
+        shard0.enqueue(9, 2)
+        await shard0.wait_idle(9, timeout=5)
+        await shard0.stop()
+        await shard1.stop()
+
+    asyncio.run(scenario())
+    assert delivered == {0: [], 1: [1, 2]}
+
+
+class DeletedTopicBot:
+    def __init__(self):
+        self.sent = []
+
+    async def copy_message(self, **kwargs):
+        raise BadRequest("Message thread not found")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def test_deleted_topic_is_reported_once_per_user(database, monkeypatch):
+    main = importlib.import_module("interactive-bot.__main__")
+    session = SessionMaker()
+    monkeypatch.setattr(main, "db", session)
+    session.add(User(user_id=8, first_name="U", message_thread_id=55))
+    session.commit()
+
+    async def scenario():
+        bot = DeletedTopicBot()
+        outbox = outbox_module.Outbox(main._deliver_u2a, main._on_u2a_failed)
+        await outbox.start(bot)
+        for message_id in (1, 2, 3):
+            outbox.enqueue(8, message_id)
+        await outbox.drain(5)
+        return bot.sent
+
+    sent = asyncio.run(scenario())
+    assert len(sent) == 1
+    assert "已被删除" in sent[0][1]
+    assert session.query(User.message_thread_id).filter(User.user_id == 8).scalar() is None
@@ -0,0 +1,102 @@
+import importlib
+
+raid = importlib.import_module("interactive-bot.raid")
+
+KNOWN_MAX_ID = 1000
+
+
+def replay(detector, quarantine, arrivals):
+    """按时间顺序回放新用户的首条消息 [(时间, 用户 ID, 内容)]，返回被隔离的用户。"""
+    quarantined = []
+    for message_id, (now, user_id, text) in enumerate(arrivals, start=1):
+        digest = raid.hashlib.sha1(text.encode()).hexdigest()
+        if detector.should_quarantine(user_id, digest, now=now):
+            quarantine.add(user_id, message_id, digest)
+            quarantined.append(user_id)
+    return quarantined
+
+
+def raid_wave(start: float, first_id: int, count: int, text: str = "buy followers at spam.example"):
+    return [(start + i * 0.5, first_id + i, text) for i in range(count)]
+
+
+def test_raid_wave_is_quarantined_and_released_after_calm(database):
+    detector = raid.RaidDetector(10, duplicate_threshold=3, calm_seconds=300)
+    detector.note_known_user(KNOWN_MAX_ID)
+    quarantine = raid.Quarantine(duplicate_threshold=3)
+
+    # 平时：每分钟两三个新用户，内容各不相同
+    normal = [(i * 25.0, KNOWN_MAX_ID + 1 + i, f"hello {i}") for i in range(6)]
+    assert replay(detector, quarantine, normal) == []
+    assert not detector.under_attack(now=150)
+
+    # 攻击：一分钟内 40 个新注册账号发送相同内容，期间混入两个内容正常的新用户
+    wave = raid_wave(200, 5000, 40)
+    wave[10] = (wave[10][0], 9001, "hi, I have a question about my order")
+    wave[30] = (wave[30][0], 9002, "is anyone there?")
+    quarantined = replay(detector, quarantine, wave)
+    assert detector.under_attack(now=230)
+    # 重复内容第 3 次出现时进入攻击状态，之后的新用户全部隔离
+    assert quarantined == [user_id for _, user_id, _ in wave[2:]]
+    assert quarantine.users == set(quarantined)
+
+    # 只发送垃圾内容的用户不会被放行，正常用户按进入隔离区的顺序放行
+    assert quarantine.is_spam_only(5029)
+    assert not quarantine.is_spam_only(9001)
+    assert quarantine.candidates(10) == [9001, 9002]
+
+    # 平静期结束后解除攻击状态
+    last = wave[-1][0]
+    assert detector.under_attack(now=last + 299)
+    assert not detector.under_attack(now=last + 301)
+
+    assert quarantine.pop(9001) == [11]
+    assert quarantine.candidates(10) == [9002]
+    assert 9001 not in quarantine.users
+
+
+def test_known_users_pass_during_raid(database):
+    detector = raid.RaidDetector(10, duplicate_threshold=3, calm_seconds=300)
+    detector.note_known_user(KNOWN_MAX_ID)
+    quarantine = raid.Quarantine(duplicate_threshold=3)
+
+    replay(detector, quarantine, raid_wave(0, 5000, 20))
+    assert detector.under_attack(now=15)
+    # 攻击前已注册的老账号第一次发消息，内容正常时不隔离
+    assert replay(detector, quarantine, [(15, 42, "my subscription renewal failed")]) == []
+    # 老账号转发攻击内容仍会被隔离
+    assert replay(detector, quarantine, [(16, 43, "buy followers at spam.example")]) == [43]
+
+
+def test_quarantine_survives_restart(database):
+    quarantine = raid.Quarantine()
+    quarantine.add(7001, 1, "a")
+    quarantine.add(7001, 2, "b")
+
+    restarted = raid.Quarantine()
+    restarted.load()
+    assert restarted.users == {7001}
+    assert restarted.pop(7001) == [1, 2]
+
+
+def test_quarantined_messages_are_popped_once_across_processes(database):
+    # 放行任务 (0 号分片) 和用户所在的分片各自持有 Quarantine 实例
+    release_job = raid.Quarantine()
+    user_shard = raid.Quarantine()
+    release_job.add(7002, 1, "a")
+    release_job.add(7002, 2, "b")
+    user_shard.load()
+
+    assert release_job.pop(7002) == [1, 2]
+    assert user_shard.pop(7002) == []
+
+
+def test_split_scales_thresholds_per_shard():
+    detector = raid.RaidDetector(10, duplicate_threshold=6)
+    detector.split(4)
+    assert detector.threshold == 3
+    assert detector.duplicate_threshold == 2
+
+    disabled = raid.RaidDetector(0)
+    disabled.split(4)
+    assert not disabled.enabled
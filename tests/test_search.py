@@ -0,0 +1,40 @@
+import importlib
+
+search = importlib.import_module("interactive-bot.search")
+
+
+def make_index(**kwargs):
+    index = search.SearchIndex(True, **kwargs)
+    index.setup()
+    return index
+
+
+def test_more_relevant_messages_rank_first(database):
+    index = make_index()
+    index.add(1, 11, "u2a", "refund please, the refund for my refund request")
+    index.add(2, 12, "u2a", "hello, where is my order? I also asked about a refund last week and nobody answered")
+    index.add(3, 13, "u2a", "nothing to see here")
+
+    hits = index.search("refund")
+    assert [rowid for rowid, _, _ in hits] == [1, 2]
+    assert all(search.HIT_START in snippet for _, _, snippet in hits)
+    assert hits[0][1] == 11
+
+
+def test_ranking_is_limited_to_recent_matches(database):
+    index = make_index(rank_window=3)
+    index.add(1, 11, "u2a", "order order order order")
+    for rowid in range(2, 8):
+        index.add(rowid, 12, "u2a", f"a long message about an order number {rowid} that is still pending")
+
+    # 最相关的旧消息不在最近 3 条匹配之外参与排序
+    assert [rowid for rowid, _, _ in index.search("order", limit=10)] == [7, 6, 5]
+
+
+def test_short_terms_fall_back_to_newest_first(database):
+    index = make_index()
+    if not index.trigram:
+        return
+    index.add(1, 11, "u2a", "退款申请")
+    index.add(2, 12, "u2a", "还没有退款")
+    assert [rowid for rowid, _, _ in index.search("退款")] == [2, 1]
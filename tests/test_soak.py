@@ -0,0 +1,24 @@
+import asyncio
+import importlib
+
+import soak
+
+
+def test_short_soak_has_no_drift():
+    report = asyncio.run(soak.soak(20, rate=30, users=100, sample_interval=2, warmup=8, max_rss_growth_mb=32))
+    assert report.ok, report.summary()
+
+
+def test_soak_detects_a_leaking_handler(monkeypatch):
+    main = importlib.import_module("interactive-bot.__main__")
+    leaked = []
+    update_user_db = main.update_user_db
+
+    def leaking_update_user_db(user):
+        leaked.append(bytearray(256 * 1024))
+        update_user_db(user)
+
+    monkeypatch.setattr(main, "update_user_db", leaking_update_user_db)
+    report = asyncio.run(soak.soak(12, rate=30, users=100, sample_interval=2, warmup=4, max_rss_growth_mb=16))
+    assert not report.ok
+    assert "RSS grew" in report.failures[0]
@@ -0,0 +1,70 @@
+import asyncio
+import importlib
+import time
+
+from db.database import SessionMaker
+from db.model import AdminStats, User
+from fakebotapi import FakeBotAPI
+from soak import ADMIN_GROUP_ID
+
+ADMIN = {"id": 77, "is_bot": False, "first_name": "Admin"}
+
+
+class BlockedBotAPI(FakeBotAPI):
+    """向 blocked 中的用户复制消息时返回 "chat not found"。"""
+
+    def __init__(self, blocked):
+        super().__init__()
+        self.blocked = set(blocked)
+
+    async def _call(self, method: str, params: dict):
+        if method == "copyMessage" and int(params["chat_id"]) in self.blocked:
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+        return await super()._call(method, params)
+
+
+def admin_message(message_id: int, thread_id: int, **fields) -> dict:
+    return {"update_id": message_id, "message": {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": ADMIN_GROUP_ID, "type": "supergroup", "title": "Admin", "is_forum": True},
+        "from": ADMIN,
+        "message_thread_id": thread_id,
+        "is_topic_message": True,
+        **fields,
+    }}
+
+
+def test_only_delivered_messages_count_as_admin_replies(database, monkeypatch):
+    from telegram import Update
+
+    main = importlib.import_module("interactive-bot.__main__")
+    monkeypatch.setattr(main, "db", SessionMaker())
+    with SessionMaker() as session:
+        session.add(User(user_id=601, first_name="Reachable", message_thread_id=11))
+        session.add(User(user_id=602, first_name="Blocked", message_thread_id=12))
+        session.commit()
+
+    async def scenario():
+        api = BlockedBotAPI(blocked={602})
+        url = await api.start()
+        application = main.build_application(base_url=f"{url}/bot")
+        await application.initialize()
+        try:
+            updates = [
+                admin_message(1, 12, text="hello?"), # 发送失败
+                admin_message(2, 11, pinned_message={"message_id": 1, "date": 0, "chat": {"id": ADMIN_GROUP_ID, "type": "supergroup"}}),
+                admin_message(3, 11, text="hello"),
+            ]
+            for update in updates:
+                await application.process_update(Update.de_json(update, application.bot))
+        finally:
+            await application.shutdown()
+            await api.stop()
+
+    asyncio.run(scenario())
+    with SessionMaker() as session:
+        replied = dict(session.query(User.user_id, User.last_admin_reply_at))
+        assert replied[601] is not None
+        assert replied[602] is None
+        assert session.query(AdminStats.replies).filter(AdminStats.admin_id == ADMIN["id"]).scalar() == 1
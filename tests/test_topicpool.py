@@ -0,0 +1,92 @@
+import asyncio
+import importlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from telegram.error import BadRequest
+
+from db.database import SessionMaker
+from db.model import FormnStatus, TopicPool as TopicPoolRow
+
+topicpool = importlib.import_module("interactive-bot.topicpool")
+
+
+def test_acquired_topic_is_not_handed_out_twice(database):
+    pool = topicpool.TopicPool(5)
+    pool.add(101)
+    pool.add(102)
+
+    assert pool.acquire(1) == 101
+    assert pool.acquire(2) == 102
+    assert pool.acquire(3) is None
+    assert pool.free_count() == 0
+
+
+def age_allocations(minutes: int = 5):
+    with SessionMaker() as session:
+        session.query(TopicPoolRow).update({TopicPoolRow.acquired_at: datetime.now() - timedelta(minutes=minutes)})
+        session.commit()
+
+
+def test_pending_skips_fresh_allocations(database):
+    pool = topicpool.TopicPool(5)
+    pool.add(101)
+    assert pool.acquire(1) == 101
+
+    # 刚分配的话题可能正在由其他进程绑定，不算作遗留记录
+    assert pool.pending() == []
+    age_allocations()
+    assert pool.pending() == [(101, 1)]
+
+    pool.put_back(101)
+    assert pool.pending() == []
+    assert pool.acquire(2) == 101
+
+
+class PoolBot:
+    """edit_forum_topic 对 gone 中的话题报错，记录删除的话题。"""
+
+    def __init__(self, gone=()):
+        self.gone = set(gone)
+        self.deleted = []
+
+    async def edit_forum_topic(self, chat_id, message_thread_id, **kwargs):
+        if message_thread_id in self.gone:
+            raise BadRequest("Topic_id_invalid")
+
+    async def delete_forum_topic(self, chat_id, message_thread_id):
+        self.deleted.append(message_thread_id)
+
+
+def test_unbound_topics_are_returned_or_deleted(database, monkeypatch):
+    main = importlib.import_module("interactive-bot.__main__")
+    session = SessionMaker()
+    monkeypatch.setattr(main, "db", session)
+    pool = topicpool.TopicPool(5, min_size=0)
+    monkeypatch.setattr(main, "topic_pool", pool)
+    for thread_id, user_id in ((101, 1), (102, 2), (103, 3)):
+        pool.add(thread_id)
+        assert pool.acquire(user_id) == thread_id
+    age_allocations()
+    # 102 绑定后被解除 (已有话题状态记录)，103 已不存在，101 从未使用
+    session.add(FormnStatus(message_thread_id=102, status="opened"))
+    session.commit()
+
+    bot = PoolBot(gone={103})
+    asyncio.run(main._maintain_topic_pool(SimpleNamespace(bot=bot)))
+
+    assert bot.deleted == [102]
+    assert pool.pending() == []
+    assert pool.free_count() == 1
+    assert pool.acquire(4) == 101
+
+
+def test_split_scales_target_size_with_shard_count():
+    pool = topicpool.TopicPool(100, refill_interval=60)
+    for i in range(120):
+        pool.record_arrival(now=i * 30.0)
+    now = 120 * 30.0
+    assert pool.target_size(now=now) == 4
+
+    pool.split(4)
+    assert pool.target_size(now=now) == 16